@@ -19,27 +19,44 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os, sys, platform
-from PyQt5 import QtCore, QtWidgets
-
-from .gpgsync import GPGSync
-
-class Application(QtWidgets.QApplication):
-    def __init__(self):
-        if platform.system() == 'Linux':
-            self.setAttribute(QtCore.Qt.AA_X11InitThreads, True)
-        QtWidgets.QApplication.__init__(self, sys.argv)
 
 def main():
+    from .common import StartupProfile
+    startup_profile = StartupProfile('--startup-profile' in sys.argv)
+
     # https://stackoverflow.com/questions/15157502/requests-library-missing-file-after-cx-freeze
     if getattr(sys, 'frozen', False):
         os.environ["REQUESTS_CA_BUNDLE"] = os.path.join(os.path.dirname(sys.executable), 'cacert.pem')
 
+    # Syncing without the GUI doesn't need Qt at all
+    if '--headless' in sys.argv[1:] or 'sync' in sys.argv[1:]:
+        from . import headless
+        sys.exit(headless.main(sys.argv[1:]))
+
+    from PyQt5 import QtCore, QtWidgets
+    startup_profile.mark('Import Qt')
+    from .gpgsync import GPGSync
+    startup_profile.mark('Import GPG Sync')
+
+    class Application(QtWidgets.QApplication):
+        def __init__(self):
+            if platform.system() == 'Linux':
+                self.setAttribute(QtCore.Qt.AA_X11InitThreads, True)
+            QtWidgets.QApplication.__init__(self, sys.argv)
+
     debug = False
     if '--debug' in sys.argv:
         debug = True
 
     app = Application()
-    gui = GPGSync(app, debug)
+    startup_profile.mark('Create the application')
+    gui = GPGSync(app, debug, startup_profile)
+
+    # Once the event loop is running, startup is done
+    def startup_finished():
+        startup_profile.mark('Start the event loop')
+        startup_profile.report()
+    QtCore.QTimer.singleShot(0, startup_finished)
 
     # Clean up when app quits
     def shutdown():
@@ -18,10 +18,17 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import datetime, os, sys, re, platform, inspect, requests, socket
-from PyQt5 import QtCore, QtWidgets, QtGui
+import datetime, os, sys, re, platform, inspect, socket, threading, tempfile, time
+
+# Qt and requests are only imported by the functions that need them. The
+# headless sync engine runs without Qt, and requests is slow to import, which
+# adds up at every login.
+
+def alert(msg, details='', icon=None):
+    from PyQt5 import QtWidgets
+    if icon is None:
+        icon = QtWidgets.QMessageBox.Warning
 
-def alert(msg, details='', icon=QtWidgets.QMessageBox.Warning):
     d = QtWidgets.QMessageBox()
     d.setWindowTitle('GPG Sync')
     d.setText(msg)
@@ -33,6 +40,7 @@ def alert(msg, details='', icon=QtWidgets.QMessageBox.Warning):
     d.exec_()
 
 def update_alert(curr_version, latest_version, url):
+    from PyQt5 import QtCore, QtWidgets, QtGui
     d = QtWidgets.QMessageBox()
     d.setWindowTitle('GPG Sync')
     d.setText('GPG Sync v{} is now available.<span style="font-weight:normal;">' \
@@ -81,18 +89,81 @@ def get_resource_path(filename):
     resource_path = os.path.join(prefix, filename)
     return resource_path
 
-def requests_get(url, proxies=None):
+"""
+Keeps one pooled requests.Session for each (proxies, verify) combination, so
+downloads reuse their TCP, TLS and SOCKS connections across endpoints and
+syncs, and every request has connect and read timeouts.
+"""
+class SessionManager(object):
+    def __init__(self, connect_timeout=10, read_timeout=60):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.sessions = {}
+        self.request_counts = {}
+        self.lock = threading.Lock()
+
+    def set_timeouts(self, connect_timeout, read_timeout):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def get_session(self, proxies=None, verify=True):
+        key = self._key(proxies, verify)
+        with self.lock:
+            if key not in self.sessions:
+                import requests
+                self.sessions[key] = requests.Session()
+                self.request_counts[key] = 0
+            return self.sessions[key]
+
+    def get(self, url, proxies=None, headers=None, verify=True):
+        session = self.get_session(proxies, verify)
+        with self.lock:
+            self.request_counts[self._key(proxies, verify)] += 1
+
+        return session.get(url, proxies=proxies, headers=headers, verify=verify,
+            timeout=(self.connect_timeout, self.read_timeout))
+
+    def get_stats(self):
+        # Number of requests, connection pools and connections for each session
+        stats = []
+        with self.lock:
+            for key, session in self.sessions.items():
+                pools = []
+                for adapter in session.adapters.values():
+                    managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+                    for manager in managers:
+                        for pool_key in list(manager.pools.keys()):
+                            pool = manager.pools.get(pool_key)
+                            if pool:
+                                pools.append(pool)
+
+                stats.append({
+                    'proxies': dict(key[0]) if key[0] else None,
+                    'verify': key[1],
+                    'requests': self.request_counts[key],
+                    'pools': len(pools),
+                    'connections': sum([pool.num_connections for pool in pools])
+                })
+        return stats
+
+    def _key(self, proxies, verify):
+        return (tuple(sorted(proxies.items())) if proxies else None, verify)
+
+session_manager = SessionManager()
+
+def requests_get(url, proxies=None, headers=None):
     # When creating an OSX app bundle, the requests module can't seem to find
     # the location of cacerts.pem. Here's a hack to let it know where it is.
     # https://stackoverflow.com/questions/17158529/fixing-ssl-certificate-error-in-exe-compiled-with-py2exe-or-pyinstaller
     if getattr(sys, 'frozen', False):
         verify = os.path.join(os.path.dirname(sys.executable), 'requests/cacert.pem')
-        return requests.get(url, proxies=proxies, verify=verify)
+        return session_manager.get(url, proxies=proxies, headers=headers, verify=verify)
     else:
-        return requests.get(url, proxies=proxies)
+        return session_manager.get(url, proxies=proxies, headers=headers)
 
 icon = None
 def get_icon():
+    from PyQt5 import QtGui
     global icon
     if not icon:
         icon = QtGui.QIcon(get_resource_path('gpgsync.png'))
@@ -100,6 +171,7 @@ def get_icon():
 
 systray_icon = None
 def get_systray_icon():
+    from PyQt5 import QtGui
     global systray_icon
     if not systray_icon:
         if platform.system() == 'Darwin':
@@ -110,6 +182,7 @@ def get_systray_icon():
 
 systray_syncing_icon = None
 def get_systray_syncing_icon():
+    from PyQt5 import QtGui
     global systray_syncing_icon
     if not systray_syncing_icon:
         if platform.system() == 'Darwin':
@@ -120,6 +193,7 @@ def get_systray_syncing_icon():
 
 systray_error_icon = None
 def get_systray_error_icon():
+    from PyQt5 import QtGui
     global systray_error_icon
     if not systray_error_icon:
         if platform.system() == 'Darwin':
@@ -134,6 +208,21 @@ def serialize_settings(o):
     if isinstance(o, datetime.datetime):
         return o.isoformat()
 
+def write_file_atomically(filename, data):
+    # Write to a temporary file next to filename and rename it over filename,
+    # so a crash can never leave a half-written file behind. data can be str
+    # or bytes.
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb' if type(data) == bytes else 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except:
+        os.remove(tmp_filename)
+        raise
+
 def internet_available():
     try:
         host = socket.gethostbyname("www.example.com")
@@ -143,3 +232,29 @@ def internet_available():
         pass
 
     return False
+
+"""
+Times each step of starting up, for `gpgsync --startup-profile`, so it's easy
+to see what starting at login costs. When it's not enabled it does nothing.
+"""
+class StartupProfile(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.steps = []
+
+    def mark(self, step):
+        # Record how long it took since the last step
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        for step, seconds in self.steps:
+            print("[Startup] {:8.1f} ms  {}".format(seconds * 1000, step))
+        print("[Startup] {:8.1f} ms  Total".format((self.last - self.started) * 1000))
@@ -18,10 +18,8 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import requests, socks, uuid, datetime
+import datetime
 import dateutil.parser as date_parser
-from io import BytesIO
-from PyQt5 import QtCore, QtWidgets
 
 from . import common
 from .gnupg import *
@@ -39,11 +37,14 @@ class InvalidFingerprints(Exception):
     def __str__(self):
         return str([s.decode() for s in self.fingerprints])
 
-class Endpoint(QtCore.QObject):
-    fetched_public_key_signal = QtCore.pyqtSignal()
+class Endpoint(object):
+    # These change on every sync, so they're saved apart from the configuration
+    state_fields = ['last_checked', 'last_synced', 'last_failed', 'error', 'warning']
 
     def __init__(self):
-        super(Endpoint, self).__init__()
+        # Gets called, from whichever thread is syncing, after the signing key
+        # is fetched from the keyserver
+        self.fetched_public_key_callback = None
 
         self.verified = False
         self.fingerprint = b''
@@ -71,11 +72,18 @@ class Endpoint(QtCore.QObject):
         self.use_proxy = e['use_proxy']
         self.proxy_host = str.encode(e['proxy_host'])
         self.proxy_port = str.encode(e['proxy_port'])
-        self.last_checked = (date_parser.parse(e['last_checked']) if e['last_checked'] is not None else None)
-        self.last_synced = (date_parser.parse(e['last_synced']) if e['last_synced'] is not None else None)
-        self.last_failed = (date_parser.parse(e['last_failed']) if e['last_failed'] is not None else None)
-        self.error = e['error']
-        self.warning = e['warning']
+
+        # Older settings files have the state in them too
+        self.load_state(e)
+
+        return self
+
+    def load_state(self, state):
+        self.last_checked = (date_parser.parse(state['last_checked']) if state.get('last_checked') is not None else None)
+        self.last_synced = (date_parser.parse(state['last_synced']) if state.get('last_synced') is not None else None)
+        self.last_failed = (date_parser.parse(state['last_failed']) if state.get('last_failed') is not None else None)
+        self.error = state.get('error')
+        self.warning = state.get('warning')
 
         return self
 
@@ -83,6 +91,8 @@ class Endpoint(QtCore.QObject):
         tmp = {}
 
         for k, v in self.__dict__.items():
+            if k in self.state_fields or k == 'fetched_public_key_callback':
+                continue
             if isinstance(v, bytes):
                 tmp[k] = v.decode()
             elif isinstance(v, datetime.datetime):
@@ -92,6 +102,22 @@ class Endpoint(QtCore.QObject):
 
         return tmp
 
+    def serialize_state(self):
+        tmp = {}
+
+        for k in self.state_fields:
+            v = getattr(self, k)
+            if isinstance(v, datetime.datetime):
+                tmp[k] = v.isoformat()
+            else:
+                tmp[k] = v
+
+        return tmp
+
+    def get_state_key(self):
+        # Editing an endpoint's signing key or URL starts it over
+        return '{} {}'.format(self.fingerprint.decode(), self.url.decode())
+
     def fetch_public_key(self, gpg):
         # Retreive the signing key from the keyserver
         gpg.recv_key(self.keyserver, self.fingerprint, self.use_proxy, self.proxy_host, self.proxy_port)
@@ -102,7 +128,8 @@ class Endpoint(QtCore.QObject):
         # Save it to disk
         gpg.export_pubkey_to_disk(self.fingerprint)
 
-        self.fetched_public_key_signal.emit()
+        if self.fetched_public_key_callback:
+            self.fetched_public_key_callback()
 
     def fetch_msg_url(self):
         return self.fetch_url(self.url)
@@ -111,6 +138,21 @@ class Endpoint(QtCore.QObject):
         return self.fetch_url(self.sig_url)
 
     def fetch_url(self, url):
+        msg_bytes, validators = self.fetch_url_conditional(url)
+        return msg_bytes
+
+    def fetch_url_conditional(self, url, validators=None):
+        # If validators from an earlier download are given, the server can
+        # answer 304 Not Modified, and then this returns None for the content
+        import requests, socks
+
+        headers = {}
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
         try:
             if self.use_proxy:
                 socks5_address = 'socks5://{}:{}'.format(self.proxy_host.decode(), self.proxy_port.decode())
@@ -120,9 +162,9 @@ class Endpoint(QtCore.QObject):
                   'http': socks5_address
                 }
 
-                r = common.requests_get(url, proxies=proxies)
+                r = common.requests_get(url, proxies=proxies, headers=headers)
             else:
-                r = common.requests_get(url)
+                r = common.requests_get(url, headers=headers)
 
             r.close()
             msg_bytes = r.content
@@ -132,7 +174,13 @@ class Endpoint(QtCore.QObject):
             else:
                 raise URLDownloadError(e)
 
-        return msg_bytes
+        if validators and r.status_code == 304:
+            return None, validators
+
+        return msg_bytes, {
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified')
+        }
 
     def verify_fingerprints_sig(self, gpg, msg_sig_bytes, msg_bytes):
         # Make sure the signature is valid
@@ -161,323 +209,3 @@ class Endpoint(QtCore.QObject):
             raise InvalidFingerprints(invalid_fingerprints)
 
         return fingerprints
-
-class Verifier(QtCore.QThread):
-    alert_error = QtCore.pyqtSignal(str, str)
-    success = QtCore.pyqtSignal(bytes, bytes, bytes, bool, bytes, bytes)
-
-    def __init__(self, debug, gpg, q, fingerprint, url, keyserver, use_proxy, proxy_host, proxy_port):
-        super(Verifier, self).__init__()
-        self.debug = debug
-        self.gpg = gpg
-        self.q = q
-        self.fingerprint = fingerprint
-        self.url = url
-        self.sig_url = self.url + b'.sig'
-        self.keyserver = keyserver
-        self.use_proxy = use_proxy
-        self.proxy_host = proxy_host
-        self.proxy_port = proxy_port
-
-    def finish_with_failure(self):
-        self.q.add_message(type='clear')
-        self.finished.emit()
-
-    def log(self, message, timeout=None):
-        if self.debug:
-            print("[Verifier] {}".format(message))
-
-        if timeout:
-            self.q.add_message(message, timeout=timeout)
-        else:
-            self.q.add_message(message)
-
-    def run(self):
-        print("Verifying endpoint with authority key {}".format(self.fingerprint.decode()))
-
-        # Make an endpoint
-        e = Endpoint()
-        e.fingerprint = self.fingerprint
-        e.url = self.url
-        e.sig_url = self.sig_url
-        e.keyserver = self.keyserver
-        e.use_proxy = self.use_proxy
-        e.proxy_host = self.proxy_host
-        e.proxy_port = self.proxy_port
-
-        # Test loading URL
-        success = False
-        try:
-            self.log('Testing downloading URL {}'.format(self.url.decode()))
-            msg_bytes = e.fetch_msg_url()
-        except ProxyURLDownloadError as e:
-            self.alert_error.emit('URL failed to download: Check your internet connection and proxy settings.', str(e))
-        except URLDownloadError as e:
-            self.alert_error.emit('URL failed to download: Check your internet connection.', str(e))
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure()
-
-        # Test loading signature URL
-        success = False
-        try:
-            self.log('Testing downloading URL {}'.format(self.sig_url.decode()))
-            msg_sig_bytes = e.fetch_msg_sig_url()
-        except ProxyURLDownloadError as e:
-            self.alert_error.emit('URL failed to download: Check your internet connection and proxy settings.', str(e))
-        except URLDownloadError as e:
-            self.alert_error.emit('URL failed to download: Check your internet connection.', str(e))
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure()
-
-        # Test fingerprint and keyserver, and that the key isn't revoked or expired
-        success = False
-        try:
-            self.log('Downloading {} from keyserver {}'.format(common.fp_to_keyid(self.fingerprint).decode(), self.keyserver.decode()))
-            e.fetch_public_key(self.gpg)
-        except InvalidFingerprint:
-            self.alert_error.emit('Invalid signing key fingerprint.', '')
-        except InvalidKeyserver:
-            self.alert_error.emit('Invalid keyserver.', '')
-        except KeyserverError:
-            self.alert_error.emit('Error with keyserver {}.'.format(self.keyserver.decode()), '')
-        except NotFoundOnKeyserver:
-            self.alert_error.emit('Signing key is not found on keyserver. Upload signing key and try again.', '')
-        except NotFoundInKeyring:
-            self.alert_error.emit('Signing key is not found in keyring. Something went wrong.', '')
-        except RevokedKey:
-            self.alert_error.emit('The signing key is revoked.', '')
-        except ExpiredKey:
-            self.alert_error.emit('The signing key is expired.', '')
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure()
-
-        # Make sure URL is in the right format
-        success = False
-        o = urlparse(self.url)
-        if (o.scheme != b'http' and o.scheme != b'https') or o.netloc == '':
-            self.alert_error.emit('URL is invalid.', '')
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure()
-
-        # After downloading URL, test that it's signed by signing key
-        success = False
-        try:
-            self.log('Verifying signature')
-            e.verify_fingerprints_sig(self.gpg, msg_sig_bytes, msg_bytes)
-        except VerificationError:
-            self.alert_error.emit('Signature does not verify.', '')
-        except BadSignature:
-            self.alert_error.emit('Bad signature.', '')
-        except RevokedKey:
-            self.alert_error.emit('The signing key is revoked.', '')
-        except SignedWithWrongKey:
-            self.alert_error.emit('Valid signature, but signed with wrong signing key.', '')
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure()
-
-        # Test that it's a list of fingerprints
-        success = False
-        try:
-            self.log('Validating fingerprint list')
-            e.get_fingerprint_list(msg_bytes)
-        except InvalidFingerprints as e:
-            self.alert_error.emit('Invalid fingerprints', str(e), '')
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure()
-
-        self.log('Endpoint saved', 4000)
-        self.success.emit(self.fingerprint, self.url, self.keyserver, self.use_proxy, self.proxy_host, self.proxy_port)
-        self.finished.emit()
-
-class Refresher(QtCore.QThread):
-    success = QtCore.pyqtSignal(Endpoint, list, list)
-    error = QtCore.pyqtSignal(Endpoint, str, bool)
-
-    def __init__(self, debug, gpg, refresh_interval, q, endpoint, force=False):
-        super(Refresher, self).__init__()
-        self.debug = debug
-        self.gpg = gpg
-        # this should be safe to cast directly to a float since it passed the input test
-        self.refresh_interval = float(refresh_interval)
-        self.q = q
-        self.e = endpoint
-        self.force = force
-
-    def finish_with_failure(self, err, reset_last_checked=True):
-        self.q.add_message(type='clear')
-        self.error.emit(self.e, err, reset_last_checked)
-
-    def log(self, message, timeout=None):
-        if self.debug:
-            print("[Refresher] {}".format(message))
-
-        if timeout:
-            self.q.add_message(message, timeout=timeout)
-        else:
-            self.q.add_message(message)
-
-    def run(self):
-        print("Refreshing endpoint with authority key {}".format(self.e.fingerprint.decode()))
-
-        # Refresh if it's forced, if it's never been checked before,
-        # or if it's been longer than the configured refresh interval
-        update_interval = 60*60*(self.refresh_interval)
-        run_refresher = False
-
-        # If there is no connection - skip
-        if not common.internet_available():
-            return
-
-        if self.force:
-            print('Forcing sync')
-            run_refresher = True
-        elif not self.e.last_checked:
-            print('Never been checked before')
-            run_refresher = True
-        elif (datetime.datetime.now() - self.e.last_checked).total_seconds() >= update_interval:
-            print('It has been {} hours since the last sync.'.format(self.refresh_interval))
-            run_refresher = True
-
-        if not run_refresher:
-            return
-
-        # Fetch signing key from keyserver, make sure it's not expired or revoked
-        success = False
-        reset_last_checked = True
-        try:
-            self.log('Fetching public key {} {}'.format(common.fp_to_keyid(self.e.fingerprint).decode(), self.gpg.get_uid(self.e.fingerprint)))
-            self.e.fetch_public_key(self.gpg)
-        except InvalidFingerprint:
-            err = 'Invalid signing key fingerprint'
-        except InvalidKeyserver:
-            err = 'Invalid keyserver'
-        except NotFoundOnKeyserver:
-            err = 'Signing key is not found on keyserver'
-        except NotFoundInKeyring:
-            err = 'Signing key is not found in keyring'
-        except RevokedKey:
-            err = 'The signing key is revoked'
-        except ExpiredKey:
-            err = 'The signing key is expired'
-        except KeyserverError:
-            err = 'Error connecting to keyserver'
-            reset_last_checked = False
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure(err, reset_last_checked)
-
-        # Download URL
-        success = False
-        try:
-            self.log('Downloading URL {}'.format(self.e.url.decode()))
-            msg_bytes = self.e.fetch_msg_url()
-        except URLDownloadError as e:
-            err = 'Failed to download: Check your internet connection'
-        except ProxyURLDownloadError as e:
-            err = 'Failed to download: Check your internet connection and proxy configuration'
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure(err)
-
-        # Download signature URL
-        success = False
-        try:
-            self.log('Downloading URL {}'.format(self.e.sig_url.decode()))
-            msg_sig_bytes = self.e.fetch_msg_sig_url()
-        except URLDownloadError as e:
-            err = 'Failed to download: Check your internet connection'
-        except ProxyURLDownloadError as e:
-            err = 'Failed to download: Check your internet connection and proxy configuration'
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure(err)
-
-        # Verifiy signature
-        success = False
-        try:
-            self.log('Verifying signature')
-            self.e.verify_fingerprints_sig(self.gpg, msg_sig_bytes, msg_bytes)
-        except VerificationError:
-            err = 'Signature does not verify'
-        except BadSignature:
-            err = 'Bad signature'
-        except RevokedKey:
-            err = 'The signing key is revoked'
-        except SignedWithWrongKey:
-            err = 'Valid signature, but signed with wrong signing key'
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure(err)
-
-        # Get fingerprint list
-        success = False
-        try:
-            self.log('Validating fingerprints')
-            fingerprints = self.e.get_fingerprint_list(msg_bytes)
-        except InvalidFingerprints as e:
-            err = 'Invalid fingerprints: {}'.format(e)
-        else:
-            success = True
-
-        if not success:
-            return self.finish_with_failure(err)
-
-        # Build list of fingerprints to fetch
-        fingerprints_to_fetch = []
-        invalid_fingerprints = []
-        for fingerprint in fingerprints:
-            try:
-                self.gpg.test_key(fingerprint)
-            except InvalidFingerprint:
-                invalid_fingerprints.append(fingerprint)
-            except (NotFoundInKeyring, ExpiredKey):
-                # Fetch these ones
-                fingerprints_to_fetch.append(fingerprint)
-            except RevokedKey:
-                # Skip revoked keys
-                pass
-            else:
-                # Fetch all others
-                fingerprints_to_fetch.append(fingerprint)
-
-        # Fetch fingerprints
-        notfound_fingerprints = []
-        for fingerprint in fingerprints_to_fetch:
-            try:
-                self.log('Fetching public key {} {}'.format(common.fp_to_keyid(fingerprint).decode(), self.gpg.get_uid(fingerprint)))
-                self.gpg.recv_key(self.e.keyserver, fingerprint, self.e.use_proxy, self.e.proxy_host, self.e.proxy_port)
-            except InvalidKeyserver:
-                return self.finish_with_failure('Invalid keyserver')
-            except KeyserverError:
-                return self.finish_with_failure('Keyserver error')
-            except NotFoundOnKeyserver:
-                notfound_fingerprints.append(fingerprint)
-
-        # All done
-        self.success.emit(self.e, invalid_fingerprints, notfound_fingerprints)
@@ -18,171 +18,252 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import re, time, datetime
+import datetime
 from PyQt5 import QtCore, QtWidgets, QtGui
 
 from . import common
 
-class EndpointWidget(QtWidgets.QWidget):
-    def __init__(self, item, endpoint, gpg):
-        super(EndpointWidget, self).__init__()
-        self.item = item
-        self.e = endpoint
+def get_last_checked_text(e):
+    # This only changes once a minute, so it doesn't count seconds
+    if e.last_checked:
+        if e.error:
+            diff = datetime.datetime.now() - e.last_failed
+        else:
+            diff = datetime.datetime.now() - e.last_synced
+        s = int(diff.total_seconds())
+        hours = s // 3600
+        s = s - (hours * 3600)
+        minutes = s // 60
+
+        if hours > 0:
+            last_checked = '{} hours ago'.format(hours)
+        elif minutes > 0:
+            last_checked = '{} minutes ago'.format(minutes)
+        else:
+            last_checked = 'less than a minute ago'
+    else:
+        last_checked = 'never'
+
+    if e.error:
+        return 'Last attempted: {}'.format(last_checked)
+    else:
+        return 'Last synced: {}'.format(last_checked)
+
+"""
+The endpoints, as a list model. The uids of their signing keys are looked up
+all at once when the endpoints are loaded, and then only again for an endpoint
+whose signing key changes, so painting a row never runs gpg.
+"""
+class EndpointListModel(QtCore.QAbstractListModel):
+    endpoint_role = QtCore.Qt.UserRole
+    uid_role = QtCore.Qt.UserRole + 1
+
+    # Signing keys get fetched in the sync engine's threads
+    fetched_public_key_signal = QtCore.pyqtSignal(object)
+
+    def __init__(self, gpg):
+        super(EndpointListModel, self).__init__()
         self.gpg = gpg
+        self.endpoints = []
+        self.uids = {}
+
+        self.fetched_public_key_signal.connect(self.refresh_uid)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.endpoints)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.endpoints):
+            return None
+
+        e = self.endpoints[index.row()]
+        if role == self.endpoint_role:
+            return e
+        elif role == self.uid_role or role == QtCore.Qt.DisplayRole:
+            return self.get_uid(e)
+        elif role == QtCore.Qt.ToolTipRole:
+            # Warnings and errors might be too long to fit
+            tooltip = []
+            if e.warning:
+                tooltip.append('Warning: {}'.format(e.warning))
+            if e.error:
+                tooltip.append('Error: {}'.format(e.error))
+            if len(tooltip) > 0:
+                return '\n'.join(tooltip)
+        return None
+
+    def get_index(self, e):
+        for row in range(len(self.endpoints)):
+            if self.endpoints[row] is e:
+                return self.index(row)
+        return QtCore.QModelIndex()
+
+    def get_uid(self, e):
+        if not common.valid_fp(e.fingerprint):
+            return ''
+        return self.uids.get(common.clean_fp(e.fingerprint), '')
+
+    def set_uids(self, uids):
+        self.uids.update(uids)
+
+    def prefetch_uids(self, endpoints):
+        # Only look up the uids that aren't known yet
+        fps = [e.fingerprint for e in endpoints if common.valid_fp(e.fingerprint) and common.clean_fp(e.fingerprint) not in self.uids]
+        if len(fps) > 0:
+            self.uids.update(self.gpg.get_uids(fps))
+
+    def watch_endpoint(self, e):
+        # Whenever the endpoint finishes fetching the signing key from the
+        # keyserver, refresh its uid
+        e.fetched_public_key_callback = lambda: self.fetched_public_key_signal.emit(e)
+
+    def load_endpoints(self, endpoints, uids={}):
+        # uids that are already known, by fingerprint, don't get looked up
+        self.beginResetModel()
+        self.set_uids(uids)
+        self.endpoints = list(endpoints)
+        for e in self.endpoints:
+            self.watch_endpoint(e)
+        self.prefetch_uids(self.endpoints)
+        self.endResetModel()
 
-        self.uid = ""
-
-        # If the endpoint isn't configured yet
-        self.not_configured_label = QtWidgets.QLabel('Not configured')
-        self.not_configured_label.setStyleSheet("QLabel { color: #CC0000; }")
-
-        # User id and keyid of signing key
-        self.uid_label = QtWidgets.QLabel()
-        self.uid_label.setStyleSheet("QLabel { font-weight: bold; }")
-        self.keyid_label = QtWidgets.QLabel()
-        self.keyid_label.setStyleSheet("QLabel { font-style: italic; color: #333333; }")
-
-        # Last updated
-        self.last_checked_label = QtWidgets.QLabel()
-        self.last_checked_label.setStyleSheet("QLabel { color: #333333; }")
-
-        # Warning and error
-        self.warning_label = QtWidgets.QLabel()
-        self.warning_label.setStyleSheet("QLabel { color: #C36900; }")
-        self.error_label = QtWidgets.QLabel()
-        self.error_label.setStyleSheet("QLabel { color: #CC0000; }")
-
-        # Widget layout
-        layout = QtWidgets.QVBoxLayout()
-        layout.addWidget(self.not_configured_label)
-        layout.addWidget(self.uid_label)
-        layout.addWidget(self.keyid_label)
-        layout.addWidget(self.last_checked_label)
-        layout.addWidget(self.warning_label)
-        layout.addWidget(self.error_label)
-        self.setLayout(layout)
-
-        if common.valid_fp(self.e.fingerprint):
-            self.refresh_signing_key_label()
-        self.update()
-
-    def refresh_signing_key_label(self):
-        # User id and keyid of signing key
-        uid = self.gpg.get_uid(self.e.fingerprint)
-        self.uid_label.setText(uid)
-        keyid = common.fp_to_keyid(self.e.fingerprint).decode()
-        self.keyid_label.setText(keyid)
-
-    def update(self):
-        # If the endpoint isn't configured yet
-        if not common.valid_fp(self.e.fingerprint):
-            self.not_configured_label.show()
-            self.uid_label.hide()
-            self.keyid_label.hide()
-            self.last_checked_label.hide()
-            self.warning_label.hide()
-            self.error_label.hide()
-            self.item.setSizeHint(QtCore.QSize(0, 80))
-            return
-
-        # The endpoint is configured
-        self.not_configured_label.hide()
-        self.uid_label.show()
-        self.keyid_label.show()
-        self.last_checked_label.show()
-
-        # Last updated
-        if self.e.last_checked:
-            if self.e.error:
-                diff = datetime.datetime.now() - self.e.last_failed
-            else:
-                diff = datetime.datetime.now() - self.e.last_synced
-            s = diff.seconds
-            hours = s // 3600
-            s = s - (hours * 3600)
-            minutes = s // 60
-            seconds = s - (minutes * 60)
-
-            if hours > 0:
-                last_checked = '{} hours ago'.format(hours)
-            elif minutes > 0:
-                last_checked = '{} minutes ago'.format(minutes)
-            else:
-                last_checked = '{} seconds ago'.format(seconds)
-        else:
-            last_checked = 'never'
+    def add_endpoint(self, e):
+        self.watch_endpoint(e)
+        self.prefetch_uids([e])
+        row = len(self.endpoints)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self.endpoints.append(e)
+        self.endInsertRows()
 
-        if self.e.error:
-            self.last_checked_label.setText('Last attempted: {}'.format(last_checked))
-        else:
-            self.last_checked_label.setText('Last synced: {}'.format(last_checked))
+    def delete_endpoint(self, e):
+        index = self.get_index(e)
+        if index.isValid():
+            self.beginRemoveRows(QtCore.QModelIndex(), index.row(), index.row())
+            del self.endpoints[index.row()]
+            self.endRemoveRows()
 
-        # Warning and error
-        if self.e.warning:
-            self.warning_label.setText('Warning: {}'.format(self.e.warning))
-            self.warning_label.show()
-        else:
-            self.warning_label.hide()
-        if self.e.error:
-            self.error_label.setText('Error: {}'.format(self.e.error))
-            self.error_label.show()
-        else:
-            self.error_label.hide()
+    def reload_endpoint(self, e):
+        # Its signing key might have been edited
+        self.prefetch_uids([e])
+        index = self.get_index(e)
+        if index.isValid():
+            self.dataChanged.emit(index, index)
+
+    def refresh_uid(self, e):
+        if common.valid_fp(e.fingerprint):
+            self.uids.update(self.gpg.get_uids([e.fingerprint]))
+        self.reload_endpoint(e)
 
-        # Size
-        if self.e.warning and self.e.error:
-            self.item.setSizeHint(QtCore.QSize(0, 120))
-        elif self.e.warning and not self.e.error or self.e.error and not self.e.warning:
-            self.item.setSizeHint(QtCore.QSize(0, 100))
+"""
+Paints each endpoint's row on demand: the uid and keyid of its signing key,
+when it was last synced, and any warning or error.
+"""
+class EndpointDelegate(QtWidgets.QStyledItemDelegate):
+    margin = 11
+    spacing = 4
+
+    def get_lines(self, e, uid):
+        # Returns a (text, color, bold, italic) for each line of the row
+        if not common.valid_fp(e.fingerprint):
+            return [('Not configured', '#CC0000', False, False)]
+
+        lines = [
+            (uid, '#000000', True, False),
+            (common.fp_to_keyid(e.fingerprint).decode(), '#333333', False, True),
+            (get_last_checked_text(e), '#333333', False, False)
+        ]
+        if e.warning:
+            lines.append(('Warning: {}'.format(e.warning), '#C36900', False, False))
+        if e.error:
+            lines.append(('Error: {}'.format(e.error), '#CC0000', False, False))
+        return lines
+
+    def get_font(self, option, bold, italic):
+        font = QtGui.QFont(option.font)
+        font.setBold(bold)
+        font.setItalic(italic)
+        return font
+
+    def paint(self, painter, option, index):
+        e = index.data(EndpointListModel.endpoint_role)
+        uid = index.data(EndpointListModel.uid_role)
+
+        painter.save()
+        if option.state & QtWidgets.QStyle.State_Selected:
+            painter.fillRect(option.rect, QtGui.QColor(153, 204, 255))
         else:
-            self.item.setSizeHint(QtCore.QSize(0, 80))
+            painter.fillRect(option.rect, QtGui.QColor(255, 255, 255))
+
+        x = option.rect.left() + self.margin
+        y = option.rect.top() + self.margin
+        width = option.rect.width() - 2*self.margin
+        for text, color, bold, italic in self.get_lines(e, uid):
+            font = self.get_font(option, bold, italic)
+            metrics = QtGui.QFontMetrics(font)
+            painter.setFont(font)
+            painter.setPen(QtGui.QColor(color))
+            painter.drawText(QtCore.QRect(x, y, width, metrics.height()),
+                QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter,
+                metrics.elidedText(text, QtCore.Qt.ElideRight, width))
+            y += metrics.height() + self.spacing
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        e = index.data(EndpointListModel.endpoint_role)
+        lines = self.get_lines(e, '')
+        height = 2*self.margin + self.spacing*(len(lines) - 1)
+        for text, color, bold, italic in lines:
+            height += QtGui.QFontMetrics(self.get_font(option, bold, italic)).height()
+        return QtCore.QSize(0, height)
+
+class EndpointList(QtWidgets.QListView):
+    endpoint_clicked = QtCore.pyqtSignal(object)
 
-class EndpointList(QtWidgets.QListWidget):
     def __init__(self, gpg):
         super(EndpointList, self).__init__()
         self.gpg = gpg
-        self.setStyleSheet("""
-            QListWidget::item { background: rgb(255, 255, 255);  }
-            QListWidget::item:selected { background: rgb(153, 204, 255); }
-        """)
-
-    def iter_all_items(self):
-        for i in range(self.count()):
-            yield self.item(i)
+        self.endpoint_model = EndpointListModel(gpg)
+        self.setModel(self.endpoint_model)
+        self.setItemDelegate(EndpointDelegate(self))
+        self.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self.clicked.connect(self.index_clicked)
+
+    def index_clicked(self, index):
+        self.endpoint_clicked.emit(index.data(EndpointListModel.endpoint_role))
+
+    def select_endpoint(self, e):
+        # Select an endpoint, or select nothing if e is None
+        if e is None:
+            self.clearSelection()
+            self.setCurrentIndex(QtCore.QModelIndex())
+        else:
+            self.setCurrentIndex(self.endpoint_model.get_index(e))
 
     def add_endpoint(self, e):
-        item = QtWidgets.QListWidgetItem()
-        item.endpoint = e
-        widget = EndpointWidget(item, e, self.gpg)
-
-        # Whenever the endpoint finishes fetching the signing key from the keyserver,
-        # refresh the signing key label
-        e.fetched_public_key_signal.connect(widget.refresh_signing_key_label)
-
-        self.addItem(item)
-        self.setItemWidget(item, widget)
+        self.endpoint_model.add_endpoint(e)
 
-    def load_endpoints(self, endpoints):
-        self.clear()
-        for e in endpoints:
-            self.add_endpoint(e)
+    def load_endpoints(self, endpoints, uids={}):
+        self.endpoint_model.load_endpoints(endpoints, uids)
 
     def reload_endpoint(self, endpoint):
-        for item in self.iter_all_items():
-            if item.endpoint == endpoint:
-                self.itemWidget(item).update()
+        # Warnings and errors change the row's height
+        self.endpoint_model.reload_endpoint(endpoint)
+        index = self.endpoint_model.get_index(endpoint)
+        if index.isValid():
+            self.itemDelegate().sizeHintChanged.emit(index)
 
-    def reload_endpoints(self):
-        for item in self.iter_all_items():
-            self.itemWidget(item).update()
+    def refresh_last_checked_labels(self):
+        # Only the visible rows get painted again
+        self.viewport().update()
 
     def delete_endpoint(self, endpoint):
-        self.gpg.delete_pubkey_from_disk(endpoint.fingerprint)
-        for item in self.iter_all_items():
-            if item:
-                if item.endpoint == endpoint:
-                    self.removeItemWidget(item)
-                    self.takeItem(self.row(item))
+        # Keep the signing key if another endpoint is signed by it too
+        self.endpoint_model.delete_endpoint(endpoint)
+        fp = common.clean_fp(endpoint.fingerprint)
+        if fp not in [common.clean_fp(e.fingerprint) for e in self.endpoint_model.endpoints]:
+            self.gpg.delete_pubkey_from_disk(endpoint.fingerprint)
 
 class EndpointSelection(QtWidgets.QVBoxLayout):
     add_endpoint_signal = QtCore.pyqtSignal()
@@ -205,14 +286,14 @@ class EndpointSelection(QtWidgets.QVBoxLayout):
     def add_endpoint(self, e):
         self.endpoint_list.add_endpoint(e)
 
-    def load_endpoints(self, e):
-        self.endpoint_list.load_endpoints(e)
+    def load_endpoints(self, e, uids={}):
+        self.endpoint_list.load_endpoints(e, uids)
 
     def reload_endpoint(self, e):
         self.endpoint_list.reload_endpoint(e)
 
-    def reload_endpoints(self):
-        self.endpoint_list.reload_endpoints()
+    def refresh_last_checked_labels(self):
+        self.endpoint_list.refresh_last_checked_labels()
 
     def delete_endpoint(self, e):
         self.endpoint_list.delete_endpoint(e)
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+GPG Sync
+Helps users have up-to-date public keys for everyone in their organization
+https://github.com/firstlookmedia/gpgsync
+Copyright (C) 2016 First Look Media
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import datetime, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import common
+from .gnupg import *
+from .endpoint import URLDownloadError, ProxyURLDownloadError, InvalidFingerprints
+from .sync_plan import SyncPlan
+
+class NoInternetConnection(Exception):
+    pass
+
+"""
+Syncs every endpoint, without any Qt, so it runs the same under the GUI as it
+does on its own with `gpgsync --headless` or `gpgsync sync`. First each
+endpoint's signing key is fetched and its fingerprint list is downloaded and
+verified, a few endpoints at a time. Then the keys of all of them are fetched
+at once, and each endpoint's status is updated and saved.
+
+The callbacks get called from the syncing threads:
+  message_callback(msg, timeout) shows a status message, or clears it if msg is None
+  progress_callback(msg) describes what the sync is doing right now
+  endpoint_updated_callback(e) is called when an endpoint's status changes
+"""
+class SyncEngine(object):
+    def __init__(self, settings, gpg, sync_state, debug=False):
+        self.settings = settings
+        self.gpg = gpg
+        self.sync_state = sync_state
+        self.debug = debug
+        self.sync_lock = threading.Lock()
+        self.errors = []
+
+        self.message_callback = None
+        self.progress_callback = None
+        self.endpoint_updated_callback = None
+
+    def log(self, message, timeout=0):
+        if self.debug:
+            print("[SyncEngine] {}".format(message))
+
+        if self.message_callback:
+            self.message_callback(message, timeout)
+
+    def clear_message(self):
+        if self.message_callback:
+            self.message_callback(None, 0)
+
+    def progress(self, message):
+        print(message)
+        if self.progress_callback:
+            self.progress_callback(message)
+
+    def endpoint_updated(self, e):
+        if self.endpoint_updated_callback:
+            self.endpoint_updated_callback(e)
+
+    def import_signing_keys(self):
+        # Import every endpoint's signing key at once, even into a persistent
+        # homedir that most likely has them already, since that's cheaper than
+        # checking. Returns the uids of the signing keys.
+        started = time.perf_counter()
+        uids = self.gpg.import_pubkeys_from_disk([e.fingerprint for e in self.settings.endpoints if e.verified])
+        if self.debug:
+            print("[SyncEngine] import_signing_keys: imported {} signing keys in {:.1f} ms".format(len(uids), (time.perf_counter() - started) * 1000))
+        return uids
+
+    def sync(self, force=False):
+        # Returns the endpoints that failed to sync, or None if another sync
+        # is already running. Raises NoInternetConnection if there's no
+        # connection, and nothing was synced.
+        if not self.sync_lock.acquire(blocking=False):
+            return None
+
+        try:
+            self.errors = []
+            sync_started = datetime.datetime.now()
+
+            endpoints = [e for e in self.settings.endpoints if e.verified]
+            if len(endpoints) == 0:
+                return self.errors
+
+            # If there is no connection - skip
+            if not common.internet_available():
+                raise NoInternetConnection()
+
+            # Prepare a few endpoints at a time, which all add their keys to one plan
+            plan = SyncPlan(60*60*float(self.settings.update_interval_hours), self.settings.keyserver_batch_size)
+            with ThreadPoolExecutor(max_workers=max(1, int(self.settings.max_concurrent_syncs))) as executor:
+                list(executor.map(lambda e: self.prepare_endpoint(e, plan, force), endpoints))
+
+            # Every endpoint's list is ready, so fetch all of their keys at once
+            if len(plan.get_endpoints()) > 0:
+                self.progress("Syncing: fetching public keys")
+                plan.execute(self.gpg, self.sync_state, self.log)
+
+                # Let each endpoint know how its keys did
+                for e in plan.get_endpoints():
+                    invalid_fingerprints, notfound_fingerprints, removed_fingerprints, err = plan.get_result(e)
+                    list_checked = plan.is_list_checked(e)
+                    if err:
+                        self.endpoint_failed(e, err, list_checked)
+                    elif list_checked:
+                        self.endpoint_succeeded(e, invalid_fingerprints, notfound_fingerprints, removed_fingerprints)
+                    else:
+                        self.endpoint_keys_refreshed(e, notfound_fingerprints)
+
+            self.log('Syncing complete.', 4000)
+            if self.debug:
+                print("[SyncEngine] sync: {} keys changed".format(len(self.sync_state.get_changed_keys(sync_started))))
+                print("[SyncEngine] sync: HTTP session stats: {}".format(common.session_manager.get_stats()))
+            return self.errors
+        finally:
+            self.sync_lock.release()
+
+    def prepare_endpoint(self, e, plan, force=False):
+        self.progress("Syncing: {} {}".format(self.gpg.get_uid(e.fingerprint), common.fp_to_keyid(e.fingerprint).decode()))
+        print("Refreshing endpoint with authority key {}".format(e.fingerprint.decode()))
+
+        # Check the fingerprint list if it's forced, if it's never been checked
+        # before, or if it's been longer than the configured refresh interval.
+        # Otherwise just refresh the keys that are due.
+        refresh_interval = float(self.settings.update_interval_hours)
+        update_interval = 60*60*(refresh_interval)
+        check_list = False
+
+        if force:
+            print('Forcing sync')
+            check_list = True
+        elif not e.last_checked:
+            print('Never been checked before')
+            check_list = True
+        elif (datetime.datetime.now() - e.last_checked).total_seconds() >= update_interval:
+            print('It has been {} hours since the last sync.'.format(refresh_interval))
+            check_list = True
+
+        if check_list:
+            result = self.check_fingerprint_list(e)
+            if result is None:
+                return
+            fingerprints, previous_fingerprints = result
+        else:
+            # Between list checks, only refresh the keys on the last verified
+            # list whose turn it is
+            endpoint_state = self.sync_state.get_endpoint(e)
+            if 'fingerprints' not in endpoint_state:
+                return
+            fingerprints = [common.clean_fp(fp.encode()) for fp in endpoint_state['fingerprints']]
+            previous_fingerprints = fingerprints
+
+        # Compare the list with the last verified one. New keys get fetched right
+        # away, but keys that were already on the list only when they're due,
+        # unless the sync is forced.
+        if previous_fingerprints is None:
+            previous_fingerprints = []
+        fingerprints_set = set(fingerprints)
+        previous_fingerprints_set = set(previous_fingerprints)
+        added_fingerprints = [fp for fp in fingerprints if fp not in previous_fingerprints_set]
+        removed_fingerprints = [fp for fp in previous_fingerprints if fp not in fingerprints_set]
+        unchanged_fingerprints = [fp for fp in fingerprints if fp in previous_fingerprints_set]
+        if force:
+            due_fingerprints = unchanged_fingerprints
+        else:
+            due_fingerprints = self.sync_state.get_due_keys(unchanged_fingerprints, update_interval)
+        if check_list:
+            self.log('{} added, {} removed, {} unchanged ({} due)'.format(len(added_fingerprints), len(removed_fingerprints), len(unchanged_fingerprints), len(due_fingerprints)))
+
+        fingerprints_to_fetch, priority_fingerprints, invalid_fingerprints = self.sort_fingerprints(added_fingerprints + due_fingerprints)
+
+        # Nothing is due yet
+        if not check_list and len(fingerprints_to_fetch) == 0:
+            return
+
+        # Keys that weren't found last time aren't tried again until they're
+        # due, but they still get reported
+        fingerprints_to_fetch_set = set(fingerprints_to_fetch)
+        notfound_fingerprints = [fp for fp in self.sync_state.get_not_found_keys(fingerprints) if fp not in fingerprints_to_fetch_set]
+
+        # The keys get fetched later on, along with the keys of every other endpoint
+        plan.add_endpoint(e, fingerprints_to_fetch, invalid_fingerprints, removed_fingerprints, check_list, priority_fingerprints, notfound_fingerprints)
+
+    def sort_fingerprints(self, fingerprints):
+        # Build list of fingerprints to fetch. Keys that expired recently, and
+        # keys that are about to expire, have priority. Keys that expired long
+        # ago stay on the normal interval. Returns (fingerprints_to_fetch,
+        # priority_fingerprints, invalid_fingerprints).
+        fingerprints_to_fetch = []
+        priority_fingerprints = []
+        invalid_fingerprints = []
+        for fingerprint in fingerprints:
+            try:
+                self.gpg.test_key(fingerprint)
+            except InvalidFingerprint:
+                invalid_fingerprints.append(fingerprint)
+            except ExpiredKey:
+                # Fetch these ones first, if they expired recently
+                if self.sync_state.key_expires_soon(fingerprint, self.gpg.get_expiry(fingerprint)):
+                    priority_fingerprints.append(fingerprint)
+                else:
+                    fingerprints_to_fetch.append(fingerprint)
+            except NotFoundInKeyring:
+                # Fetch these ones
+                fingerprints_to_fetch.append(fingerprint)
+            except RevokedKey:
+                # Skip revoked keys
+                pass
+            else:
+                # Fetch all others
+                if self.sync_state.key_expires_soon(fingerprint):
+                    priority_fingerprints.append(fingerprint)
+                else:
+                    fingerprints_to_fetch.append(fingerprint)
+        return priority_fingerprints + fingerprints_to_fetch, priority_fingerprints, invalid_fingerprints
+
+    def check_fingerprint_list(self, e):
+        # Fetch the signing key, and download and verify the fingerprint list.
+        # Returns (fingerprints, previous_fingerprints), or None on failure.
+        # Fetch signing key from keyserver, make sure it's not expired or revoked
+        success = False
+        reset_last_checked = True
+        try:
+            self.log('Fetching public key {} {}'.format(common.fp_to_keyid(e.fingerprint).decode(), self.gpg.get_uid(e.fingerprint)))
+            e.fetch_public_key(self.gpg)
+        except InvalidFingerprint:
+            err = 'Invalid signing key fingerprint'
+        except InvalidKeyserver:
+            err = 'Invalid keyserver'
+        except NotFoundOnKeyserver:
+            err = 'Signing key is not found on keyserver'
+        except NotFoundInKeyring:
+            err = 'Signing key is not found in keyring'
+        except RevokedKey:
+            err = 'The signing key is revoked'
+        except ExpiredKey:
+            err = 'The signing key is expired'
+        except KeyserverError:
+            err = 'Error connecting to keyserver'
+            reset_last_checked = False
+        else:
+            success = True
+
+        if not success:
+            return self.endpoint_failed(e, err, reset_last_checked)
+
+        # Download URL and signature URL. If there's already a verified list,
+        # only ask the server for them if they changed.
+        endpoint_state = self.sync_state.get_endpoint(e)
+        if 'fingerprints' in endpoint_state:
+            url_validators = endpoint_state.get('url_validators')
+            sig_url_validators = endpoint_state.get('sig_url_validators')
+        else:
+            url_validators = None
+            sig_url_validators = None
+
+        success = False
+        try:
+            self.log('Downloading URL {}'.format(e.url.decode()))
+            msg_bytes, url_validators = e.fetch_url_conditional(e.url, url_validators)
+            self.log('Downloading URL {}'.format(e.sig_url.decode()))
+            msg_sig_bytes, sig_url_validators = e.fetch_url_conditional(e.sig_url, sig_url_validators)
+
+            # If only one of them changed, get a fresh copy of the other one too
+            if msg_bytes is None and msg_sig_bytes is not None:
+                msg_bytes, url_validators = e.fetch_url_conditional(e.url)
+            if msg_sig_bytes is None and msg_bytes is not None:
+                msg_sig_bytes, sig_url_validators = e.fetch_url_conditional(e.sig_url)
+        except URLDownloadError:
+            err = 'Failed to download: Check your internet connection'
+        except ProxyURLDownloadError:
+            err = 'Failed to download: Check your internet connection and proxy configuration'
+        else:
+            success = True
+
+        if not success:
+            return self.endpoint_failed(e, err)
+
+        # The last verified list, if there is one
+        if 'fingerprints' in endpoint_state:
+            previous_fingerprints = [common.clean_fp(fp.encode()) for fp in endpoint_state['fingerprints']]
+        else:
+            previous_fingerprints = None
+
+        if msg_bytes is None and msg_sig_bytes is None:
+            # Neither changed, so the last verified list is still good
+            self.log('Fingerprint list is not modified')
+            fingerprints = previous_fingerprints
+        else:
+            # Verifiy signature
+            success = False
+            try:
+                self.log('Verifying signature')
+                e.verify_fingerprints_sig(self.gpg, msg_sig_bytes, msg_bytes)
+            except VerificationError:
+                err = 'Signature does not verify'
+            except BadSignature:
+                err = 'Bad signature'
+            except RevokedKey:
+                err = 'The signing key is revoked'
+            except SignedWithWrongKey:
+                err = 'Valid signature, but signed with wrong signing key'
+            else:
+                success = True
+
+            if not success:
+                return self.endpoint_failed(e, err)
+
+            # Get fingerprint list
+            success = False
+            try:
+                self.log('Validating fingerprints')
+                fingerprints = [common.clean_fp(fp) for fp in e.get_fingerprint_list(msg_bytes)]
+            except InvalidFingerprints as ex:
+                err = 'Invalid fingerprints: {}'.format(ex)
+            else:
+                success = True
+
+            if not success:
+                return self.endpoint_failed(e, err)
+
+            # Remember the verified list, and how to ask whether it changed
+            self.sync_state.update_endpoint(e,
+                fingerprints=[fp.decode() for fp in fingerprints],
+                url_validators=url_validators,
+                sig_url_validators=sig_url_validators)
+
+        return fingerprints, previous_fingerprints
+
+    def endpoint_succeeded(self, e, invalid_fingerprints, notfound_fingerprints, removed_fingerprints):
+        if len(invalid_fingerprints) == 0 and len(notfound_fingerprints) == 0 and len(removed_fingerprints) == 0:
+            warning = False
+        else:
+            warnings = []
+            if len(invalid_fingerprints) > 0:
+                warnings.append('Invalid fingerprints {}'.format(invalid_fingerprints))
+            if len(notfound_fingerprints) > 0:
+                warnings.append('Not found fingerprints {}'.format(notfound_fingerprints))
+            if len(removed_fingerprints) > 0:
+                warnings.append('Removed fingerprints {}'.format(removed_fingerprints))
+            warning = ', '.join(warnings)
+
+        if self.settings.prune_removed_keys:
+            self.prune_keys(e, removed_fingerprints)
+
+        e.last_checked = datetime.datetime.now()
+        e.last_synced = datetime.datetime.now()
+        e.warning = warning
+        e.error = None
+
+        self.endpoint_updated(e)
+        self.settings.save_state()
+
+    def endpoint_keys_refreshed(self, e, notfound_fingerprints):
+        # Only some of the endpoint's keys were refreshed, its list wasn't checked
+        e.last_synced = datetime.datetime.now()
+
+        self.endpoint_updated(e)
+        self.settings.save_state()
+
+    def endpoint_failed(self, e, err, reset_last_checked=True):
+        self.clear_message()
+        self.errors.append(e)
+        if reset_last_checked:
+            e.last_checked = datetime.datetime.now()
+        e.last_failed = datetime.datetime.now()
+        e.warning = None
+        e.error = err
+
+        self.endpoint_updated(e)
+        self.settings.save_state()
+
+    def prune_keys(self, e, removed_fingerprints):
+        # Forget about keys that were removed from this endpoint's list, unless
+        # another endpoint still lists them. They're never deleted from the
+        # default homedir, only from the gpgsync homedir and the sync state.
+        listed_fingerprints = set()
+        for other_e in self.settings.endpoints:
+            if other_e is not e:
+                listed_fingerprints.update([common.clean_fp(fp.encode()) for fp in self.sync_state.get_endpoint(other_e).get('fingerprints', [])])
+
+        prune_fingerprints = [fp for fp in removed_fingerprints if fp not in listed_fingerprints]
+        if len(prune_fingerprints) == 0:
+            return
+
+        if self.debug:
+            print("[SyncEngine] prune_keys: pruning {} keys".format(len(prune_fingerprints)))
+        self.gpg.delete_keys(prune_fingerprints)
+        for fp in prune_fingerprints:
+            self.sync_state.forget_key(fp)
+        self.sync_state.save()
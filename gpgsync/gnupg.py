@@ -18,7 +18,7 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import re, subprocess, os, platform, tempfile, shutil
+import re, subprocess, os, platform, tempfile, shutil, threading, weakref, socket, hashlib, json, glob, base64
 from urllib.parse import urlparse
 from . import common
 
@@ -52,14 +52,359 @@ class BadSignature(Exception):
 class SignedWithWrongKey(Exception):
     pass
 
+class UnsupportedKeyVersion(Exception):
+    pass
+
+def split_keys(data):
+    # Split a binary export of many keys into a dict that maps each v4
+    # fingerprint to the packets of that key, without asking gpg. Raises
+    # UnsupportedKeyVersion if there's a key of any other version, since
+    # there's no telling where it ends.
+    keys = {}
+    fp = None
+    start = 0
+    i = 0
+    while i < len(data):
+        tag_byte = data[i]
+        if not tag_byte & 0x80:
+            break
+
+        if tag_byte & 0x40:
+            # New format packet header
+            tag = tag_byte & 0x3f
+            if data[i+1] < 192:
+                header_len, length = 2, data[i+1]
+            elif data[i+1] < 224:
+                header_len, length = 3, ((data[i+1] - 192) << 8) + data[i+2] + 192
+            elif data[i+1] == 255:
+                header_len, length = 6, int.from_bytes(data[i+2:i+6], 'big')
+            else:
+                # Partial body lengths aren't used for keys
+                break
+        else:
+            # Old format packet header
+            tag = (tag_byte >> 2) & 0x0f
+            length_type = tag_byte & 0x03
+            if length_type == 3:
+                header_len, length = 1, len(data) - i - 1
+            else:
+                header_len = 1 + (1 << length_type)
+                length = int.from_bytes(data[i+1:i+header_len], 'big')
+
+        # A public key packet starts a new key
+        if tag == 6:
+            if fp:
+                keys[fp] = data[start:i]
+            body = data[i+header_len:i+header_len+length]
+            if len(body) == 0 or body[0] != 4:
+                raise UnsupportedKeyVersion(body[0] if len(body) > 0 else None)
+            fp = hashlib.sha1(b'\x99' + len(body).to_bytes(2, 'big') + body).hexdigest().upper().encode()
+            start = i
+
+        i += header_len + length
+
+    if fp:
+        keys[fp] = data[start:i]
+    return keys
+
+def dearmor(data):
+    # Turn ASCII armored public keys into binary ones, without asking gpg.
+    # Binary data is returned as is. Raises ValueError if the armor is broken.
+    if len(data) == 0 or data[0] & 0x80:
+        return data
+
+    blocks = re.findall(b'-----BEGIN PGP PUBLIC KEY BLOCK-----(.*?)-----END PGP PUBLIC KEY BLOCK-----', data, re.S)
+    if len(blocks) == 0:
+        raise ValueError('No public key block')
+
+    keys = b''
+    for block in blocks:
+        # Skip the rest of the BEGIN line, the armor headers, which end with a
+        # blank line, and the checksum
+        lines = [line.strip() for line in block.split(b'\n')[1:]]
+        if b'' not in lines:
+            raise ValueError('No blank line after the armor headers')
+        lines = [line for line in lines[lines.index(b'')+1:] if line != b'']
+        if len(lines) > 0 and lines[-1].startswith(b'='):
+            lines = lines[:-1]
+        keys += base64.b64decode(b''.join(lines), validate=True)
+    return keys
+
+class IndexedKey(object):
+    def __init__(self, fp, validity, created, expires):
+        self.fp = fp
+        self.validity = validity
+        self.created = created
+        self.expires = expires
+        self.uids = []
+        self.subkeys = []
+        self.last_modified = created
+
+"""
+Everything gpgsync needs to know about the keys in a homedir, built from a
+single `gpg --with-colons --list-keys` run. It's rebuilt when the keyring file
+changes on disk, or when it gets invalidated.
+"""
+class KeyringIndex(object):
+    def __init__(self, gpg):
+        # A weak reference, so GnuPG.__del__ still cleans up the homedir
+        self.gpg = weakref.proxy(gpg)
+        self.keys = {}
+        self.keyring_stat = None
+        self.stale = True
+        self.lock = threading.Lock()
+
+    def get(self, fp):
+        return self.get_many([fp]).get(fp)
+
+    def get_many(self, fps):
+        # Look up several keys, checking whether the keyring changed just once
+        with self.lock:
+            keyring_stat = self._keyring_stat()
+            if self.stale or keyring_stat != self.keyring_stat:
+                self.keyring_stat = keyring_stat
+                self.stale = False
+                self._rebuild()
+            return {fp: self.keys[fp] for fp in fps if fp in self.keys}
+
+    def invalidate(self):
+        with self.lock:
+            self.stale = True
+
+    def _keyring_stat(self):
+        for filename in ['pubring.kbx', 'pubring.gpg']:
+            try:
+                st = os.stat(os.path.join(self.gpg.homedir, filename))
+                return (filename, st.st_mtime_ns, st.st_size)
+            except OSError:
+                pass
+        return None
+
+    def _rebuild(self):
+        out,err = self.gpg._gpg(['--with-colons', '--fixed-list-mode', '--list-keys'])
+        self.keys = self.parse(out)
+        self.gpg.log("KeyringIndex: indexed {} keys".format(len(self.keys)))
+
+    def parse(self, out):
+        keys = {}
+        key = None
+        subkey = None
+        for line in out.split(b'\n'):
+            chunks = line.split(b':')
+            if chunks[0] == b'pub':
+                key = IndexedKey(None, chunks[1], self._timestamp(chunks[5]), self._timestamp(chunks[6]))
+                subkey = None
+            elif key is None:
+                continue
+            elif chunks[0] == b'sub':
+                subkey = {
+                    'fp': None,
+                    'validity': chunks[1],
+                    'created': self._timestamp(chunks[5]),
+                    'expires': self._timestamp(chunks[6])
+                }
+                key.subkeys.append(subkey)
+                key.last_modified = max(key.last_modified or 0, subkey['created'] or 0)
+            elif chunks[0] == b'fpr':
+                if subkey is not None:
+                    subkey['fp'] = chunks[9]
+                elif key.fp is None:
+                    key.fp = chunks[9]
+                    keys[key.fp] = key
+            elif chunks[0] == b'uid':
+                key.uids.append(str(chunks[9], 'UTF-8'))
+                key.last_modified = max(key.last_modified or 0, self._timestamp(chunks[5]) or 0)
+        return keys
+
+    def _timestamp(self, field):
+        try:
+            return int(field)
+        except ValueError:
+            return None
+
+"""
+Every endpoint's signing key, kept together in appdata_path: the keys
+themselves in one binary keyring, signing_keys.gpg, which gpg can import in one
+go, and an index of where each key is in it in signing_keys.json, so looking
+keys up never needs gpg. Both files are written atomically, keyring first. If
+the index doesn't match the keyring, such as after a crash between the two
+writes, it's built again from the keyring.
+"""
+class SigningKeyStore(object):
+    def __init__(self, appdata_path, debug=False):
+        self.keyring_filename = os.path.join(appdata_path, 'signing_keys.gpg')
+        self.index_filename = os.path.join(appdata_path, 'signing_keys.json')
+        self.debug = debug
+        self.keys = None
+        self.lock = threading.Lock()
+
+    def log(self, msg):
+        if self.debug:
+            print("[SigningKeyStore] {}".format(msg))
+
+    def has(self, fp):
+        with self.lock:
+            return fp in self._load()
+
+    def get_many(self, fps):
+        # Returns the keys as they were exported, in the order of fps
+        with self.lock:
+            keys = self._load()
+            return {fp: keys[fp] for fp in fps if fp in keys}
+
+    def put_many(self, keys):
+        # Keys that are byte for byte the same as the stored ones don't cause
+        # a write. Returns the fingerprints that changed.
+        with self.lock:
+            stored = self._load()
+            changed = [fp for fp in keys if stored.get(fp) != keys[fp]]
+            if len(changed) > 0:
+                stored.update({fp: keys[fp] for fp in changed})
+                self._save()
+            return changed
+
+    def delete(self, fp):
+        with self.lock:
+            stored = self._load()
+            if fp in stored:
+                del stored[fp]
+                self._save()
+
+    def _load(self):
+        if self.keys is not None:
+            return self.keys
+
+        try:
+            with open(self.keyring_filename, 'rb') as f:
+                keyring = f.read()
+        except FileNotFoundError:
+            keyring = b''
+
+        try:
+            with open(self.index_filename, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+
+        if index is not None and index.get('digest') == hashlib.sha256(keyring).hexdigest():
+            self.keys = {}
+            for fp, (offset, length) in index['keys'].items():
+                self.keys[fp.encode()] = keyring[offset:offset+length]
+        else:
+            if keyring != b'':
+                self.log("_load: index doesn't match {}, rebuilding it".format(self.keyring_filename))
+            try:
+                self.keys = split_keys(keyring)
+            except UnsupportedKeyVersion as e:
+                # Start over. The signing keys get stored again as they're
+                # fetched.
+                self.log("_load: can't rebuild the index, unsupported key version {}".format(e))
+                self.keys = {}
+        return self.keys
+
+    def _save(self):
+        keyring = b''
+        index = {}
+        for fp in sorted(self.keys):
+            index[fp.decode()] = (len(keyring), len(self.keys[fp]))
+            keyring += self.keys[fp]
+
+        common.write_file_atomically(self.keyring_filename, keyring)
+        common.write_file_atomically(self.index_filename, json.dumps({
+            'digest': hashlib.sha256(keyring).hexdigest(),
+            'keys': index
+        }))
+
+"""
+A long-lived Assuan connection to the dirmngr of a homedir. Keys are fetched
+with KS_GET over this one connection, instead of through a gpg process per key.
+Errors from dirmngr are mapped onto the same exceptions that recv_key raises.
+"""
+class DirmngrConnection(object):
+    # gpg-error codes
+    GPG_ERR_GENERAL = 1
+    GPG_ERR_NOT_FOUND = 27
+    GPG_ERR_NO_DATA = 58
+    GPG_ERR_NO_KEYSERVER = 186
+
+    def __init__(self, socket_path, keyserver, timeout=120):
+        self.keyserver = keyserver
+
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(socket_path)
+        except OSError:
+            raise KeyserverError(keyserver)
+        self.f = self.sock.makefile('rb')
+
+        # Read the greeting, and point dirmngr at the keyserver
+        self._read_response()
+        self.transact(b'KEYSERVER --clear')
+        self.transact(b'KEYSERVER ' + keyserver.encode())
+
+    def ks_get(self, fp):
+        return self.transact(b'KS_GET -- 0x' + fp, fp)
+
+    def transact(self, command, fp=None):
+        try:
+            self.sock.sendall(command + b'\n')
+        except OSError:
+            raise KeyserverError(self.keyserver)
+        return self._read_response(fp)
+
+    def close(self):
+        try:
+            self.sock.sendall(b'BYE\n')
+        except OSError:
+            pass
+        self.f.close()
+        self.sock.close()
+
+    def _read_response(self, fp=None):
+        data = []
+        while True:
+            try:
+                line = self.f.readline()
+            except OSError:
+                raise KeyserverError(self.keyserver)
+            if not line:
+                raise KeyserverError(self.keyserver)
+
+            line = line.rstrip(b'\r\n')
+            if line.startswith(b'D '):
+                data.append(self._unescape(line[2:]))
+            elif line == b'OK' or line.startswith(b'OK '):
+                return b''.join(data)
+            elif line.startswith(b'ERR '):
+                self._raise_error(line, fp)
+            elif line.startswith(b'INQUIRE '):
+                # We don't have anything to give, so send an empty answer
+                self.sock.sendall(b'END\n')
+            # Ignore status (S) and comment (#) lines
+
+    def _raise_error(self, line, fp):
+        chunks = line.split(b' ', 2)
+        try:
+            code = int(chunks[1]) & 0xFFFF
+        except (IndexError, ValueError):
+            code = None
+
+        if code in [self.GPG_ERR_NO_KEYSERVER, self.GPG_ERR_GENERAL]:
+            raise InvalidKeyserver(self.keyserver)
+        if code in [self.GPG_ERR_NO_DATA, self.GPG_ERR_NOT_FOUND]:
+            raise NotFoundOnKeyserver(fp)
+        raise KeyserverError(self.keyserver)
+
+    def _unescape(self, data):
+        # Assuan percent-escapes %, CR and LF in data lines
+        return re.sub(b'%([0-9A-Fa-f]{2})', lambda m: bytes([int(m.group(1), 16)]), data)
+
 class GnuPG(object):
-    def __init__(self, appdata_path=None, debug=False):
+    def __init__(self, appdata_path=None, debug=False, persistent_homedir=False):
         self.appdata_path = appdata_path
         self.debug = debug
 
-        self.homedir = tempfile.mkdtemp()
-        self.log('[GnuPG] __init__: created homedir: {}'.format(self.homedir))
-
         self.system = platform.system()
         self.creationflags = 0
         if self.system == 'Darwin':
@@ -72,17 +417,101 @@ class GnuPG(object):
             self.creationflags = win32process.CREATE_NO_WINDOW
             self.gpg_path = shutil.which('gpg2')
 
-        # Remember uids that have already been queried
-        self.uids = dict()
+        # Use a persistent homedir in appdata_path if asked to, and if no other
+        # GPG Sync process has it locked. Otherwise use a temporary homedir.
+        self.persistent_homedir = False
+        self.homedir_lock = None
+        if persistent_homedir and self.appdata_path and self._lock_homedir():
+            self.persistent_homedir = True
+            self.homedir = os.path.join(self.appdata_path, 'homedir')
+            self._prepare_persistent_homedir()
+        else:
+            self.homedir = tempfile.mkdtemp()
+            self.log('[GnuPG] __init__: created homedir: {}'.format(self.homedir))
+
+        # Answer key queries from an index of the whole keyring
+        self.index = KeyringIndex(self)
+
+        # Endpoints' signing keys are kept in appdata_path
+        if self.appdata_path:
+            self.signing_keys = SigningKeyStore(self.appdata_path, self.debug)
+        else:
+            self.signing_keys = None
+
+        # Several endpoints can sync at once. Writing the keyserver config and
+        # anything that imports keys has to happen one thread at a time.
+        self.keyring_lock = threading.RLock()
 
     def log(self, msg):
         if self.debug:
             print("[GnuPG] {}".format(msg))
 
     def __del__(self):
-        # Delete the temporary homedir
-        shutil.rmtree(self.homedir, ignore_errors=True)
-        self.log('[GnuPG] __del__: deleted homedir: {}'.format(self.homedir))
+        if self.persistent_homedir:
+            # Keep the persistent homedir, but let other processes use it
+            self._unlock_homedir()
+            self.log('[GnuPG] __del__: unlocked homedir: {}'.format(self.homedir))
+        else:
+            # Delete the temporary homedir
+            shutil.rmtree(self.homedir, ignore_errors=True)
+            self.log('[GnuPG] __del__: deleted homedir: {}'.format(self.homedir))
+
+    def _lock_homedir(self):
+        lock_filename = os.path.join(self.appdata_path, 'homedir.lock')
+        try:
+            os.makedirs(self.appdata_path, exist_ok=True)
+            self.homedir_lock = open(lock_filename, 'w')
+            if self.system == 'Windows':
+                import msvcrt
+                msvcrt.locking(self.homedir_lock.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.homedir_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (OSError, IOError):
+            self.log('_lock_homedir: homedir is locked by another process, using a temporary homedir')
+            self._unlock_homedir()
+            return False
+
+        return True
+
+    def _unlock_homedir(self):
+        # Closing the lock file releases the lock
+        if self.homedir_lock:
+            self.homedir_lock.close()
+            self.homedir_lock = None
+
+    def _prepare_persistent_homedir(self):
+        if os.path.isdir(self.homedir):
+            if self._check_homedir_integrity():
+                self.log('_prepare_persistent_homedir: reusing homedir: {}'.format(self.homedir))
+                return
+
+            self.log('_prepare_persistent_homedir: homedir failed integrity check, starting over')
+            shutil.rmtree(self.homedir, ignore_errors=True)
+
+        os.makedirs(self.homedir)
+        self.log('_prepare_persistent_homedir: created homedir: {}'.format(self.homedir))
+
+        # gpg complains about homedirs that other users can read
+        if self.system != 'Windows':
+            os.chmod(self.homedir, 0o700)
+
+    def _check_homedir_integrity(self):
+        if not self.gpg_path:
+            return True
+
+        if self.system != 'Windows':
+            os.chmod(self.homedir, 0o700)
+
+        # Make sure gpg can read the whole keyring
+        p = subprocess.Popen([self.gpg_path, '--batch', '--no-tty', '--homedir', self.homedir, '--with-colons', '--list-keys'],
+            stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = p.communicate()
+        if p.returncode != 0 or b'keydb' in err or b'invalid keyring' in err:
+            self.log('_check_homedir_integrity: stderr: {}'.format(err))
+            return False
+
+        return True
 
     def is_gpg_available(self):
         if self.system == 'Windows':
@@ -101,7 +530,185 @@ class GnuPG(object):
 
         fp = common.clean_fp(fp)
         keyserver = common.clean_keyserver(keyserver).decode()
+        with self.keyring_lock:
+            self._write_keyserver_conf(keyserver)
+
+            args = ['--recv-keys', fp]
+            out,err = self._gpg(args)
+            self.index.invalidate()
+        self._check_recv_errors(keyserver, fp, out, err)
+
+        # Import key into default homedir
+        self.import_to_default_homedir([fp])
+
+    def recv_keys(self, keyserver, fps, use_proxy, proxy_host, proxy_port, dirmngr=None):
+        # Receive a batch of keys with a single `gpg --recv-keys` call, and return
+        # (fetched, notfound, failed) lists of cleaned fingerprints. If the
+        # keyserver errors on the batch it gets bisected, so one bad key can't
+        # sink the rest; it's just reported as failed. Only if the keyserver
+        # doesn't work at all, and no key could be fetched or found missing,
+        # does the error get raised.
+        # If there's a DirmngrConnection, keys are fetched over it instead.
+        # Keys are only received into the gpgsync homedir; it's up to the caller
+        # to commit them to the default homedir with import_to_default_homedir.
+        self.log("recv_keys: keyserver={}, {} fps, use_proxy={}, proxy_host={}, proxy_port={}".format(keyserver, len(fps), use_proxy, proxy_host, proxy_port))
+
+        for fp in fps:
+            if not common.valid_fp(fp):
+                raise InvalidFingerprint(fp)
+
+        fps = [common.clean_fp(fp) for fp in fps]
+        if dirmngr:
+            fetched, notfound, failed = self._recv_keys_dirmngr(dirmngr, fps)
+        else:
+            # gpg reads the keyserver from gpg.conf, so hold the keyring lock until
+            # the whole batch has been received
+            keyserver = common.clean_keyserver(keyserver).decode()
+            with self.keyring_lock:
+                self._write_keyserver_conf(keyserver)
+                fetched, notfound, failed = self._recv_keys_batch(keyserver, fps)
+
+        # In the order they were asked for
+        failed_fps = [fp for fp in fps if fp in failed]
+        if len(fetched) == 0 and len(notfound) == 0 and len(failed_fps) > 0:
+            raise failed[failed_fps[0]]
+        return fetched, notfound, failed_fps
+
+    def connect_dirmngr(self, keyserver):
+        # Open a connection to this homedir's dirmngr, launching it if needed.
+        # Returns None if that isn't possible, so callers can fall back to gpg.
+        self.log("connect_dirmngr: keyserver={}".format(keyserver))
+
+        if self.system == 'Windows' or not hasattr(socket, 'AF_UNIX'):
+            return None
 
+        keyserver = common.clean_keyserver(keyserver).decode()
+        with self.keyring_lock:
+            self._write_keyserver_conf(keyserver)
+
+        gpgconf_path = os.path.join(os.path.dirname(self.gpg_path), 'gpgconf')
+        if not os.path.isfile(gpgconf_path):
+            gpgconf_path = shutil.which('gpgconf')
+        if not gpgconf_path:
+            return None
+
+        try:
+            subprocess.call([gpgconf_path, '--homedir', self.homedir, '--launch', 'dirmngr'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            p = subprocess.Popen([gpgconf_path, '--homedir', self.homedir, '--list-dirs', 'dirmngr-socket'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (out, err) = p.communicate()
+            return DirmngrConnection(out.strip().decode(), keyserver)
+        except (OSError, KeyserverError):
+            self.log("connect_dirmngr: can't connect to dirmngr, falling back to gpg")
+            return None
+
+    def _recv_keys_dirmngr(self, dirmngr, fps):
+        keys = {}
+        notfound = []
+        unparsed = []
+        failed = {}
+        for i, fp in enumerate(fps):
+            try:
+                data = dirmngr.ks_get(fp)
+            except NotFoundOnKeyserver:
+                notfound.append(fp)
+                continue
+            except InvalidKeyserver as e:
+                # No use asking for the rest, but keep what was fetched
+                for remaining_fp in fps[i:]:
+                    failed[remaining_fp] = e
+                break
+            except KeyserverError as e:
+                failed[fp] = e
+                continue
+
+            # A keyserver can send other keys along with the one that was
+            # asked for. Keep just that one, like --recv-keys does.
+            try:
+                key = split_keys(dearmor(data)).get(fp)
+            except (ValueError, UnsupportedKeyVersion):
+                unparsed.append(fp)
+                continue
+            if key is None:
+                notfound.append(fp)
+            else:
+                keys[fp] = key
+
+        # Import everything that was fetched at once
+        fetched = set()
+        if len(keys) > 0:
+            with self.keyring_lock:
+                out,err = self._gpg(['--status-fd', '1', '--import'], b''.join(keys.values()))
+                self.index.invalidate()
+            fetched.update([fp for fp in self._parse_import_ok(out) if fp in keys])
+        notfound += [fp for fp in keys if fp not in fetched]
+
+        # Let gpg fetch and filter the keys that couldn't be parsed
+        if len(unparsed) > 0:
+            self.log("_recv_keys_dirmngr: can't parse {} keys, receiving them with gpg".format(len(unparsed)))
+            with self.keyring_lock:
+                self._write_keyserver_conf(dirmngr.keyserver)
+                unparsed_fetched, unparsed_notfound, unparsed_failed = self._recv_keys_batch(dirmngr.keyserver, unparsed)
+            fetched.update(unparsed_fetched)
+            notfound += unparsed_notfound
+            failed.update(unparsed_failed)
+
+        # In the order they were asked for
+        notfound = set(notfound)
+        return [fp for fp in fps if fp in fetched], [fp for fp in fps if fp in notfound], failed
+
+    def _recv_keys_batch(self, keyserver, fps):
+        # Returns (fetched, notfound, failed), where failed maps each key that
+        # couldn't be received to the error it got
+        if len(fps) == 0:
+            return [], [], {}
+
+        out,err = self._gpg(['--status-fd', '1', '--recv-keys'] + fps)
+        self.index.invalidate()
+
+        imported = self._parse_import_ok(out)
+        fetched = [fp for fp in fps if fp in imported]
+        missing = [fp for fp in fps if fp not in imported]
+        if len(missing) == 0:
+            return fetched, [], {}
+
+        # gpg only reports errors for the whole batch, so if some keys aren't
+        # on the keyserver and others failed for another reason, there's no
+        # telling which is which without bisecting
+        errors = self._get_recv_errors(keyserver, missing[0], out, err)
+        notfound_errors = [e for e in errors if isinstance(e, NotFoundOnKeyserver)]
+        if len(notfound_errors) == len(errors):
+            # No error from gpg, or the keys that are missing just aren't on
+            # the keyserver
+            return fetched, missing, {}
+
+        # Give up on a single key
+        if len(missing) == 1:
+            try:
+                self._check_recv_errors(keyserver, missing[0], out, err)
+            except NotFoundOnKeyserver:
+                return fetched, missing, {}
+            except (InvalidKeyserver, KeyserverError) as e:
+                return fetched, [], {missing[0]: e}
+
+        # Give up on a keyserver that doesn't work at all
+        if len(fetched) == 0 and len(notfound_errors) == 0 and self._is_invalid_keyserver(out, err):
+            return fetched, [], {fp: InvalidKeyserver(keyserver) for fp in missing}
+
+        # Bisect the keys that didn't make it, and try again
+        self.log("_recv_keys_batch: keyserver error, bisecting {} keys".format(len(missing)))
+        notfound = []
+        failed = {}
+        middle = len(missing) // 2
+        for half in [missing[:middle], missing[middle:]]:
+            half_fetched, half_notfound, half_failed = self._recv_keys_batch(keyserver, half)
+            fetched += half_fetched
+            notfound += half_notfound
+            failed.update(half_failed)
+        return fetched, notfound, failed
+
+    def _write_keyserver_conf(self, keyserver):
         default_hkps_server = 'hkps://hkps.pool.sks-keyservers.net'
         ca_cert_file = common.get_resource_path('sks-keyservers.netCA.pem')
 
@@ -119,67 +726,100 @@ class GnuPG(object):
         open(os.path.join(self.homedir, 'dirmngr.conf'), 'w').write(dirmngr_conf)
         open(os.path.join(self.homedir, 'gpg.conf'), 'w').write(gpg_conf)
 
-        args = ['--recv-keys', fp]
-        out,err = self._gpg(args)
+    def _is_invalid_keyserver(self, out, err):
+        return b"No keyserver available" in err or b"gpg: keyserver communications error: General error" in err or b"gpgkeys: HTTP fetch error" in out
 
-        if b"No keyserver available" in err or b"gpg: keyserver communications error: General error" in err or b"gpgkeys: HTTP fetch error" in out:
+    def _check_recv_errors(self, keyserver, fp, out, err):
+        if self._is_invalid_keyserver(out, err):
             raise InvalidKeyserver(keyserver)
 
-        if b"not found on keyserver" in err or b"keyserver receive failed: No data" in err or b"no valid OpenPGP data found" in err:
+        if self._is_not_found(err):
             raise NotFoundOnKeyserver(fp)
 
         if b"keyserver receive failed" in err:
             raise KeyserverError(keyserver)
 
-        # Import key into default homedir
-        self.import_to_default_homedir(fp)
-
-    def get_pubkey_filename_on_disk(self, fp):
-        fp = common.clean_fp(fp)
-        filename = fp.decode() + '.asc'
-        return os.path.join(self.appdata_path, filename)
+    def _get_recv_errors(self, keyserver, fp, out, err):
+        # Every error gpg reported, one for each line of its output
+        errors = []
+        if self._is_invalid_keyserver(out, err):
+            errors.append(InvalidKeyserver(keyserver))
+        for line in err.split(b'\n'):
+            if self._is_not_found(line):
+                errors.append(NotFoundOnKeyserver(fp))
+            elif b"keyserver receive failed" in line:
+                errors.append(KeyserverError(keyserver))
+        return errors
+
+    def _is_not_found(self, err):
+        return b"not found on keyserver" in err or b"keyserver receive failed: No data" in err or b"no valid OpenPGP data found" in err
+
+    def _parse_status(self, out):
+        # Parse the machine readable --status-fd lines into (keyword, args)
+        status = []
+        for line in out.split(b'\n'):
+            chunks = line.split()
+            if len(chunks) >= 2 and chunks[0] == b'[GNUPG:]':
+                status.append((chunks[1], chunks[2:]))
+        return status
+
+    def _parse_import_ok(self, out):
+        # Map each imported fingerprint to the IMPORT_OK reason flags
+        imported = {}
+        for keyword, args in self._parse_status(out):
+            if keyword == b'IMPORT_OK' and len(args) >= 2:
+                imported[args[1]] = int(args[0])
+        return imported
 
     def export_pubkey_to_disk(self, fp):
         fp = common.clean_fp(fp)
-        filename = self.get_pubkey_filename_on_disk(fp)
 
         self.log("export_pubkey_to_disk: fp={}".format(fp))
 
-        if not self.appdata_path:
+        if not self.signing_keys:
             self.log("export_pubkey_to_disk: appdata_path not set, skipping")
             return
 
-        # Export public key from the temporary homedir
-        out,err = self._gpg(['--armor', '--export', fp])
-        pubkey = out
+        # Export the public key from the temporary homedir, and add it to the
+        # signing key store
+        out,err = self._gpg(['--export', fp])
+        if out != b'':
+            self.signing_keys.put_many({fp: out})
 
-        # Save to disk
-        open(filename, 'w').write(pubkey.decode())
+    def import_pubkeys_from_disk(self, fps):
+        # Import several signing keys with just one gpg. Returns the first uid
+        # of each of them, from the listing gpg shows as it imports them.
+        self.log("import_pubkeys_from_disk: {} keys".format(len(fps)))
 
-    def import_pubkey_from_disk(self, fp):
-        fp = common.clean_fp(fp)
-        filename = self.get_pubkey_filename_on_disk(fp)
+        if not self.signing_keys:
+            self.log("import_pubkeys_from_disk: appdata_path not set, skipping")
+            return {}
 
-        self.log("import_pubkey_from_disk: fp={}".format(fp))
+        self._migrate_pubkeys_on_disk()
 
-        if not self.appdata_path:
-            self.log("import_pubkey_from_disk: appdata_path not set, skipping")
-            return
+        # Skip the keys that aren't stored
+        keys = self.signing_keys.get_many([common.clean_fp(fp) for fp in fps])
+        if len(keys) == 0:
+            return {}
 
-        # Import key
-        try:
-            out,err = self._gpg(['--import', filename])
-        except:
-            # If the key doesn't exist, ignore
-            pass
+        with self.keyring_lock:
+            out,err = self._gpg(['--with-colons', '--import-options', 'import-show', '--import'], input=b''.join(keys.values()))
+        self.index.invalidate()
+
+        uids = {}
+        for fp, key in self.index.parse(out).items():
+            if len(key.uids) > 0:
+                uids[fp] = key.uids[0]
+            else:
+                uids[fp] = ''
+        return uids
 
     def delete_pubkey_from_disk(self, fp):
         fp = common.clean_fp(fp)
-        filename = self.get_pubkey_filename_on_disk(fp)
 
         self.log("delete_pubkey_from_disk: fp={}".format(fp))
 
-        if not self.appdata_path:
+        if not self.signing_keys:
             self.log("delete_pubkey_from_disk: appdata_path not set, skipping")
             return
 
@@ -187,11 +827,29 @@ class GnuPG(object):
         if fp == b"":
             return
 
-        # Delete the public key from disk
-        try:
-            os.remove(filename)
-        except:
-            pass
+        self.signing_keys.delete(fp)
+
+    def _migrate_pubkeys_on_disk(self):
+        # Older versions saved each signing key in its own <fingerprint>.asc
+        # file. Move them all into the signing key store, with one import
+        # and one export.
+        filenames = [filename for filename in glob.glob(os.path.join(self.appdata_path, '*.asc'))
+            if common.valid_fp(os.path.basename(filename)[:-4].encode())]
+        if len(filenames) == 0:
+            return
+
+        self.log("_migrate_pubkeys_on_disk: migrating {} keys".format(len(filenames)))
+        fps = [common.clean_fp(os.path.basename(filename)[:-4].encode()) for filename in filenames]
+        with self.keyring_lock:
+            self._gpg(['--import'] + filenames)
+            self.index.invalidate()
+        keys = self.export_keys(fps)
+        self.signing_keys.put_many(keys)
+
+        # Only remove the files that made it into the store
+        for filename, fp in zip(filenames, fps):
+            if fp in keys:
+                os.remove(filename)
 
     def test_key(self, fp):
         self.log("test_key: fp={}".format(fp))
@@ -200,18 +858,21 @@ class GnuPG(object):
             raise InvalidFingerprint(fp)
 
         fp = common.clean_fp(fp)
-        out,err = self._gpg(['--with-colons', '--list-keys', fp])
+        key = self.index.get(fp)
 
-        if b"error reading key: No public key" in err:
+        if key is None:
             raise NotFoundInKeyring(fp)
 
-        for line in out.split(b'\n'):
-            if line.startswith(b'pub:'):
-                chunks = line.split(b':')
-                if chunks[1] == b'r':
-                    raise RevokedKey(fp)
-                if chunks[1] == b'e':
-                    raise ExpiredKey(fp)
+        if key.validity == b'r':
+            raise RevokedKey(fp)
+        if key.validity == b'e':
+            raise ExpiredKey(fp)
+
+    def in_keyring(self, fp):
+        if not common.valid_fp(fp):
+            raise InvalidFingerprint(fp)
+
+        return self.index.get(common.clean_fp(fp)) is not None
 
     def get_uid(self, fp):
         self.log("get_uid: fp={}".format(fp))
@@ -220,20 +881,53 @@ class GnuPG(object):
             raise InvalidFingerprint(fp)
 
         fp = common.clean_fp(fp)
+        key = self.index.get(fp)
 
-        if fp in self.uids:
-            return self.uids[fp]
-
-        out,err = self._gpg(['--with-colons', '--list-keys', fp])
-        for line in out.split(b'\n'):
-            if line.startswith(b'uid:'):
-                chunks = line.split(b':')
-                uid = str(chunks[9], 'UTF-8')
-                self.uids[fp] = uid
-                return uid
+        if key is not None and len(key.uids) > 0:
+            return key.uids[0]
 
         return ''
 
+    def get_uids(self, fps):
+        # Returns the first uid of each of these keys, from one look at the
+        # keyring index. Keys that aren't in the keyring get ''.
+        fps = [common.clean_fp(fp) for fp in fps if common.valid_fp(fp)]
+        self.log("get_uids: {} keys".format(len(fps)))
+
+        keys = self.index.get_many(fps)
+        uids = {}
+        for fp in fps:
+            if fp in keys and len(keys[fp].uids) > 0:
+                uids[fp] = keys[fp].uids[0]
+            else:
+                uids[fp] = ''
+        return uids
+
+    def get_expiry(self, fp):
+        # Returns when a key stops being useful, as a timestamp, or None if it
+        # never expires. That's when the primary key expires, or when its last
+        # subkey does, whichever comes first.
+        self.log("get_expiry: fp={}".format(fp))
+
+        if not common.valid_fp(fp):
+            raise InvalidFingerprint(fp)
+
+        fp = common.clean_fp(fp)
+        key = self.index.get(fp)
+
+        if key is None:
+            return None
+
+        expires = [key.expires]
+        subkeys = [subkey for subkey in key.subkeys if subkey['validity'] != b'r']
+        if len(subkeys) > 0 and all([subkey['expires'] for subkey in subkeys]):
+            expires.append(max([subkey['expires'] for subkey in subkeys]))
+
+        expires = [timestamp for timestamp in expires if timestamp]
+        if len(expires) == 0:
+            return None
+        return min(expires)
+
     def verify(self, msg_sig, msg, fp):
         self.log("verify: (not displaying msg_sig, msg), fp={}".format(fp))
 
@@ -242,82 +936,141 @@ class GnuPG(object):
 
         fp = common.clean_fp(fp)
 
-        # Write message and detached signature to disk
-        msg_sig_filename = tempfile.NamedTemporaryFile(delete=False).name
-        open(msg_sig_filename, 'wb').write(msg_sig)
-        msg_filename = tempfile.NamedTemporaryFile(delete=False).name
-        open(msg_filename, 'wb').write(msg)
-
         # Verify the signature
-        out,err = self._gpg(['--keyid-format', '0xlong', '--verify', msg_sig_filename, msg_filename])
-        os.unlink(msg_filename)
-        os.unlink(msg_sig_filename)
+        out,err = self._gpg_verify(msg_sig, msg)
+        status = self._parse_status(out)
+        keywords = [keyword for keyword, args in status]
 
-        if b'BAD signature' in err:
+        if b'BADSIG' in keywords:
             raise BadSignature()
-        if b"Can't check signature: No public key" in err or b'no valid OpenPGP data found' in err or b'the signature could not be verified' in err:
+        if b'ERRSIG' in keywords or b'NO_PUBKEY' in keywords or b'NODATA' in keywords:
             raise VerificationError()
-        if b'This key has been revoked by its owner!' in err:
+        if b'REVKEYSIG' in keywords or b'KEYREVOKED' in keywords:
             raise RevokedKey()
-        if b'Note: This key has expired!' in err:
+        if b'EXPKEYSIG' in keywords:
             raise ExpiredKey()
-        if b'Signature made' not in err and b'Good signature from' not in err:
+        if b'VALIDSIG' not in keywords:
             raise VerificationError()
 
-        # Make sure the signing key is correct
-        lines = err.split(b'\n')
-        for i in range(len(lines)):
-            if lines[i].startswith(b'gpg: Signature made'):
-                signing_fp = lines[i+1].split()[-1]
-                signing_keyid = self.fp_to_long_keyid(signing_fp)
-                if signing_keyid not in self.list_all_keyids(fp):
-                    raise SignedWithWrongKey
-                break
+        # Make sure the signing key is correct. The last field of VALIDSIG is
+        # the fingerprint of the primary key, even if a subkey made the signature
+        for keyword, args in status:
+            if keyword == b'VALIDSIG' and args[-1] == fp:
+                return
+        raise SignedWithWrongKey
 
-    def list_all_keyids(self, fp):
-        self.log("list_all_keyids: fp={}".format(fp))
+    def export_keys(self, fps):
+        self.log("export_keys: {} fps".format(len(fps)))
 
-        if not common.valid_fp(fp):
-            raise InvalidFingerprint(fp)
+        if len(fps) == 0:
+            return {}
 
-        fp = common.clean_fp(fp)
+        # Export all of the public keys at once, and split them up
+        out,err = self._gpg(['--export'] + fps)
+        try:
+            return split_keys(out)
+        except UnsupportedKeyVersion as e:
+            # Fall back to exporting them one at a time
+            self.log("export_keys: unsupported key version {}, exporting keys one at a time".format(e))
+
+        keys = {}
+        for fp in fps:
+            out,err = self._gpg(['--export', fp])
+            if out != b'':
+                keys[fp] = out
+        return keys
+
+    def import_to_default_homedir(self, fps, keys=None):
+        self.log("import_to_default_homedir: {} fps".format(len(fps)))
+
+        if len(fps) == 0:
+            return {}
+
+        # Export all of the public keys from the temporary homedir at once,
+        # unless they were already exported with export_keys
+        if keys is not None and all([fp in keys for fp in fps]):
+            pubkeys = b''.join([keys[fp] for fp in fps])
+        else:
+            out,err = self._gpg(['--export'] + fps)
+            pubkeys = out
 
-        out, err = self._gpg(['--keyid-format', '0xlong', '--list-keys', fp])
-        if b'gpg: error reading key: No public key' in err:
-            raise NotFoundInKeyring
+        if pubkeys == b'':
+            return {}
 
-        return re.findall(b'0x[A-F\d]{16}', out)
+        # Import them into default homedir, with a single import
+        with self.keyring_lock:
+            p = subprocess.Popen([self.gpg_path, '--batch', '--no-tty', '--status-fd', '1', '--import'],
+                stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            (out, err) = p.communicate(pubkeys)
 
-    def fp_to_long_keyid(self, fp):
-        if re.match(b'0x[A-F\d]{16}', fp):
-            return fp
-        return b'0x' + fp[-16:]
+        if out != '':
+            self.log('import_to_default_homedir: stdout: {}'.format(out))
+        if err != '':
+            self.log('import_to_default_homedir: stderr: {}'.format(err))
+
+        # Find out what happened to each key
+        results = {}
+        for fp, reason in self._parse_import_ok(out).items():
+            if reason == 0:
+                results[fp] = 'unchanged'
+            elif reason & 1:
+                results[fp] = 'new'
+            else:
+                results[fp] = 'updated'
+        return results
+
+    def delete_keys(self, fps):
+        # Delete keys from the gpgsync homedir only, never the default homedir
+        self.log("delete_keys: {} fps".format(len(fps)))
+
+        if len(fps) == 0:
+            return
 
-    def import_to_default_homedir(self, fp):
-        self.log("import_to_default_homedir: fp={}".format(fp))
+        fps = [common.clean_fp(fp) for fp in fps]
+        with self.keyring_lock:
+            self._gpg(['--yes', '--delete-keys'] + fps)
+            self.index.invalidate()
 
-        # Export public key from the temporary homedir
-        out,err = self._gpg(['--armor', '--export', fp])
-        pubkey = out
+    def _gpg_verify(self, msg_sig, msg):
+        args = ['--status-fd', '1', '--enable-special-filenames', '--verify']
 
-        # Import public key into default homedir
-        if not b'gpg: WARNING: nothing exported' in err:
-            p = subprocess.Popen([self.gpg_path, '--import'],
-                stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-            (out, err) = p.communicate(pubkey)
+        # Windows can't pass extra file descriptors to gpg, so fall back to
+        # writing the detached signature to a temporary file
+        if self.system == 'Windows':
+            msg_sig_file = tempfile.NamedTemporaryFile(delete=False)
+            try:
+                msg_sig_file.write(msg_sig)
+                msg_sig_file.close()
+                return self._gpg(args + ['--', msg_sig_file.name, '-'], msg)
+            finally:
+                os.unlink(msg_sig_file.name)
+
+        # The message goes to gpg's stdin, and the detached signature through
+        # an extra pipe, so neither of them touch the disk
+        sig_read_fd, sig_write_fd = os.pipe()
+        writer = threading.Thread(target=self._write_fd, args=(sig_write_fd, msg_sig))
+        try:
+            writer.start()
+            return self._gpg(args + ['--', '-&{}'.format(sig_read_fd), '-'], msg, pass_fds=(sig_read_fd,))
+        finally:
+            os.close(sig_read_fd)
+            writer.join()
 
-            if out != '':
-                self.log('import_to_default_homedir: stdout: {}'.format(out))
-            if err != '':
-                self.log('import_to_default_homedir: stderr: {}'.format(err))
+    def _write_fd(self, fd, data):
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        except BrokenPipeError:
+            # gpg stopped reading
+            pass
 
-    def _gpg(self, args, input=None):
+    def _gpg(self, args, input=None, pass_fds=()):
         default_args = [self.gpg_path, '--batch', '--no-tty', '--homedir', self.homedir]
 
         self.log('_gpg: args: {}'.format(default_args + args))
 
         p = subprocess.Popen(default_args + args,
-            stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds)
         (out, err) = p.communicate(input)
 
         if out != '':
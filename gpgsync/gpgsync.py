@@ -18,7 +18,7 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import sys, platform, queue, datetime, requests
+import sys, platform, datetime
 from packaging.version import parse
 from PyQt5 import QtCore, QtWidgets
 
@@ -26,20 +26,24 @@ from . import common
 
 from .gnupg import GnuPG
 from .settings import Settings
+from .sync_state import SyncState
+from .engine import SyncEngine
 
 from .endpoint_selection import EndpointSelection
 from .edit_endpoint import EditEndpoint
-from .endpoint import Endpoint, Verifier, Refresher, URLDownloadError, ProxyURLDownloadError, InvalidFingerprints
+from .endpoint import Endpoint
+from .threads import Verifier, SyncThread, UpdateChecker
 from .buttons import Buttons
-from .status_bar import StatusBar, MessageQueue
+from .status_bar import StatusBar
 from .systray import SysTray
 from .settings_window import SettingsWindow
 
 class GPGSync(QtWidgets.QMainWindow):
-    def __init__(self, app, debug=False):
+    def __init__(self, app, debug=False, startup_profile=None):
         super(GPGSync, self).__init__()
         self.app = app
         self.debug = debug
+        self.startup_profile = startup_profile if startup_profile else common.StartupProfile()
         self.system = platform.system()
         self.setWindowTitle('GPG Sync')
         self.setWindowIcon(common.get_icon())
@@ -50,11 +54,14 @@ class GPGSync(QtWidgets.QMainWindow):
 
         self.threads = []
 
-        # Load settings
+        # Load settings, and the per-key sync state
         self.settings = Settings(self.debug)
+        self.sync_state = SyncState(self.settings.get_appdata_path(), self.debug)
+        common.session_manager.set_timeouts(self.settings.http_connect_timeout, self.settings.http_read_timeout)
+        self.startup_profile.mark('Load settings')
 
         # Initialize gpg
-        self.gpg = GnuPG(appdata_path=self.settings.get_appdata_path(), debug=debug)
+        self.gpg = GnuPG(appdata_path=self.settings.get_appdata_path(), debug=debug, persistent_homedir=self.settings.persistent_homedir)
         if not self.gpg.is_gpg_available():
             if self.system == 'Linux':
                 common.alert('GnuPG 2.x doesn\'t seem to be installed. Install your operating system\'s gnupg2 package.')
@@ -63,19 +70,25 @@ class GPGSync(QtWidgets.QMainWindow):
             if self.system == 'Windows':
                 common.alert('GnuPG doesn\'t seem to be installed. Install <a href="http://gpg4win.org/">Gpg4win</a>.')
             sys.exit()
+        self.startup_profile.mark('Initialize gpg')
+
+        # The sync engine does the syncing, this is just the GUI for it
+        self.engine = SyncEngine(self.settings, self.gpg, self.sync_state, self.debug)
 
         # Initialize endpoints
         self.current_endpoint = None
-        try:
-            for e in self.settings.endpoints:
-                if e.verified:
-                    self.gpg.import_pubkey_from_disk(e.fingerprint)
-                else:
-                    self.unconfigured_endpoint = e
-        except:
-            pass
+        for e in self.settings.endpoints:
+            if not e.verified:
+                self.unconfigured_endpoint = e
+
+        # The signing keys' uids are kept for the endpoint list
+        self.signing_key_uids = self.engine.import_signing_keys()
+        self.startup_profile.mark('Import signing keys')
 
-        self.settings_window = SettingsWindow(self.settings)
+        # The main window and the settings window are built the first time
+        # they're shown. At login, GPG Sync starts out hidden in the system tray.
+        self.window_built = False
+        self.settings_window = None
 
         # Initialize the system tray icon
         self.systray = SysTray(self.version)
@@ -83,20 +96,55 @@ class GPGSync(QtWidgets.QMainWindow):
         self.systray.sync_now_signal.connect(self.sync_all_endpoints)
         if self.system != 'Linux':
             self.checking_for_updates = False
+            self.force_update_check = False
             self.systray.check_updates_now_signal.connect(self.force_check_for_updates)
         self.systray.quit_signal.connect(self.quit)
         self.systray.show_settings_window_signal.connect(self.open_settings_window)
         self.systray.clicked_applet_signal.connect(self.clicked_applet)
+        self.sync_msg = None
+
+        # Refresh the "N minutes ago" labels as each minute goes by. Everything
+        # else in the window is updated by signals when it changes.
+        self.relative_time_timer = QtCore.QTimer()
+        self.relative_time_timer.setSingleShot(True)
+        self.relative_time_timer.timeout.connect(self.refresh_relative_times)
+        self.schedule_relative_times()
+
+        # Timed tasks intialize
+        self.currently_syncing = False
+        self.syncing_errors = []
+
+        self.global_timer = QtCore.QTimer()
+        self.global_timer.timeout.connect(self.run_interval_tasks)
+        self.global_timer.start(60000) # 1 minute
+        self.startup_profile.mark('Build the system tray icon')
+
+        # Decide if window should start out shown or hidden
+        if len(self.settings.endpoints) == 0:
+            self.show_main_window()
+            self.startup_profile.mark('Build the main window')
+        else:
+            self.systray.set_window_show(False)
+
+        # Handle application state changes
+        self.first_state_change_ignored = False
+        self.app.applicationStateChanged.connect(self.application_state_change)
+
+    def build_window(self):
+        if self.window_built:
+            return
+        self.window_built = True
+        self.log("build_window")
 
         # Endpoint selection GUI
         self.endpoint_selection = EndpointSelection(self.gpg)
-        self.endpoint_selection.load_endpoints(self.settings.endpoints)
+        self.endpoint_selection.load_endpoints(self.settings.endpoints, self.signing_key_uids)
         endpoint_selection_wrapper = QtWidgets.QWidget()
         endpoint_selection_wrapper.setMinimumWidth(300)
         endpoint_selection_wrapper.setLayout(self.endpoint_selection)
 
         self.endpoint_selection.add_endpoint_signal.connect(self.add_endpoint)
-        self.endpoint_selection.endpoint_list.itemClicked.connect(self.endpoint_clicked)
+        self.endpoint_selection.endpoint_list.endpoint_clicked.connect(self.endpoint_clicked)
 
         if self.unconfigured_endpoint is not None:
             self.endpoint_selection.add_btn.setEnabled(False)
@@ -116,7 +164,6 @@ class GPGSync(QtWidgets.QMainWindow):
         self.buttons.sync_now_signal.connect(self.sync_all_endpoints)
         self.buttons.autoupdate_signal.connect(self.configure_autoupdate)
         self.buttons.quit_signal.connect(self.quit)
-        self.sync_msg = None
 
         # Layout
         hlayout = QtWidgets.QHBoxLayout()
@@ -133,32 +180,8 @@ class GPGSync(QtWidgets.QMainWindow):
         self.status_bar = StatusBar()
         self.setStatusBar(self.status_bar)
 
-        # Check for status bar messages from other threads
-        # Also, reload endpoint display
-        self.status_q = MessageQueue()
-        self.update_ui_timer = QtCore.QTimer()
-        self.update_ui_timer.timeout.connect(self.update_ui)
-        self.update_ui_timer.start(500) # 0.5 seconds
-
-        # Timed tasks intialize
-        self.currently_syncing = False
-        self.syncing_errors = []
-
-        self.global_timer = QtCore.QTimer()
-        self.global_timer.timeout.connect(self.run_interval_tasks)
-        self.global_timer.start(60000) # 1 minute
-
-        # Decide if window should start out shown or hidden
-        if len(self.settings.endpoints) == 0:
-            self.show()
-            self.systray.set_window_show(True)
-        else:
-            self.hide()
-            self.systray.set_window_show(False)
-
-        # Handle application state changes
-        self.first_state_change_ignored = False
-        self.app.applicationStateChanged.connect(self.application_state_change)
+        # Catch up with a sync that's already running
+        self.toggle_input(not self.currently_syncing, self.sync_msg)
 
     def log(self, msg):
         if self.debug:
@@ -189,6 +212,7 @@ class GPGSync(QtWidgets.QMainWindow):
 
     def toggle_show_window(self):
         if self.isHidden():
+            self.build_window()
             self.show()
             self.raise_()
             self.showNormal()
@@ -200,6 +224,7 @@ class GPGSync(QtWidgets.QMainWindow):
 
     def show_main_window(self):
         if self.isHidden():
+            self.build_window()
             self.show()
             self.raise_()
             self.showNormal()
@@ -212,38 +237,31 @@ class GPGSync(QtWidgets.QMainWindow):
             self.showNormal()
             self.activateWindow()
 
-    def update_ui(self):
-        # Print events, and update status bar
-        events = []
-        done = False
-        while not done:
-            try:
-                ev = self.status_q.get(False)
-                events.append(ev)
-            except queue.Empty:
-                done = True
-
-        for event in events:
-            if event['type'] == 'update':
-                print(event['msg'])
-                if not self.isHidden():
-                    self.status_bar.showMessage(event['msg'], event['timeout'])
-            elif event['type'] == 'clear':
-                if not self.isHidden():
-                    self.status_bar.clearMessage()
-
-        # Ignore the rest of the UI if window is hidden
-        if self.isHidden():
-            return
+    def showEvent(self, e):
+        # The labels might have gone stale while the window was hidden
+        self.refresh_relative_times()
+        super(GPGSync, self).showEvent(e)
+
+    def show_message(self, msg, timeout=0):
+        # Show a status message from a thread, or clear it if msg is None
+        window_shown = self.window_built and not self.isHidden()
+        if msg is None:
+            if window_shown:
+                self.status_bar.clearMessage()
+        else:
+            print(msg)
+            if window_shown:
+                self.status_bar.showMessage(msg, timeout)
 
-        # Endpoint display
-        self.endpoint_selection.reload_endpoints()
+    def schedule_relative_times(self):
+        # Fire again right after the next minute boundary
+        now = datetime.datetime.now()
+        self.relative_time_timer.start(60000 - (now.second * 1000 + now.microsecond // 1000))
 
-        # Sync message
-        if(self.sync_msg):
-            self.buttons.update_sync_label(self.sync_msg)
-        else:
-            self.buttons.update_sync_label()
+    def refresh_relative_times(self):
+        if self.window_built and not self.isHidden():
+            self.endpoint_selection.refresh_last_checked_labels()
+        self.schedule_relative_times()
 
     def edit_endpoint_alert_error(self, msg, details='', icon=QtWidgets.QMessageBox.Warning):
         common.alert(msg, details, icon)
@@ -267,7 +285,7 @@ class GPGSync(QtWidgets.QMainWindow):
         self.endpoint_selection.reload_endpoint(self.settings.endpoints[self.current_endpoint])
 
         # Unselect endpoint
-        self.endpoint_selection.endpoint_list.setCurrentItem(None)
+        self.endpoint_selection.endpoint_list.select_endpoint(None)
         self.edit_endpoint_wrapper.hide()
         self.current_endpoint = None
 
@@ -275,6 +293,8 @@ class GPGSync(QtWidgets.QMainWindow):
 
     def open_settings_window(self):
         self.show_main_window()
+        if self.settings_window is None:
+            self.settings_window = SettingsWindow(self.settings)
         self.settings_window.show()
 
     def add_endpoint(self):
@@ -285,10 +305,8 @@ class GPGSync(QtWidgets.QMainWindow):
         self.endpoint_selection.add_btn.setEnabled(False)
 
         # Click on the newest endpoint
-        count = self.endpoint_selection.endpoint_list.count()
-        item = self.endpoint_selection.endpoint_list.item(count-1)
-        self.endpoint_selection.endpoint_list.setCurrentItem(item)
-        self.endpoint_selection.endpoint_list.itemClicked.emit(item)
+        self.endpoint_selection.endpoint_list.select_endpoint(e)
+        self.endpoint_clicked(e)
 
     def save_endpoint(self):
         # Get values for endpoint
@@ -303,9 +321,10 @@ class GPGSync(QtWidgets.QMainWindow):
         self.toggle_input(False)
 
         # Run the verifier inside a new thread
-        self.verifier = Verifier(self.debug, self.gpg, self.status_q, fingerprint, url, keyserver, use_proxy, proxy_host, proxy_port)
+        self.verifier = Verifier(self.debug, self.gpg, fingerprint, url, keyserver, use_proxy, proxy_host, proxy_port)
         self.threads.append(self.verifier)
         self.log("save_endpoint, adding Verifier thread ({} threads right now)".format(len(self.threads)))
+        self.verifier.message.connect(self.show_message, QtCore.Qt.QueuedConnection)
         self.verifier.alert_error.connect(self.edit_endpoint_alert_error)
         self.verifier.success.connect(self.edit_endpoint_save)
         self.verifier.finished.connect(self.clean_threads)
@@ -337,9 +356,9 @@ class GPGSync(QtWidgets.QMainWindow):
         else:
             self.log("delete_endpoint, user clicked Cancel")
 
-    def endpoint_clicked(self, item):
+    def endpoint_clicked(self, e):
         try:
-            i = self.settings.endpoints.index(item.endpoint)
+            i = self.settings.endpoints.index(e)
         except ValueError:
             print('ERROR: Invalid endpoint')
             return
@@ -347,57 +366,15 @@ class GPGSync(QtWidgets.QMainWindow):
         # Clicking on an already-selected endpoint unselects it
         if i == self.current_endpoint:
             self.edit_endpoint_wrapper.hide()
-            self.endpoint_selection.endpoint_list.setCurrentItem(None)
+            self.endpoint_selection.endpoint_list.select_endpoint(None)
             self.current_endpoint = None
 
         # Select new endpoint
         else:
             self.current_endpoint = i
-            self.edit_endpoint.set_endpoint(item.endpoint)
+            self.edit_endpoint.set_endpoint(e)
             self.edit_endpoint_wrapper.show()
 
-    def refresher_finished(self):
-        self.clean_threads()
-
-        if len(self.waiting_refreshers) > 0:
-            r = self.waiting_refreshers.pop()
-            self.active_refreshers.append(r)
-            r.start()
-        else:
-            self.status_q.add_message('Syncing complete.', timeout=4000)
-            self.currently_syncing = False
-            self.toggle_input(True)
-
-    def refresher_success(self, e, invalid_fingerprints, notfound_fingerprints):
-        if len(invalid_fingerprints) == 0 and len(notfound_fingerprints) == 0:
-            warning = False
-        else:
-            warnings = []
-            if len(invalid_fingerprints) > 0:
-                warning.append('Invalid fingerprints {}'.format(invalid_fingerprints))
-            if len(notfound_fingerprints) > 0:
-                warnings.append('Not found fingerprints {}'.format(notfound_fingerprints))
-            warning = ', '.join(warnings)
-
-        e.last_checked = datetime.datetime.now()
-        e.last_synced = datetime.datetime.now()
-        e.warning = warning
-        e.error = None
-
-        self.endpoint_selection.reload_endpoint(e)
-        self.settings.save()
-
-    def refresher_error(self, e, err, reset_last_checked=True):
-        self.syncing_errors.append(e)
-        if reset_last_checked:
-            e.last_checked = datetime.datetime.now()
-        e.last_failed = datetime.datetime.now()
-        e.warning = None
-        e.error = err
-
-        self.endpoint_selection.reload_endpoint(e)
-        self.settings.save()
-
     def clean_threads(self):
         self.log("clean_threads ({} threads right now)".format(len(self.threads)))
 
@@ -419,46 +396,35 @@ class GPGSync(QtWidgets.QMainWindow):
         self.currently_syncing = True
         self.syncing_errors = []
 
-        # Make a refresher for each endpoint
-        self.waiting_refreshers = []
-        self.active_refreshers = []
-        for e in self.settings.endpoints:
-            if e.verified:
-                refresher = Refresher(self.debug, self.gpg, self.settings.update_interval_hours, self.status_q, e, force)
-                self.threads.append(refresher)
-                self.log("sync_all_endpoints, adding Refresher thread ({} threads right now)".format(len(self.threads)))
-                refresher.finished.connect(self.refresher_finished)
-                refresher.success.connect(self.refresher_success)
-                refresher.error.connect(self.refresher_error)
-                self.waiting_refreshers.append(refresher)
-
-        # Start the first refresher thread
-        if len(self.waiting_refreshers) > 0:
-            r = self.waiting_refreshers.pop()
-            self.active_refreshers.append(r)
-            r.start()
-
-            sync_string = "Syncing: {} {}".format(self.gpg.get_uid(r.e.fingerprint), common.fp_to_keyid(r.e.fingerprint).decode())
-            print(sync_string)
-            self.toggle_input(False, sync_string)
+        # Run the sync engine inside a new thread
+        sync_thread = SyncThread(self.engine, force)
+        self.threads.append(sync_thread)
+        self.log("sync_all_endpoints, adding SyncThread ({} threads right now)".format(len(self.threads)))
+        sync_thread.message.connect(self.show_message, QtCore.Qt.QueuedConnection)
+        sync_thread.progress.connect(self.sync_progress, QtCore.Qt.QueuedConnection)
+        sync_thread.endpoint_updated.connect(self.endpoint_updated, QtCore.Qt.QueuedConnection)
+        sync_thread.finished.connect(self.syncing_finished)
+        sync_thread.start()
+
+    def endpoint_updated(self, e):
+        if self.window_built:
+            self.endpoint_selection.reload_endpoint(e)
+
+    def sync_progress(self, sync_msg):
+        self.toggle_input(False, sync_msg)
+
+    def syncing_finished(self):
+        self.syncing_errors = self.sender().errors
+        self.clean_threads()
+        self.currently_syncing = False
+        self.toggle_input(True)
 
     def toggle_input(self, enabled=False, sync_msg=None):
         # Show/hide loading graphic
         if enabled:
-            self.status_bar.hide_loading()
             self.systray.setIcon(common.get_systray_icon())
         else:
-            self.status_bar.show_loading()
             self.systray.setIcon(common.get_systray_syncing_icon())
-
-        # Disable/enable all input
-        if self.unconfigured_endpoint is not None:
-            self.endpoint_selection.add_btn.setEnabled(False)
-            self.endpoint_selection.endpoint_list.setEnabled(enabled)
-        else:
-            self.endpoint_selection.setEnabled(enabled)
-        self.edit_endpoint_wrapper.setEnabled(enabled)
-        self.buttons.sync_now_btn.setEnabled(enabled)
         self.systray.refresh_act.setEnabled(enabled)
 
         # Next sync check message
@@ -470,6 +436,25 @@ class GPGSync(QtWidgets.QMainWindow):
         if len(self.syncing_errors) > 0:
             self.systray.setIcon(common.get_systray_error_icon())
 
+        # The rest of the input is in the main window, if it's built yet
+        if not self.window_built:
+            return
+
+        if enabled:
+            self.status_bar.hide_loading()
+        else:
+            self.status_bar.show_loading()
+
+        # Disable/enable all input
+        if self.unconfigured_endpoint is not None:
+            self.endpoint_selection.add_btn.setEnabled(False)
+            self.endpoint_selection.endpoint_list.setEnabled(enabled)
+        else:
+            self.endpoint_selection.setEnabled(enabled)
+        self.edit_endpoint_wrapper.setEnabled(enabled)
+        self.buttons.sync_now_btn.setEnabled(enabled)
+        self.buttons.update_sync_label(self.sync_msg)
+
     def check_for_updates(self, force=False):
         self.log("check_for_updates, force={}".format(force))
 
@@ -487,56 +472,59 @@ class GPGSync(QtWidgets.QMainWindow):
                 return
 
             self.checking_for_updates = True
+            self.force_update_check = force
+
+            # Check in a new thread, and show the results when it's done
+            update_checker = UpdateChecker(self.debug,
+                self.settings.automatic_update_use_proxy,
+                self.settings.automatic_update_proxy_host,
+                self.settings.automatic_update_proxy_port,
+                self.settings.update_etag, self.settings.update_release)
+            self.threads.append(update_checker)
+            self.log("check_for_updates, adding UpdateChecker thread ({} threads right now)".format(len(self.threads)))
+            update_checker.checked.connect(self.update_checked, QtCore.Qt.QueuedConnection)
+            update_checker.finished.connect(self.clean_threads)
+            update_checker.start()
+
+    def update_checked(self, release, etag):
+        force = self.force_update_check
+        self.checking_for_updates = False
+
+        # The request failed
+        if release is None:
+            return
 
-            try:
-                url = 'https://api.github.com/repos/firstlookmedia/gpgsync/releases/latest'
-
-                self.log("check_for_updates, loading {}".format(url))
-                if self.settings.automatic_update_use_proxy:
-                    socks5_address = 'socks5://{}:{}'.format(self.settings.automatic_update_proxy_host.decode(), self.settings.automatic_update_proxy_port.decode())
-
-                    proxies = {
-                      'https': socks5_address,
-                      'http': socks5_address
-                    }
-
-                    r = common.requests_get(url, proxies=proxies)
-                else:
-                    r = common.requests_get(url)
-
-                release = r.json()
-            except (requests.exceptions.RequestException, requests.exceptions.ConnectionError) as e:
-                self.log("check_for_updates, exception making http request: {}".format(e))
-                self.checking_for_updates = False
-                return
-
-            if release and 'tag_name' in release:
-                latest_version = parse(release['tag_name'])
-                self.log('check_for_updates, latest version = {}'.format(latest_version))
+        if release and 'tag_name' in release:
+            latest_version = parse(release['tag_name'])
+            self.log('check_for_updates, latest version = {}'.format(latest_version))
 
-                if self.version < latest_version:
-                    if self.saved_update_version < latest_version or force:
-                        self.show_main_window()
+            # Remember the release, so next time it only gets downloaded again
+            # if it changed
+            self.settings.update_etag = etag
+            self.settings.update_release = release
 
-                        common.update_alert(self.version, latest_version, release['html_url'])
-                        self.saved_update_version = latest_version
-                elif self.version >= latest_version and force:
-                    self.show_main_window()
-                    common.alert('No updates available.<br><br><span style="font-weight:normal;">Version {} is the latest version.</span>'.format(latest_version))
-                self.settings.last_update_check_err = False
-            elif release and 'tag_name' not in release:
-                if not self.settings.last_update_check_err or force:
+            if self.version < latest_version:
+                if self.saved_update_version < latest_version or force:
                     self.show_main_window()
-                    details = ''
-                    for key, val in release.items():
-                        details += '{}: {}\n\n'.format(key, val)
-
-                    common.alert('Error checking for updates.', details)
-                self.settings.last_update_check_err = True
 
-            self.settings.last_update_check = datetime.datetime.now()
-            self.settings.save()
-            self.checking_for_updates = False
+                    common.update_alert(self.version, latest_version, release['html_url'])
+                    self.saved_update_version = latest_version
+            elif self.version >= latest_version and force:
+                self.show_main_window()
+                common.alert('No updates available.<br><br><span style="font-weight:normal;">Version {} is the latest version.</span>'.format(latest_version))
+            self.settings.last_update_check_err = False
+        elif release and 'tag_name' not in release:
+            if not self.settings.last_update_check_err or force:
+                self.show_main_window()
+                details = ''
+                for key, val in release.items():
+                    details += '{}: {}\n\n'.format(key, val)
+
+                common.alert('Error checking for updates.', details)
+            self.settings.last_update_check_err = True
+
+        self.settings.last_update_check = datetime.datetime.now()
+        self.settings.save_state()
 
     def force_check_for_updates(self):
         self.check_for_updates(True)
@@ -548,6 +536,9 @@ class GPGSync(QtWidgets.QMainWindow):
     def shutdown(self):
         self.log("shutdown ({} threads)".format(len(self.threads)))
 
+        # Save anything that's waiting to be saved
+        self.settings.flush()
+
         # Tell all the threads to quit
         for t in self.threads:
             self.log("terminating thread {}".format(type(t)))
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+GPG Sync
+Helps users have up-to-date public keys for everyone in their organization
+https://github.com/firstlookmedia/gpgsync
+Copyright (C) 2016 First Look Media
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import sys, argparse, signal, threading
+
+from . import common
+from .gnupg import GnuPG
+from .settings import Settings
+from .sync_state import SyncState
+from .engine import SyncEngine, NoInternetConnection
+
+# Exit codes
+EXIT_OK = 0
+EXIT_SYNC_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_GPG = 3
+EXIT_NO_ENDPOINTS = 4
+EXIT_OFFLINE = 5
+
+# How often the daemon looks for endpoints and keys that are due, in seconds
+SYNC_CHECK_INTERVAL = 60
+
+def print_message(msg, timeout):
+    if msg is not None:
+        print(msg)
+
+def run_daemon(engine, force, stop_event):
+    # Sync whenever something is due, until stop_event is set. A sync that
+    # fails is reported and tried again later, rather than stopping the daemon.
+    while not stop_event.is_set():
+        try:
+            engine.sync(force)
+            force = False
+        except NoInternetConnection:
+            print('There is no internet connection, trying again later.')
+        except Exception as e:
+            print('Sync failed, trying again later: {}'.format(e), file=sys.stderr)
+        stop_event.wait(SYNC_CHECK_INTERVAL)
+
+"""
+Runs the sync engine without the GUI, using the same settings. `gpgsync sync`
+syncs once and exits, and `gpgsync --headless` keeps running and syncs on the
+configured schedule until it's interrupted or terminated. Bad arguments exit
+with EXIT_USAGE, like argparse does, and `gpgsync sync` exits with EXIT_OFFLINE
+if there's no internet connection, so a skipped sync isn't taken for a
+successful one. The daemon doesn't exit because of a failed sync.
+"""
+def main(argv):
+    parser = argparse.ArgumentParser(prog='gpgsync', description='Sync the public keys of every endpoint, without the GUI.')
+    parser.add_argument('command', nargs='?', choices=['sync'], help='sync once, and exit')
+    parser.add_argument('--headless', action='store_true', help='keep running, and sync on the configured schedule')
+    parser.add_argument('--force', action='store_true', help='check every fingerprint list, and refresh every key')
+    parser.add_argument('--debug', action='store_true', help='print debug output')
+    args = parser.parse_args(argv)
+    if (args.command == 'sync') == args.headless:
+        parser.error('use either sync or --headless')
+
+    settings = Settings(args.debug, headless=True)
+    sync_state = SyncState(settings.get_appdata_path(), args.debug)
+    common.session_manager.set_timeouts(settings.http_connect_timeout, settings.http_read_timeout)
+
+    gpg = GnuPG(appdata_path=settings.get_appdata_path(), debug=args.debug, persistent_homedir=settings.persistent_homedir)
+    if not gpg.is_gpg_available():
+        print('GnuPG 2.x doesn\'t seem to be installed.', file=sys.stderr)
+        return EXIT_NO_GPG
+
+    if len([e for e in settings.endpoints if e.verified]) == 0:
+        print('There are no endpoints to sync. Add one in GPG Sync first.', file=sys.stderr)
+        return EXIT_NO_ENDPOINTS
+
+    engine = SyncEngine(settings, gpg, sync_state, args.debug)
+    engine.message_callback = print_message
+    engine.import_signing_keys()
+
+    if args.command == 'sync':
+        try:
+            errors = engine.sync(args.force)
+        except NoInternetConnection:
+            print('There is no internet connection, so nothing was synced.', file=sys.stderr)
+            return EXIT_OFFLINE
+        finally:
+            settings.flush()
+
+        for e in errors:
+            print('Failed to sync endpoint {}: {}'.format(e.fingerprint.decode(), e.error), file=sys.stderr)
+        if len(errors) > 0:
+            return EXIT_SYNC_FAILED
+        return EXIT_OK
+
+    # Finish the current sync before stopping
+    stop_event = threading.Event()
+    def stop(signum, frame):
+        stop_event.set()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        run_daemon(engine, args.force, stop_event)
+    finally:
+        settings.flush()
+
+    return EXIT_OK
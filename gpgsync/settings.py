@@ -18,15 +18,31 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import os, json, pickle, platform
+import os, json, pickle, platform, threading
 import dateutil.parser as date_parser
 from . import common
 
 from .endpoint import Endpoint
 
+# Writes of the sync state that happen within this many seconds of each other
+# get saved to disk all at once
+STATE_SAVE_DELAY = 2
+
+"""
+User configuration is saved in settings.json, and state that changes on every
+sync, like when each endpoint was last checked and its errors and warnings, is
+saved in state.json. Both are written atomically, and only if they changed.
+"""
 class Settings(object):
-    def __init__(self, debug):
+    def __init__(self, debug, headless=False):
         self.debug = debug
+        # The headless sync engine doesn't start automatically with the desktop
+        self.headless = headless
+        self.state_lock = threading.Lock()
+        self.state_timer = None
+        self.saved_settings = None
+        self.saved_state = None
+        self.run_automatically_configured = None
 
         system = platform.system()
         if system == 'Windows':
@@ -48,15 +64,23 @@ class Settings(object):
     def get_appdata_path(self):
         return self.appdata_path
 
+    def get_settings_filename(self):
+        return os.path.join(self.appdata_path, 'settings.json')
+
+    def get_state_filename(self):
+        return os.path.join(self.appdata_path, 'state.json')
+
     def load(self):
         start_new_settings = False
-        settings_file = os.path.join(self.appdata_path, 'settings.json')
+        settings_file = self.get_settings_filename()
 
         # If the settings file exists, load it
         if os.path.isfile(settings_file):
             try:
                 # Parse the json file
-                self.settings = json.load(open(settings_file, 'r'))
+                data = open(settings_file, 'r').read()
+                self.settings = json.loads(data)
+                self.saved_settings = data
                 load_settings = True
                 self.log("load: settings loaded from {}".format(settings_file))
 
@@ -100,8 +124,33 @@ class Settings(object):
                     self.automatic_update_proxy_port = str.encode(self.settings['automatic_update_proxy_port'])
                 else:
                     self.automatic_update_proxy_port = b'9050'
+                if 'keyserver_batch_size' in self.settings:
+                    self.keyserver_batch_size = self.settings['keyserver_batch_size']
+                else:
+                    self.keyserver_batch_size = 100
+                if 'persistent_homedir' in self.settings:
+                    self.persistent_homedir = self.settings['persistent_homedir']
+                else:
+                    self.persistent_homedir = False
+                if 'http_connect_timeout' in self.settings:
+                    self.http_connect_timeout = self.settings['http_connect_timeout']
+                else:
+                    self.http_connect_timeout = 10
+                if 'http_read_timeout' in self.settings:
+                    self.http_read_timeout = self.settings['http_read_timeout']
+                else:
+                    self.http_read_timeout = 60
+                if 'max_concurrent_syncs' in self.settings:
+                    self.max_concurrent_syncs = self.settings['max_concurrent_syncs']
+                else:
+                    self.max_concurrent_syncs = 4
+                if 'prune_removed_keys' in self.settings:
+                    self.prune_removed_keys = self.settings['prune_removed_keys']
+                else:
+                    self.prune_removed_keys = False
 
-                self.configure_run_automatically()
+                if not self.headless:
+                    self.configure_run_automatically()
 
             except:
                 self.log("load: error loading settings file, starting from scratch")
@@ -127,8 +176,48 @@ class Settings(object):
             self.automatic_update_use_proxy = False
             self.automatic_update_proxy_host = b'127.0.0.1'
             self.automatic_update_proxy_port = b'9050'
+            self.keyserver_batch_size = 100
+            self.persistent_homedir = False
+            self.http_connect_timeout = 10
+            self.http_read_timeout = 60
+            self.max_concurrent_syncs = 4
+            self.prune_removed_keys = False
             self.save()
-            self.configure_run_automatically()
+
+        # The latest release from the last update check, and its ETag, so the
+        # next check can be a conditional request
+        self.update_etag = None
+        self.update_release = None
+
+        self.load_state()
+
+    def load_state(self):
+        # Older settings files have the state in them, so if there's no state
+        # file yet, keep what was loaded from settings and save it right away
+        state_file = self.get_state_filename()
+        if not os.path.isfile(state_file):
+            self.save_state()
+            self.flush()
+            return
+
+        try:
+            data = open(state_file, 'r').read()
+            state = json.loads(data)
+            self.saved_state = data
+            self.log("load_state: state loaded from {}".format(state_file))
+
+            for e in self.endpoints:
+                if e.get_state_key() in state['endpoints']:
+                    e.load_state(state['endpoints'][e.get_state_key()])
+            if state.get('last_update_check') is not None:
+                self.last_update_check = date_parser.parse(state['last_update_check'])
+            else:
+                self.last_update_check = None
+            self.last_update_check_err = state.get('last_update_check_err', False)
+            self.update_etag = state.get('update_etag')
+            self.update_release = state.get('update_release')
+        except:
+            self.log("load_state: error loading state file, ignoring it")
 
     def save(self):
         self.log("save")
@@ -136,24 +225,65 @@ class Settings(object):
             'endpoints': [e.serialize() for e in self.endpoints],
             'run_automatically': self.run_automatically,
             'run_autoupdate': self.run_autoupdate,
-            'last_update_check': self.last_update_check,
-            'last_update_check_err': self.last_update_check_err,
             'update_interval_hours': self.update_interval_hours,
             'automatic_update_use_proxy': self.automatic_update_use_proxy,
             'automatic_update_proxy_host': self.automatic_update_proxy_host,
-            'automatic_update_proxy_port': self.automatic_update_proxy_port
-
+            'automatic_update_proxy_port': self.automatic_update_proxy_port,
+            'keyserver_batch_size': self.keyserver_batch_size,
+            'persistent_homedir': self.persistent_homedir,
+            'http_connect_timeout': self.http_connect_timeout,
+            'http_read_timeout': self.http_read_timeout,
+            'max_concurrent_syncs': self.max_concurrent_syncs,
+            'prune_removed_keys': self.prune_removed_keys
         }
 
         if not os.path.exists(self.appdata_path):
             os.makedirs(self.appdata_path)
 
-        with open(os.path.join(self.appdata_path, 'settings.json'), 'w') as settings_file:
-            json.dump(self.settings, settings_file, default=common.serialize_settings, indent=4)
+        data = json.dumps(self.settings, default=common.serialize_settings, indent=4)
+        if data != self.saved_settings:
+            common.write_file_atomically(self.get_settings_filename(), data)
+            self.saved_settings = data
+
+        if not self.headless and self.run_automatically != self.run_automatically_configured:
+            self.configure_run_automatically()
 
-        self.configure_run_automatically()
+        # Endpoints might have been added or deleted
+        self.save_state()
         return True
 
+    def save_state(self):
+        # Save the state soon, along with any other changes that happen until then
+        with self.state_lock:
+            if self.state_timer is None:
+                self.state_timer = threading.Timer(STATE_SAVE_DELAY, self.flush)
+                self.state_timer.daemon = True
+                self.state_timer.start()
+
+    def flush(self):
+        # Save the state now, if it changed
+        with self.state_lock:
+            if self.state_timer is not None:
+                self.state_timer.cancel()
+                self.state_timer = None
+
+            state = {
+                'endpoints': {e.get_state_key(): e.serialize_state() for e in self.endpoints},
+                'last_update_check': self.last_update_check,
+                'last_update_check_err': self.last_update_check_err,
+                'update_etag': self.update_etag,
+                'update_release': self.update_release
+            }
+            data = json.dumps(state, default=common.serialize_settings)
+            if data == self.saved_state:
+                return
+
+            self.log("flush: saving state")
+            if not os.path.exists(self.appdata_path):
+                os.makedirs(self.appdata_path)
+            common.write_file_atomically(self.get_state_filename(), data)
+            self.saved_state = data
+
     def configure_run_automatically(self):
         self.log("configure_run_automatically")
 
@@ -168,6 +298,7 @@ class Settings(object):
             os.makedirs(autorun_dir)
 
         autorun_filename = os.path.join(autorun_dir, share_filename)
+        self.run_automatically_configured = self.run_automatically
 
         if self.run_automatically:
             buf = open(common.get_resource_path(share_filename)).read()
@@ -250,6 +381,12 @@ class Settings(object):
                     self.automatic_update_proxy_port = settings['automatic_update_proxy_port']
                 else:
                     self.automatic_update_proxy_port = b'9050'
+                self.keyserver_batch_size = 100
+                self.persistent_homedir = False
+                self.http_connect_timeout = 10
+                self.http_read_timeout = 60
+                self.max_concurrent_syncs = 4
+                self.prune_removed_keys = False
 
                 # Save the settings into new location, and delete the old settings file
                 self.save()
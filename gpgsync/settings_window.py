@@ -71,6 +71,26 @@ class SettingsLayout(QtWidgets.QVBoxLayout):
         update_interval_group = QtWidgets.QGroupBox("Sync frequency")
         update_interval_group.setLayout(update_interval_hlayout)
 
+        # Persistent homedir
+        self.persistent_homedir_checkbox = QtWidgets.QCheckBox("Keep GPG Sync's keyring between restarts (takes effect after restart)")
+        if self.settings.persistent_homedir:
+            self.persistent_homedir_checkbox.setCheckState(QtCore.Qt.Checked)
+        else:
+            self.persistent_homedir_checkbox.setCheckState(QtCore.Qt.Unchecked)
+
+        # Prune removed keys
+        self.prune_removed_keys_checkbox = QtWidgets.QCheckBox("Forget about keys that are removed from endpoints")
+        if self.settings.prune_removed_keys:
+            self.prune_removed_keys_checkbox.setCheckState(QtCore.Qt.Checked)
+        else:
+            self.prune_removed_keys_checkbox.setCheckState(QtCore.Qt.Unchecked)
+
+        keyring_vlayout = QtWidgets.QVBoxLayout()
+        keyring_vlayout.addWidget(self.persistent_homedir_checkbox)
+        keyring_vlayout.addWidget(self.prune_removed_keys_checkbox)
+        keyring_group = QtWidgets.QGroupBox("Keyring")
+        keyring_group.setLayout(keyring_vlayout)
+
         # SOCKS5 proxy settings
         self.use_proxy = QtWidgets.QCheckBox()
         self.use_proxy.setText("Check for updates through SOCKS5 proxy (e.g. Tor)")
@@ -105,6 +125,7 @@ class SettingsLayout(QtWidgets.QVBoxLayout):
 
         self.addWidget(autostart_group)
         self.addWidget(update_interval_group)
+        self.addWidget(keyring_group)
         if platform.system() != 'Linux':
             self.addWidget(autoupdate_group)
         self.addWidget(self.save_btn)
@@ -118,6 +139,8 @@ class SettingsLayout(QtWidgets.QVBoxLayout):
 
     def save_settings(self):
         self.settings.run_automatically = (self.run_automatically_checkbox.checkState() == QtCore.Qt.Checked)
+        self.settings.persistent_homedir = (self.persistent_homedir_checkbox.checkState() == QtCore.Qt.Checked)
+        self.settings.prune_removed_keys = (self.prune_removed_keys_checkbox.checkState() == QtCore.Qt.Checked)
         if platform.system() != 'Linux':
             self.settings.run_autoupdate = (self.run_autoupdate_checkbox.checkState() == QtCore.Qt.Checked)
             self.settings.automatic_update_use_proxy = (self.use_proxy.checkState() == QtCore.Qt.Checked)
@@ -18,7 +18,6 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import queue
 from PyQt5 import QtCore, QtWidgets
 
 from .loading_animation import LoadingAnimation
@@ -36,15 +35,3 @@ class StatusBar(QtWidgets.QStatusBar):
 
         def hide_loading(self):
             self.loading_animation.hide()
-
-
-class MessageQueue(queue.Queue):
-    def __init(self):
-        super(MessageQueue, self).__init__()
-
-    def add_message(self, msg=None, type='update', timeout=0):
-        self.put({
-            'type': type,
-            'msg': msg,
-            'timeout': timeout
-        })
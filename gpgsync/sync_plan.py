@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+GPG Sync
+Helps users have up-to-date public keys for everyone in their organization
+https://github.com/firstlookmedia/gpgsync
+Copyright (C) 2016 First Look Media
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib, threading, datetime
+
+from . import common
+from .gnupg import InvalidKeyserver, KeyserverError
+
+"""
+A plan for fetching the keys of every endpoint in one sync. Endpoints add the
+fingerprints they need once their lists are downloaded and verified, and then
+each fingerprint is fetched just once, even if several endpoints list it. A key
+is fetched over the route (keyserver and proxy settings) that most of the
+endpoints listing it share. If that route fails, the key is tried again over
+the next best one, and the results are attributed back to every endpoint that
+listed it. Every key that's fetched gets scheduled for its next refresh,
+refresh_interval seconds from now, give or take. Priority keys, such as ones
+that are expired or about to expire, are fetched before all the others.
+"""
+class SyncPlan(object):
+    def __init__(self, refresh_interval, batch_size=100):
+        self.refresh_interval = refresh_interval
+        self.batch_size = max(1, int(batch_size))
+        self.lock = threading.Lock()
+        self.endpoints = []
+        self.results = {}
+        self.failed_routes = {}
+        self.failed_keys = {}
+        self.import_results = {'new': 0, 'updated': 0, 'unchanged': 0}
+
+    def add_endpoint(self, e, fingerprints, invalid_fingerprints=[], removed_fingerprints=[], list_checked=True, priority_fingerprints=[], notfound_fingerprints=[]):
+        # list_checked is False if the endpoint's list wasn't checked this time
+        # around, and it only has keys that are due for a refresh.
+        # notfound_fingerprints are keys that weren't found on an earlier sync,
+        # and aren't due to be tried again yet.
+        with self.lock:
+            self.endpoints.append({
+                'e': e,
+                'fingerprints': [common.clean_fp(fp) for fp in fingerprints],
+                'invalid_fingerprints': list(invalid_fingerprints),
+                'removed_fingerprints': list(removed_fingerprints),
+                'list_checked': list_checked,
+                'priority_fingerprints': [common.clean_fp(fp) for fp in priority_fingerprints],
+                'notfound_fingerprints': [common.clean_fp(fp) for fp in notfound_fingerprints]
+            })
+
+    def get_endpoints(self):
+        with self.lock:
+            return [endpoint['e'] for endpoint in self.endpoints]
+
+    def is_list_checked(self, e):
+        endpoint = self._get_endpoint(e)
+        return endpoint is None or endpoint['list_checked']
+
+    def get_route(self, e):
+        return (e.keyserver, e.use_proxy, e.proxy_host, e.proxy_port)
+
+    def get_fetch_groups(self):
+        # Count, for each fingerprint that isn't fetched yet, how many of the
+        # endpoints listing it use each route that hasn't failed
+        with self.lock:
+            counts = {}
+            fps = []
+            for endpoint in self.endpoints:
+                route = self.get_route(endpoint['e'])
+                if route in self.failed_routes:
+                    continue
+                for fp in endpoint['fingerprints']:
+                    if fp in self.results or route in self.failed_keys.get(fp, {}):
+                        continue
+                    if fp not in counts:
+                        counts[fp] = []
+                        fps.append(fp)
+                    for route_count in counts[fp]:
+                        if route_count[0] == route:
+                            route_count[1] += 1
+                            break
+                    else:
+                        counts[fp].append([route, 1])
+
+            # Priority keys go first
+            priority_fps = set()
+            for endpoint in self.endpoints:
+                priority_fps.update(endpoint['priority_fingerprints'])
+            fps = [fp for fp in fps if fp in priority_fps] + [fp for fp in fps if fp not in priority_fps]
+
+            # Group fingerprints by their best route, favoring the first
+            # endpoint's route on a tie
+            groups = []
+            for fp in fps:
+                best_route = counts[fp][0]
+                for route_count in counts[fp]:
+                    if route_count[1] > best_route[1]:
+                        best_route = route_count
+
+                for route, group_fps in groups:
+                    if route == best_route[0]:
+                        group_fps.append(fp)
+                        break
+                else:
+                    groups.append((best_route[0], [fp]))
+            return groups
+
+    def execute(self, gpg, sync_state, log):
+        # Keep fetching until every key is either fetched, not found, or has
+        # no working route left
+        try:
+            groups = self.get_fetch_groups()
+            while len(groups) > 0:
+                for route, fps in groups:
+                    try:
+                        self.fetch_group(gpg, sync_state, route, fps, log)
+                    except InvalidKeyserver:
+                        self.failed_routes[route] = 'Invalid keyserver'
+                    except KeyserverError:
+                        self.failed_routes[route] = 'Keyserver error'
+                    if route in self.failed_routes:
+                        for fp in fps:
+                            if fp not in self.results:
+                                self.failed_keys.setdefault(fp, {})[route] = self.failed_routes[route]
+                groups = self.get_fetch_groups()
+
+            # Count a failure for each key that no route could fetch
+            for fp in self.failed_keys:
+                if fp not in self.results:
+                    sync_state.record_key_failure(fp)
+        finally:
+            sync_state.save()
+
+        fetched_count = len([fp for fp in self.results if self.results[fp] == 'fetched'])
+        log('{} of {} keys changed ({} new, {} updated)'.format(self.import_results['new'] + self.import_results['updated'], fetched_count, self.import_results['new'], self.import_results['updated']))
+
+    def fetch_group(self, gpg, sync_state, route, fps, log):
+        # Fetch fingerprints in batches, and commit each batch to the default homedir.
+        # Keep one connection to dirmngr open for the whole group, if possible.
+        keyserver, use_proxy, proxy_host, proxy_port = route
+        dirmngr = gpg.connect_dirmngr(keyserver)
+        try:
+            for i in range(0, len(fps), self.batch_size):
+                batch = fps[i:i+self.batch_size]
+                log('Fetching public keys {}-{} of {}'.format(i+1, i+len(batch), len(fps)))
+                fetched, notfound, failed = gpg.recv_keys(keyserver, batch, use_proxy, proxy_host, proxy_port, dirmngr)
+                for fp in failed:
+                    # Try these ones over another route, if there is one
+                    self.failed_keys.setdefault(fp, {})[route] = 'Keyserver error'
+                for fp in notfound:
+                    self.results[fp] = 'notfound'
+                    sync_state.schedule_not_found_key(fp, self.refresh_interval)
+
+                # Skip keys that are byte for byte the same as last time
+                keys = gpg.export_keys(fetched)
+                digests = {fp: hashlib.sha256(key).hexdigest() for fp, key in keys.items()}
+                changed = [fp for fp in fetched if fp not in digests or digests[fp] != sync_state.get_key(fp).get('digest')]
+                changed_set = set(changed)
+
+                # Schedule the next refresh, based on when each key expires
+                # and on whether it changed
+                now = datetime.datetime.now().isoformat()
+                for fp in fetched:
+                    self.results[fp] = 'fetched'
+                    if fp in changed_set:
+                        unchanged_count = 0
+                    else:
+                        unchanged_count = sync_state.get_key(fp).get('unchanged_count', 0) + 1
+                    sync_state.update_key(fp, last_fetched=now, expires=gpg.get_expiry(fp), unchanged_count=unchanged_count, failures=0, not_found_count=0, keyserver=keyserver.decode())
+                    sync_state.schedule_key(fp, self.refresh_interval)
+
+                for fp, result in gpg.import_to_default_homedir(changed, keys).items():
+                    self.import_results[result] += 1
+                    if result != 'unchanged':
+                        sync_state.update_key(fp, last_changed=now)
+                    if fp in digests:
+                        sync_state.update_key(fp, digest=digests[fp])
+        finally:
+            if dirmngr:
+                dirmngr.close()
+
+    def get_result(self, e):
+        # Returns (invalid_fingerprints, notfound_fingerprints,
+        # removed_fingerprints, err) for an endpoint. It only fails if some of
+        # its keys couldn't be fetched because of its own route, or failed on
+        # it, and no other route could fetch them.
+        endpoint = self._get_endpoint(e)
+        if endpoint is None:
+            return [], [], [], None
+
+        with self.lock:
+            notfound_fingerprints = endpoint['notfound_fingerprints'] + [fp for fp in endpoint['fingerprints'] if self.results.get(fp) == 'notfound']
+            unfetched = [fp for fp in endpoint['fingerprints'] if fp not in self.results]
+            route = self.get_route(e)
+            err = None
+            if len(unfetched) > 0 and route in self.failed_routes:
+                err = self.failed_routes[route]
+            else:
+                for fp in unfetched:
+                    if route in self.failed_keys.get(fp, {}):
+                        err = self.failed_keys[fp][route]
+                        break
+            return endpoint['invalid_fingerprints'], notfound_fingerprints, endpoint['removed_fingerprints'], err
+
+    def _get_endpoint(self, e):
+        with self.lock:
+            for endpoint in self.endpoints:
+                if endpoint['e'] is e:
+                    return endpoint
+            return None
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+GPG Sync
+Helps users have up-to-date public keys for everyone in their organization
+https://github.com/firstlookmedia/gpgsync
+Copyright (C) 2016 First Look Media
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os, json, threading, datetime, random, time, sqlite3
+import dateutil.parser as date_parser
+
+# Keys that expire within this many seconds (or expired this recently) get
+# refreshed more often, and keys that expire later than this many seconds
+# from now get refreshed less often if they don't change
+EXPIRY_SOON = 30*24*60*60
+EXPIRY_DISTANT = 365*24*60*60
+
+# Keys that aren't found on the keyserver are retried after the refresh
+# interval, then twice that, and so on, up to this many seconds
+NOT_FOUND_MAX_DELAY = 7*24*60*60
+
+# Each migration upgrades the database schema by one version
+MIGRATIONS = [
+    """
+    CREATE TABLE keys (
+        fingerprint TEXT PRIMARY KEY,
+        last_fetched TEXT,
+        last_changed TEXT,
+        next_refresh TEXT,
+        digest TEXT,
+        expires INTEGER,
+        failures INTEGER,
+        unchanged_count INTEGER,
+        keyserver TEXT
+    );
+    CREATE INDEX keys_next_refresh ON keys (next_refresh);
+    CREATE INDEX keys_last_changed ON keys (last_changed);
+
+    CREATE TABLE endpoints (
+        endpoint TEXT PRIMARY KEY,
+        list_verified TEXT,
+        url_validators TEXT,
+        sig_url_validators TEXT
+    );
+
+    CREATE TABLE endpoint_keys (
+        endpoint TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        PRIMARY KEY (endpoint, fingerprint)
+    );
+    CREATE INDEX endpoint_keys_fingerprint ON endpoint_keys (fingerprint);
+    """,
+    # failures used to count not found keys, now it counts keyserver errors
+    """
+    ALTER TABLE keys ADD COLUMN not_found_count INTEGER;
+    UPDATE keys SET not_found_count = failures, failures = NULL;
+    CREATE INDEX keys_not_found_count ON keys (not_found_count);
+    """
+]
+
+KEY_FIELDS = ['last_fetched', 'last_changed', 'next_refresh', 'digest', 'expires', 'failures', 'not_found_count', 'unchanged_count', 'keyserver']
+
+"""
+Per-fingerprint sync state, such as a digest of the key material that was last
+imported into the default homedir, and per-endpoint state, such as the last
+verified fingerprint list and its HTTP validators. It's kept out of
+settings.json in a SQLite database, because it grows with the number of keys,
+and changes on every sync. Changes are committed when it's saved.
+"""
+class SyncState(object):
+    def __init__(self, appdata_path=None, debug=False):
+        self.appdata_path = appdata_path
+        self.debug = debug
+        self.lock = threading.RLock()
+        self.load()
+
+    def log(self, msg):
+        if self.debug:
+            print("[SyncState] {}".format(msg))
+
+    def get_filename(self):
+        return os.path.join(self.appdata_path, 'sync_state.db')
+
+    def load(self):
+        with self.lock:
+            if not self.appdata_path:
+                self.db = self._connect(':memory:')
+                return
+
+            if not os.path.exists(self.appdata_path):
+                os.makedirs(self.appdata_path)
+
+            try:
+                self.db = self._connect(self.get_filename())
+            except sqlite3.DatabaseError:
+                # It's only a cache, so start over if it's broken
+                self.log("load: error loading sync state, starting from scratch")
+                os.remove(self.get_filename())
+                self.db = self._connect(self.get_filename())
+
+    def save(self):
+        with self.lock:
+            self.db.commit()
+
+    def _connect(self, filename):
+        # Refreshers use this from their own threads, always holding the lock
+        db = sqlite3.connect(filename, check_same_thread=False)
+        try:
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            for i in range(version, len(MIGRATIONS)):
+                self.log("_connect: migrating schema to version {}".format(i + 1))
+                db.executescript(MIGRATIONS[i])
+                db.execute('PRAGMA user_version = {}'.format(i + 1))
+            db.commit()
+        except sqlite3.DatabaseError:
+            # Don't leave it open, so the file can be removed
+            db.close()
+            raise
+        return db
+
+    def get_key(self, fp):
+        with self.lock:
+            row = self.db.execute('SELECT {} FROM keys WHERE fingerprint = ?'.format(', '.join(KEY_FIELDS)), (fp.decode(),)).fetchone()
+        if row is None:
+            return {}
+        return {field: value for field, value in zip(KEY_FIELDS, row) if value is not None}
+
+    def update_key(self, fp, **fields):
+        for field in fields:
+            if field not in KEY_FIELDS:
+                raise ValueError(field)
+
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO keys (fingerprint) VALUES (?)', (fp.decode(),))
+            if len(fields) > 0:
+                self.db.execute('UPDATE keys SET {} WHERE fingerprint = ?'.format(', '.join(['{} = ?'.format(field) for field in fields])),
+                    list(fields.values()) + [fp.decode()])
+
+    def forget_key(self, fp):
+        with self.lock:
+            self.db.execute('DELETE FROM keys WHERE fingerprint = ?', (fp.decode(),))
+
+    def get_due_keys(self, fps, interval):
+        # The same as key_is_due for each of fps, with two indexed queries
+        now = datetime.datetime.now()
+        cutoff = now - datetime.timedelta(seconds=interval)
+        with self.lock:
+            due = set([row[0] for row in self.db.execute('SELECT fingerprint FROM keys WHERE next_refresh <= ?', (now.isoformat(),))])
+            not_due = set([row[0] for row in self.db.execute('SELECT fingerprint FROM keys WHERE next_refresh > ? OR (next_refresh IS NULL AND last_fetched > ?)', (now.isoformat(), cutoff.isoformat()))])
+        return [fp for fp in fps if fp.decode() in due or fp.decode() not in not_due]
+
+    def get_changed_keys(self, since):
+        # Keys whose material changed since a datetime, oldest change first
+        with self.lock:
+            rows = self.db.execute('SELECT fingerprint FROM keys WHERE last_changed >= ? ORDER BY last_changed', (since.isoformat(),))
+            return [row[0].encode() for row in rows]
+
+    def schedule_key(self, fp, interval):
+        # The first time a key is scheduled it goes anywhere in the interval,
+        # so keys that were fetched together get spread out evenly. After that
+        # it's once per interval, with some jitter so they don't bunch up again.
+        interval = self.get_refresh_interval(fp, interval)
+        if 'next_refresh' in self.get_key(fp):
+            delay = interval * random.uniform(0.9, 1.1)
+        else:
+            delay = interval * random.uniform(0, 1)
+        next_refresh = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.update_key(fp, next_refresh=next_refresh.isoformat())
+
+    def schedule_not_found_key(self, fp, interval):
+        # Back off exponentially each time a key isn't found
+        not_found_count = self.get_key(fp).get('not_found_count', 0) + 1
+        delay = min(interval * 2**(not_found_count - 1), max(interval, NOT_FOUND_MAX_DELAY))
+        next_refresh = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.update_key(fp, failures=0, not_found_count=not_found_count, next_refresh=next_refresh.isoformat())
+
+    def record_key_failure(self, fp):
+        # Count consecutive syncs in which the keyserver failed to answer for
+        # a key. The key stays due, so it's tried again next sync.
+        self.update_key(fp, failures=self.get_key(fp).get('failures', 0) + 1)
+
+    def key_is_not_found(self, fp):
+        return self.get_key(fp).get('not_found_count', 0) > 0
+
+    def get_not_found_keys(self, fps):
+        # The same as key_is_not_found for each of fps, with one indexed query
+        with self.lock:
+            not_found = set([row[0] for row in self.db.execute('SELECT fingerprint FROM keys WHERE not_found_count > 0')])
+        return [fp for fp in fps if fp.decode() in not_found]
+
+    def get_refresh_interval(self, fp, interval):
+        # Keys around their expiry date get refreshed four times as often, in
+        # case they get extended. Keys that won't expire for a long time get
+        # backed off, up to twice the interval, while they stay unchanged.
+        key = self.get_key(fp)
+        if self.key_expires_soon(fp):
+            return interval / 4
+        expires = key.get('expires')
+        if 'last_fetched' in key and (expires is None or expires - time.time() > EXPIRY_DISTANT):
+            return interval * min(1 + 0.5 * key.get('unchanged_count', 0), 2)
+        return interval
+
+    def key_expires_soon(self, fp, expires=None):
+        # expires is used if the key's expiry isn't known yet
+        expires = self.get_key(fp).get('expires', expires)
+        return expires is not None and abs(expires - time.time()) < EXPIRY_SOON
+
+    def key_is_due(self, fp, interval):
+        # A key is due for a refresh once its next refresh time comes. Keys
+        # that were never scheduled are due if they've never been fetched, or
+        # if they were last fetched at least interval seconds ago.
+        key = self.get_key(fp)
+        try:
+            if 'next_refresh' in key:
+                return datetime.datetime.now() >= date_parser.parse(key['next_refresh'])
+            if 'last_fetched' in key:
+                return (datetime.datetime.now() - date_parser.parse(key['last_fetched'])).total_seconds() >= interval
+        except ValueError:
+            pass
+        return True
+
+    def get_endpoint(self, e):
+        with self.lock:
+            endpoint = self._endpoint_key(e)
+            row = self.db.execute('SELECT list_verified, url_validators, sig_url_validators FROM endpoints WHERE endpoint = ?', (endpoint,)).fetchone()
+            if row is None:
+                return {}
+
+            state = {}
+            if row[0] is not None:
+                rows = self.db.execute('SELECT fingerprint FROM endpoint_keys WHERE endpoint = ? ORDER BY position', (endpoint,))
+                state['fingerprints'] = [row[0] for row in rows]
+            if row[1] is not None:
+                state['url_validators'] = json.loads(row[1])
+            if row[2] is not None:
+                state['sig_url_validators'] = json.loads(row[2])
+            return state
+
+    def update_endpoint(self, e, **fields):
+        self._update_endpoint(self._endpoint_key(e), **fields)
+
+    def _update_endpoint(self, endpoint, fingerprints=None, url_validators=None, sig_url_validators=None):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO endpoints (endpoint) VALUES (?)', (endpoint,))
+            if fingerprints is not None:
+                self.db.execute('UPDATE endpoints SET list_verified = ? WHERE endpoint = ?', (datetime.datetime.now().isoformat(), endpoint))
+                self.db.execute('DELETE FROM endpoint_keys WHERE endpoint = ?', (endpoint,))
+                self.db.executemany('INSERT OR IGNORE INTO endpoint_keys (endpoint, fingerprint, position) VALUES (?, ?, ?)',
+                    [(endpoint, fp, i) for i, fp in enumerate(fingerprints)])
+            if url_validators is not None:
+                self.db.execute('UPDATE endpoints SET url_validators = ? WHERE endpoint = ?', (json.dumps(url_validators), endpoint))
+            if sig_url_validators is not None:
+                self.db.execute('UPDATE endpoints SET sig_url_validators = ? WHERE endpoint = ?', (json.dumps(sig_url_validators), endpoint))
+
+    def _endpoint_key(self, e):
+        return e.get_state_key()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+GPG Sync
+Helps users have up-to-date public keys for everyone in their organization
+https://github.com/firstlookmedia/gpgsync
+Copyright (C) 2016 First Look Media
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from urllib.parse import urlparse
+from PyQt5 import QtCore
+
+from . import common
+from .gnupg import *
+from .endpoint import Endpoint, URLDownloadError, ProxyURLDownloadError, InvalidFingerprints
+from .engine import NoInternetConnection
+
+class Verifier(QtCore.QThread):
+    alert_error = QtCore.pyqtSignal(str, str)
+    success = QtCore.pyqtSignal(bytes, bytes, bytes, bool, bytes, bytes)
+    message = QtCore.pyqtSignal(object, int)
+
+    def __init__(self, debug, gpg, fingerprint, url, keyserver, use_proxy, proxy_host, proxy_port):
+        super(Verifier, self).__init__()
+        self.debug = debug
+        self.gpg = gpg
+        self.fingerprint = fingerprint
+        self.url = url
+        self.sig_url = self.url + b'.sig'
+        self.keyserver = keyserver
+        self.use_proxy = use_proxy
+        self.proxy_host = proxy_host
+        self.proxy_port = proxy_port
+
+    def finish_with_failure(self):
+        self.message.emit(None, 0)
+        self.finished.emit()
+
+    def log(self, message, timeout=0):
+        if self.debug:
+            print("[Verifier] {}".format(message))
+
+        self.message.emit(message, timeout)
+
+    def run(self):
+        print("Verifying endpoint with authority key {}".format(self.fingerprint.decode()))
+
+        # Make an endpoint
+        e = Endpoint()
+        e.fingerprint = self.fingerprint
+        e.url = self.url
+        e.sig_url = self.sig_url
+        e.keyserver = self.keyserver
+        e.use_proxy = self.use_proxy
+        e.proxy_host = self.proxy_host
+        e.proxy_port = self.proxy_port
+
+        # Test loading URL
+        success = False
+        try:
+            self.log('Testing downloading URL {}'.format(self.url.decode()))
+            msg_bytes = e.fetch_msg_url()
+        except ProxyURLDownloadError as e:
+            self.alert_error.emit('URL failed to download: Check your internet connection and proxy settings.', str(e))
+        except URLDownloadError as e:
+            self.alert_error.emit('URL failed to download: Check your internet connection.', str(e))
+        else:
+            success = True
+
+        if not success:
+            return self.finish_with_failure()
+
+        # Test loading signature URL
+        success = False
+        try:
+            self.log('Testing downloading URL {}'.format(self.sig_url.decode()))
+            msg_sig_bytes = e.fetch_msg_sig_url()
+        except ProxyURLDownloadError as e:
+            self.alert_error.emit('URL failed to download: Check your internet connection and proxy settings.', str(e))
+        except URLDownloadError as e:
+            self.alert_error.emit('URL failed to download: Check your internet connection.', str(e))
+        else:
+            success = True
+
+        if not success:
+            return self.finish_with_failure()
+
+        # Test fingerprint and keyserver, and that the key isn't revoked or expired
+        success = False
+        try:
+            self.log('Downloading {} from keyserver {}'.format(common.fp_to_keyid(self.fingerprint).decode(), self.keyserver.decode()))
+            e.fetch_public_key(self.gpg)
+        except InvalidFingerprint:
+            self.alert_error.emit('Invalid signing key fingerprint.', '')
+        except InvalidKeyserver:
+            self.alert_error.emit('Invalid keyserver.', '')
+        except KeyserverError:
+            self.alert_error.emit('Error with keyserver {}.'.format(self.keyserver.decode()), '')
+        except NotFoundOnKeyserver:
+            self.alert_error.emit('Signing key is not found on keyserver. Upload signing key and try again.', '')
+        except NotFoundInKeyring:
+            self.alert_error.emit('Signing key is not found in keyring. Something went wrong.', '')
+        except RevokedKey:
+            self.alert_error.emit('The signing key is revoked.', '')
+        except ExpiredKey:
+            self.alert_error.emit('The signing key is expired.', '')
+        else:
+            success = True
+
+        if not success:
+            return self.finish_with_failure()
+
+        # Make sure URL is in the right format
+        success = False
+        o = urlparse(self.url)
+        if (o.scheme != b'http' and o.scheme != b'https') or o.netloc == '':
+            self.alert_error.emit('URL is invalid.', '')
+        else:
+            success = True
+
+        if not success:
+            return self.finish_with_failure()
+
+        # After downloading URL, test that it's signed by signing key
+        success = False
+        try:
+            self.log('Verifying signature')
+            e.verify_fingerprints_sig(self.gpg, msg_sig_bytes, msg_bytes)
+        except VerificationError:
+            self.alert_error.emit('Signature does not verify.', '')
+        except BadSignature:
+            self.alert_error.emit('Bad signature.', '')
+        except RevokedKey:
+            self.alert_error.emit('The signing key is revoked.', '')
+        except SignedWithWrongKey:
+            self.alert_error.emit('Valid signature, but signed with wrong signing key.', '')
+        else:
+            success = True
+
+        if not success:
+            return self.finish_with_failure()
+
+        # Test that it's a list of fingerprints
+        success = False
+        try:
+            self.log('Validating fingerprint list')
+            e.get_fingerprint_list(msg_bytes)
+        except InvalidFingerprints as e:
+            self.alert_error.emit('Invalid fingerprints', str(e))
+        else:
+            success = True
+
+        if not success:
+            return self.finish_with_failure()
+
+        self.log('Endpoint saved', 4000)
+        self.success.emit(self.fingerprint, self.url, self.keyserver, self.use_proxy, self.proxy_host, self.proxy_port)
+        self.finished.emit()
+
+"""
+Runs a sync with the sync engine in the background. The engine's callbacks get
+called from its own threads, so they're turned into signals here, which reach
+the GUI in its thread.
+"""
+class SyncThread(QtCore.QThread):
+    message = QtCore.pyqtSignal(object, int)
+    progress = QtCore.pyqtSignal(str)
+    endpoint_updated = QtCore.pyqtSignal(object)
+
+    def __init__(self, engine, force=False):
+        super(SyncThread, self).__init__()
+        self.engine = engine
+        self.force = force
+        self.errors = []
+
+        self.engine.message_callback = self.message.emit
+        self.engine.progress_callback = self.progress.emit
+        self.engine.endpoint_updated_callback = self.endpoint_updated.emit
+
+    def run(self):
+        try:
+            errors = self.engine.sync(self.force)
+        except NoInternetConnection:
+            # Try again next time
+            return
+        if errors is not None:
+            self.errors = errors
+
+"""
+Checks GitHub for the latest release in the background, so a slow network or
+proxy never holds up the GUI. If the last check saved the release's ETag, it
+asks for the release only if it changed, and a 304 response means the saved
+release is still the latest one.
+"""
+class UpdateChecker(QtCore.QThread):
+    # The latest release and its ETag, or None and None if the request failed
+    checked = QtCore.pyqtSignal(object, object)
+
+    url = 'https://api.github.com/repos/firstlookmedia/gpgsync/releases/latest'
+
+    def __init__(self, debug, use_proxy, proxy_host, proxy_port, etag=None, release=None):
+        super(UpdateChecker, self).__init__()
+        self.debug = debug
+        self.use_proxy = use_proxy
+        self.proxy_host = proxy_host
+        self.proxy_port = proxy_port
+        self.etag = etag
+        self.release = release
+
+    def log(self, message):
+        if self.debug:
+            print("[UpdateChecker] {}".format(message))
+
+    def run(self):
+        import requests
+
+        headers = {}
+        if self.etag and self.release:
+            headers['If-None-Match'] = self.etag
+
+        try:
+            self.log("loading {}".format(self.url))
+            if self.use_proxy:
+                socks5_address = 'socks5://{}:{}'.format(self.proxy_host.decode(), self.proxy_port.decode())
+
+                proxies = {
+                  'https': socks5_address,
+                  'http': socks5_address
+                }
+
+                r = common.requests_get(self.url, proxies=proxies, headers=headers)
+            else:
+                r = common.requests_get(self.url, headers=headers)
+
+            if r.status_code == 304:
+                self.log("release hasn't changed")
+                release = self.release
+                etag = self.etag
+            else:
+                release = r.json()
+                etag = r.headers.get('ETag')
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.log("exception making http request: {}".format(e))
+            self.checked.emit(None, None)
+            return
+
+        self.checked.emit(release, etag)
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os, tempfile
 from nose import with_setup
 from gpgsync import common
 
@@ -29,3 +30,39 @@ def test_clean_keyserver():
     assert common.clean_keyserver(b'hkp://pgp.mit.edu') == b'hkp://pgp.mit.edu'
     assert common.clean_keyserver(b'hkps://hkps.pool.sks-keyservers.net') == b'hkps://hkps.pool.sks-keyservers.net'
     assert common.clean_keyserver(b'ldap://somekeyserver') == b'ldap://somekeyserver'
+
+def test_session_manager_get_session():
+    session_manager = common.SessionManager()
+    proxies = {'https': 'socks5://127.0.0.1:9050', 'http': 'socks5://127.0.0.1:9050'}
+
+    # Sessions are shared for the same proxies and verify
+    assert session_manager.get_session() is session_manager.get_session()
+    assert session_manager.get_session(proxies) is session_manager.get_session(dict(proxies))
+    assert session_manager.get_session(proxies) is not session_manager.get_session()
+    assert session_manager.get_session(verify='cacert.pem') is not session_manager.get_session()
+    assert len(session_manager.get_stats()) == 3
+
+def test_write_file_atomically():
+    tmp_dir = tempfile.TemporaryDirectory()
+    filename = os.path.join(tmp_dir.name, 'settings.json')
+
+    common.write_file_atomically(filename, 'first')
+    common.write_file_atomically(filename, 'second')
+    assert open(filename).read() == 'second'
+
+    # No temporary files get left behind
+    assert os.listdir(tmp_dir.name) == ['settings.json']
+
+    tmp_dir.cleanup()
+
+def test_startup_profile():
+    profile = common.StartupProfile(True)
+    profile.mark('First step')
+    profile.mark('Second step')
+    assert [step for step, seconds in profile.steps] == ['First step', 'Second step']
+    assert all(seconds >= 0 for step, seconds in profile.steps)
+
+    # Disabled profiles don't record anything
+    profile = common.StartupProfile()
+    profile.mark('First step')
+    assert profile.steps == []
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtCore, QtWidgets
+from gpgsync.gnupg import GnuPG
+from gpgsync.endpoint import Endpoint
+from gpgsync.endpoint_selection import EndpointListModel, EndpointDelegate
+
+from .test_helpers import *
+
+def make_endpoint(fingerprint):
+    e = Endpoint()
+    e.verified = True
+    e.fingerprint = fingerprint
+    return e
+
+def test_endpoint_list_model_prefetches_uids():
+    gpg = GnuPG(debug=True)
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+    import_key('pgpsync_multiple_uids.asc', gpg.homedir)
+
+    # Every uid is looked up at once
+    get_uids_calls = []
+    get_uids = gpg.get_uids
+    gpg.get_uids = lambda fps: get_uids_calls.append(fps) or get_uids(fps)
+
+    e1 = make_endpoint(test_key_fp)
+    e2 = make_endpoint(b'D86B 4D4B B5DF DD37 8B58  D4D3 F121 AC62 3039 6C33')
+    model = EndpointListModel(gpg)
+    model.load_endpoints([e1, e2, Endpoint()])
+    assert len(get_uids_calls) == 1
+    assert model.rowCount() == 3
+    assert model.data(model.index(0), EndpointListModel.uid_role) == 'GPG Sync Unit Test Key (not secure in any way)'
+    assert model.data(model.index(1), EndpointListModel.uid_role) == 'PGP Sync Test uid 3 <pgpsync-uid3@example.com>'
+    assert model.data(model.index(2), EndpointListModel.uid_role) == ''
+
+    # Reloading an endpoint doesn't look its uid up again
+    model.reload_endpoint(e1)
+    assert len(get_uids_calls) == 1
+
+    model.delete_endpoint(e2)
+    assert model.rowCount() == 2
+    assert model.data(model.index(0), EndpointListModel.endpoint_role) is e1
+
+def test_endpoint_delegate_size_hint():
+    # Font metrics need a QApplication, even when not run by nose
+    setup_qt()
+    gpg = GnuPG(debug=True)
+    e = make_endpoint(test_key_fp)
+    model = EndpointListModel(gpg)
+    model.load_endpoints([e])
+    delegate = EndpointDelegate()
+    option = QtWidgets.QStyleOptionViewItem()
+    height = delegate.sizeHint(option, model.index(0)).height()
+
+    # Warnings add a line
+    e.warning = 'Not found fingerprints'
+    assert delegate.sizeHint(option, model.index(0)).height() > height
+    assert model.data(model.index(0), QtCore.Qt.ToolTipRole) == 'Warning: Not found fingerprints'
+
+def test_endpoint_list_model_known_uids():
+    gpg = GnuPG(debug=True)
+    get_uids_calls = []
+    gpg.get_uids = lambda fps: get_uids_calls.append(fps) or {}
+
+    # The uids imported along with the signing keys are used as is
+    e = make_endpoint(test_key_fp)
+    model = EndpointListModel(gpg)
+    model.load_endpoints([e], {test_key_fp: 'GPG Sync Unit Test Key'})
+    assert get_uids_calls == []
+    assert model.data(model.index(0), EndpointListModel.uid_role) == 'GPG Sync Unit Test Key'
@@ -14,6 +14,18 @@ def test_fetch_url_invalid_url():
     e = Endpoint()
     e.fetch_url('https://somethingfake')
 
+def test_fetch_url_conditional():
+    e = Endpoint()
+    url = 'https://raw.githubusercontent.com/firstlookmedia/gpgsync/master/fingerprints/fingerprints.txt'
+    msg_bytes, validators = e.fetch_url_conditional(url)
+    assert msg_bytes is not None
+    assert validators['etag'] is not None
+
+    # Not modified since the last download
+    msg_bytes, validators2 = e.fetch_url_conditional(url, validators)
+    assert msg_bytes is None
+    assert validators2 == validators
+
 @raises(ProxyURLDownloadError)
 def test_fetch_url_valid_url_invalid_proxy():
     # Assuming 127.0.0.1:9988 is not a valid SOCKS5 proxy...
@@ -43,3 +55,18 @@ def test_get_fingerprint_list_valid():
 def test_get_fingerprint_list_invalid_fingerprints():
     e = Endpoint()
     e.get_fingerprint_list(get_endpoint_file_content('invalid_fingerprints.txt'))
+
+def test_endpoint_serialize_state():
+    e = Endpoint()
+    e.fingerprint = test_key_fp
+    e.last_checked = datetime.datetime(2017, 3, 3)
+    e.warning = 'Not found fingerprints'
+
+    # State is kept out of the configuration
+    assert 'last_checked' not in e.serialize()
+    assert 'warning' not in e.serialize()
+
+    e2 = Endpoint().load_state(e.serialize_state())
+    assert e2.last_checked == datetime.datetime(2017, 3, 3)
+    assert e2.last_synced is None
+    assert e2.warning == 'Not found fingerprints'
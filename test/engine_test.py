@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import time, threading
+from nose import with_setup
+from nose.tools import raises
+from gpgsync.engine import SyncEngine, NoInternetConnection
+from gpgsync.gnupg import GnuPG
+from gpgsync.endpoint import Endpoint
+from gpgsync.sync_state import SyncState
+from gpgsync import common, headless
+
+from .test_helpers import *
+
+class EngineSettings(object):
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.prune_removed_keys = False
+        self.saved_state_count = 0
+
+    def save_state(self):
+        self.saved_state_count += 1
+
+def make_engine(endpoints=[]):
+    settings = EngineSettings(endpoints)
+    engine = SyncEngine(settings, None, SyncState())
+    messages = []
+    updated = []
+    engine.message_callback = lambda msg, timeout: messages.append(msg)
+    engine.endpoint_updated_callback = updated.append
+    return engine, messages, updated
+
+def test_engine_sync_without_endpoints():
+    engine, messages, updated = make_engine([Endpoint()])
+    assert engine.sync() == []
+
+def test_engine_sync_already_running():
+    engine, messages, updated = make_engine()
+    engine.sync_lock.acquire()
+    assert engine.sync() is None
+    engine.sync_lock.release()
+
+def test_engine_endpoint_failed():
+    e = Endpoint()
+    engine, messages, updated = make_engine([e])
+    engine.endpoint_failed(e, 'Bad signature', False)
+
+    assert engine.errors == [e]
+    assert e.error == 'Bad signature'
+    assert e.last_failed is not None
+    assert e.last_checked is None
+    assert messages == [None]
+    assert updated == [e]
+    assert engine.settings.saved_state_count == 1
+
+def test_engine_endpoint_succeeded():
+    e = Endpoint()
+    e.error = 'Bad signature'
+    engine, messages, updated = make_engine([e])
+    engine.endpoint_succeeded(e, [], [], [test_key_fp])
+
+    assert e.error is None
+    assert e.warning == 'Removed fingerprints {}'.format([test_key_fp])
+    assert e.last_checked is not None
+    assert e.last_synced is not None
+    assert updated == [e]
+
+@raises(SystemExit)
+def test_headless_usage():
+    # Either sync once, or keep running, but not both
+    headless.main(['sync', '--headless'])
+
+class FlakyEngine(object):
+    def __init__(self, stop_event):
+        self.stop_event = stop_event
+        self.forced = []
+
+    def sync(self, force=False):
+        self.forced.append(force)
+        if len(self.forced) == 1:
+            raise ValueError('unexpected')
+        if len(self.forced) == 2:
+            raise NoInternetConnection()
+        self.stop_event.set()
+
+def test_headless_daemon_keeps_running():
+    stop_event = threading.Event()
+    engine = FlakyEngine(stop_event)
+    sync_check_interval = headless.SYNC_CHECK_INTERVAL
+    headless.SYNC_CHECK_INTERVAL = 0
+    try:
+        headless.run_daemon(engine, True, stop_event)
+    finally:
+        headless.SYNC_CHECK_INTERVAL = sync_check_interval
+
+    # Failed syncs are tried again, still forced until one works
+    assert engine.forced == [True, True, True]
+
+@raises(NoInternetConnection)
+def test_engine_sync_offline():
+    e = Endpoint()
+    e.verified = True
+    engine, messages, updated = make_engine([e])
+
+    # Nothing gets synced, and that isn't reported as a success
+    internet_available = common.internet_available
+    common.internet_available = lambda: False
+    try:
+        engine.sync()
+    finally:
+        common.internet_available = internet_available
+        assert not engine.sync_lock.locked()
+
+def test_engine_sort_fingerprints_expired():
+    expired_fp = b'30996DFF545AD6A02462639624C6564F385E35F8'
+    gpg = GnuPG(debug=True)
+    import_key('expired_pubkey.asc', gpg.homedir)
+    engine = SyncEngine(EngineSettings([]), gpg, SyncState())
+
+    # This key expired years ago, so it doesn't get priority
+    assert engine.sort_fingerprints([test_key_fp, expired_fp]) == ([test_key_fp, expired_fp], [], [])
+
+    # Keys that expired recently do
+    engine.sync_state.update_key(expired_fp, expires=int(time.time()) - 24*60*60)
+    assert engine.sort_fingerprints([test_key_fp, expired_fp]) == ([expired_fp, test_key_fp], [expired_fp], [])
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import tempfile, os
+import tempfile, os, shutil
 from nose import with_setup
 from nose.tools import raises
 from gpgsync import *
@@ -11,11 +11,180 @@ def test_gpg_is_available():
     gpg = GnuPG(debug=True)
     assert gpg.is_gpg_available()
 
+def test_gpg_persistent_homedir():
+    appdata = tempfile.TemporaryDirectory()
+    gpg = GnuPG(appdata_path=appdata.name, debug=True, persistent_homedir=True)
+    assert gpg.persistent_homedir
+    assert gpg.homedir == os.path.join(appdata.name, 'homedir')
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+
+    # While it's locked, other instances fall back to a temporary homedir
+    gpg2 = GnuPG(appdata_path=appdata.name, debug=True, persistent_homedir=True)
+    assert not gpg2.persistent_homedir
+    assert not gpg2.in_keyring(test_key_fp)
+    del gpg2
+
+    # After it's unlocked, the keyring gets reused
+    del gpg
+    gpg = GnuPG(appdata_path=appdata.name, debug=True, persistent_homedir=True)
+    assert gpg.persistent_homedir
+    assert gpg.in_keyring(test_key_fp)
+    del gpg
+
+    appdata.cleanup()
+
 def test_gpg_recv_key(debug=True):
     gpg = GnuPG()
     gpg.recv_key(b'hkp://keys.gnupg.net', test_key_fp, False, None, None)
     assert gpg.get_uid(test_key_fp) == 'GPG Sync Unit Test Key (not secure in any way)'
 
+def test_gpg_recv_keys():
+    gpg = GnuPG(debug=True)
+    notfound_fp = b'0000000000000000000000000000000000000000'
+    fetched, notfound, failed = gpg.recv_keys(b'hkp://keys.gnupg.net', [test_key_fp, notfound_fp], False, None, None)
+    assert fetched == [test_key_fp]
+    assert notfound == [notfound_fp]
+    assert failed == []
+    assert gpg.get_uid(test_key_fp) == 'GPG Sync Unit Test Key (not secure in any way)'
+
+def fake_recv_keys(gpg, results):
+    # Answer --recv-keys from results, which maps each fingerprint to
+    # 'fetched', 'notfound' or 'error', with one error line for each key
+    # that isn't fetched, like gpg does for a batch
+    calls = []
+    def _gpg(args, input=None, pass_fds=()):
+        fps = args[args.index('--recv-keys')+1:]
+        calls.append(fps)
+        out = b''
+        err = b''
+        for fp in fps:
+            if results[fp] == 'fetched':
+                out += b'[GNUPG:] IMPORT_OK 1 ' + fp + b'\n'
+            elif results[fp] == 'notfound':
+                err += b'gpg: keyserver receive failed: No data\n'
+            else:
+                err += b'gpg: keyserver receive failed: Server indicated a failure\n'
+        return out, err
+    gpg._gpg = _gpg
+    return calls
+
+def test_gpg_recv_keys_mixed_errors():
+    gpg = GnuPG(debug=True)
+    fetched_fp = b'A' * 40
+    notfound_fp = b'B' * 40
+    error_fp = b'C' * 40
+    calls = fake_recv_keys(gpg, {fetched_fp: 'fetched', notfound_fp: 'notfound', error_fp: 'error'})
+
+    # A key that failed isn't taken for one that isn't on the keyserver, and
+    # doesn't lose the keys that were fetched with it
+    fetched, notfound, failed = gpg.recv_keys(b'hkp://keys.gnupg.net', [fetched_fp, notfound_fp, error_fp], False, None, None)
+    assert fetched == [fetched_fp]
+    assert notfound == [notfound_fp]
+    assert failed == [error_fp]
+    assert calls == [[fetched_fp, notfound_fp, error_fp], [notfound_fp], [error_fp]]
+
+    # When no key could be fetched, the error is raised
+    calls = fake_recv_keys(gpg, {error_fp: 'error'})
+    try:
+        gpg.recv_keys(b'hkp://keys.gnupg.net', [error_fp], False, None, None)
+        assert False
+    except KeyserverError:
+        pass
+
+    # When every missing key just isn't on the keyserver, there's no bisecting
+    notfound2_fp = b'D' * 40
+    calls = fake_recv_keys(gpg, {fetched_fp: 'fetched', notfound_fp: 'notfound', notfound2_fp: 'notfound'})
+    assert gpg._recv_keys_batch('hkp://keys.gnupg.net', [fetched_fp, notfound_fp, notfound2_fp]) == ([fetched_fp], [notfound_fp, notfound2_fp], {})
+    assert len(calls) == 1
+
+def test_gpg_recv_keys_dirmngr():
+    gpg = GnuPG(debug=True)
+    dirmngr = gpg.connect_dirmngr(b'hkp://keys.gnupg.net')
+    notfound_fp = b'0000000000000000000000000000000000000000'
+    fetched, notfound, failed = gpg.recv_keys(b'hkp://keys.gnupg.net', [test_key_fp, notfound_fp], False, None, None, dirmngr)
+    dirmngr.close()
+    assert fetched == [test_key_fp]
+    assert notfound == [notfound_fp]
+    assert failed == []
+
+def test_dearmor():
+    pubkey = open(get_gpg_file('gpgsync_test_pubkey.asc'), 'rb').read()
+    key = dearmor(pubkey)
+    assert list(split_keys(key).keys()) == [test_key_fp]
+
+    # Without armor headers, with CRLF line endings, and binary keys as is
+    assert dearmor(pubkey.replace(b'Version: GnuPG v2\n', b'')) == key
+    assert dearmor(pubkey.replace(b'\n', b'\r\n')) == key
+    assert dearmor(key) == key
+
+    try:
+        dearmor(b'not a key')
+        assert False
+    except ValueError:
+        pass
+
+class FakeDirmngr(object):
+    def __init__(self, responses, errors={}):
+        self.keyserver = 'hkp://keys.gnupg.net'
+        self.responses = responses
+        self.errors = errors
+
+    def ks_get(self, fp):
+        if fp in self.errors:
+            raise self.errors[fp]
+        if fp not in self.responses:
+            raise NotFoundOnKeyserver(fp)
+        return self.responses[fp]
+
+def test_gpg_recv_keys_dirmngr_filters_keys():
+    gpg = GnuPG(debug=True)
+    other_fp = b'D86B4D4BB5DFDD378B58D4D3F121AC6230396C33'
+    notfound_fp = b'0' * 40
+    unparsed_fp = b'A' * 40
+    pubkey = open(get_gpg_file('gpgsync_test_pubkey.asc'), 'rb').read()
+    other_pubkey = open(get_gpg_file('pgpsync_multiple_uids.asc'), 'rb').read()
+
+    # Keys that couldn't be parsed are received with gpg
+    recv_keys_batch_calls = []
+    gpg._recv_keys_batch = lambda keyserver, fps: recv_keys_batch_calls.append(fps) or ([], fps, {})
+
+    # Only the keys that were asked for get imported
+    dirmngr = FakeDirmngr({
+        test_key_fp: pubkey + other_pubkey,
+        notfound_fp: other_pubkey,
+        unparsed_fp: b'not a key'
+    })
+    fetched, notfound, failed = gpg.recv_keys(b'hkp://keys.gnupg.net', [test_key_fp, notfound_fp, unparsed_fp], False, None, None, dirmngr)
+    assert fetched == [test_key_fp]
+    assert notfound == [notfound_fp, unparsed_fp]
+    assert failed == []
+    assert recv_keys_batch_calls == [[unparsed_fp]]
+    assert gpg.in_keyring(test_key_fp)
+    assert not gpg.in_keyring(other_fp)
+
+def test_gpg_recv_keys_dirmngr_keyserver_error():
+    gpg = GnuPG(debug=True)
+    error_fp = b'A' * 40
+    notfound_fp = b'0' * 40
+    pubkey = open(get_gpg_file('gpgsync_test_pubkey.asc'), 'rb').read()
+
+    # A key that fails in the middle of a batch doesn't lose the others
+    dirmngr = FakeDirmngr({test_key_fp: pubkey}, {error_fp: KeyserverError(error_fp)})
+    fetched, notfound, failed = gpg.recv_keys(b'hkp://keys.gnupg.net', [notfound_fp, error_fp, test_key_fp], False, None, None, dirmngr)
+    assert fetched == [test_key_fp]
+    assert notfound == [notfound_fp]
+    assert failed == [error_fp]
+    assert gpg.in_keyring(test_key_fp)
+
+@raises(InvalidKeyserver)
+def test_gpg_recv_keys_dirmngr_invalid_keyserver():
+    gpg = GnuPG(debug=True)
+    dirmngr = gpg.connect_dirmngr(b'hkp://127.0.0.1:1')
+    try:
+        gpg.recv_keys(b'hkp://127.0.0.1:1', [test_key_fp], False, None, None, dirmngr)
+    finally:
+        dirmngr.close()
+
 @raises(InvalidKeyserver)
 def test_gpg_recv_key_invalid_keyserver():
     gpg = GnuPG(debug=True)
@@ -57,6 +226,179 @@ def test_gpg_get_uid():
     assert gpg.get_uid(b'D86B 4D4B B5DF DD37 8B58  D4D3 F121 AC62 3039 6C33') == 'PGP Sync Test uid 3 <pgpsync-uid3@example.com>'
     assert gpg.get_uid(b'3B72 C32B 49CB B5BB DD57  440E 1D07 D434 48FB 8382') == 'GPG Sync Unit Test Key (not secure in any way)'
 
+def test_gpg_get_uids():
+    gpg = GnuPG(debug=True)
+    import_key('pgpsync_multiple_uids.asc', gpg.homedir)
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+
+    # Keys that aren't in the keyring get an empty uid
+    assert gpg.get_uids([b'D86B 4D4B B5DF DD37 8B58  D4D3 F121 AC62 3039 6C33', test_key_fp, b'0' * 40]) == {
+        b'D86B4D4BB5DFDD378B58D4D3F121AC6230396C33': 'PGP Sync Test uid 3 <pgpsync-uid3@example.com>',
+        test_key_fp: 'GPG Sync Unit Test Key (not secure in any way)',
+        b'0' * 40: ''
+    }
+
+def test_gpg_keyring_index():
+    gpg = GnuPG(debug=True)
+    import_key('expired_pubkey.asc', gpg.homedir)
+
+    key = gpg.index.get(b'30996DFF545AD6A02462639624C6564F385E35F8')
+    assert key.validity == b'e'
+    assert key.expires == 1488589318
+    assert key.last_modified == 1488502918
+    assert key.uids == ['Expired Key <expired@example.com>']
+    assert [subkey['fp'] for subkey in key.subkeys] == [b'80551D1111E169137435F2CD6466C7378A8D030C']
+    assert gpg.index.get(test_key_fp) is None
+
+    # The index gets rebuilt when the keyring changes
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+    assert gpg.index.get(test_key_fp).uids == ['GPG Sync Unit Test Key (not secure in any way)']
+
+def test_gpg_get_expiry():
+    gpg = GnuPG(debug=True)
+    import_key('expired_pubkey.asc', gpg.homedir)
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+
+    assert gpg.get_expiry(b'30996DFF545AD6A02462639624C6564F385E35F8') == 1488589318
+    assert gpg.get_expiry(test_key_fp) is None
+
+def test_gpg_import_to_default_homedir():
+    default_homedir = tempfile.TemporaryDirectory()
+    os.environ['GNUPGHOME'] = default_homedir.name
+
+    gpg = GnuPG(debug=True)
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+    import_key('expired_pubkey.asc', gpg.homedir)
+    expired_fp = b'30996DFF545AD6A02462639624C6564F385E35F8'
+
+    assert gpg.import_to_default_homedir([test_key_fp]) == {test_key_fp: 'new'}
+    assert gpg.import_to_default_homedir([test_key_fp, expired_fp]) == {test_key_fp: 'unchanged', expired_fp: 'new'}
+
+    del os.environ['GNUPGHOME']
+    default_homedir.cleanup()
+
+def test_gpg_export_keys():
+    gpg = GnuPG(debug=True)
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+    import_key('pgpsync_multiple_uids.asc', gpg.homedir)
+    key2_fp = b'D86B4D4BB5DFDD378B58D4D3F121AC6230396C33'
+
+    keys = gpg.export_keys([test_key_fp, key2_fp])
+    assert sorted(keys.keys()) == sorted([test_key_fp, key2_fp])
+
+    # Each chunk is a complete key on its own
+    gpg2 = GnuPG(debug=True)
+    gpg2._gpg(['--import'], keys[key2_fp])
+    assert gpg2.get_uid(key2_fp) == 'PGP Sync Test uid 3 <pgpsync-uid3@example.com>'
+    assert not gpg2.in_keyring(test_key_fp)
+
+def test_gpg_import_pubkeys_from_disk():
+    appdata = tempfile.TemporaryDirectory()
+    gpg = GnuPG(appdata_path=appdata.name, debug=True)
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+    import_key('pgpsync_multiple_uids.asc', gpg.homedir)
+    gpg.export_pubkey_to_disk(test_key_fp)
+    gpg.export_pubkey_to_disk(b'D86B4D4BB5DFDD378B58D4D3F121AC6230396C33')
+    del gpg
+
+    # Keys that aren't stored are skipped
+    gpg = GnuPG(appdata_path=appdata.name, debug=True)
+    uids = gpg.import_pubkeys_from_disk([test_key_fp, b'D86B 4D4B B5DF DD37 8B58  D4D3 F121 AC62 3039 6C33', b'0' * 40])
+    assert uids == {
+        test_key_fp: 'GPG Sync Unit Test Key (not secure in any way)',
+        b'D86B4D4BB5DFDD378B58D4D3F121AC6230396C33': 'PGP Sync Test uid 3 <pgpsync-uid3@example.com>'
+    }
+    assert gpg.in_keyring(test_key_fp)
+
+    # Keys that are in the keyring already still get their uids
+    assert gpg.import_pubkeys_from_disk([test_key_fp]) == {test_key_fp: 'GPG Sync Unit Test Key (not secure in any way)'}
+
+    del gpg
+    appdata.cleanup()
+
+def test_gpg_migrate_pubkeys_on_disk():
+    appdata = tempfile.TemporaryDirectory()
+    gpg = GnuPG(appdata_path=appdata.name, debug=True)
+
+    # Keys saved by older versions, one .asc file each, move into the store
+    filename = os.path.join(appdata.name, test_key_fp.decode() + '.asc')
+    shutil.copy(get_gpg_file('gpgsync_test_pubkey.asc'), filename)
+    assert gpg.import_pubkeys_from_disk([test_key_fp]) == {test_key_fp: 'GPG Sync Unit Test Key (not secure in any way)'}
+    assert os.path.isfile(filename) == False
+    assert gpg.signing_keys.has(test_key_fp)
+
+    del gpg
+    appdata.cleanup()
+
+# A v5 public key packet, which split_keys can't tell the end of
+v5_key_packet = b'\xc6\x0a\x05' + b'\x00' * 9
+
+@raises(UnsupportedKeyVersion)
+def test_split_keys_unsupported_key_version():
+    gpg = GnuPG(debug=True)
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+    out,err = gpg._gpg(['--export', test_key_fp])
+    assert list(split_keys(out).keys()) == [test_key_fp]
+    split_keys(out + v5_key_packet)
+
+def test_gpg_export_keys_unsupported_key_version():
+    gpg = GnuPG(debug=True)
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+    import_key('expired_pubkey.asc', gpg.homedir)
+    expired_fp = b'30996DFF545AD6A02462639624C6564F385E35F8'
+    keys = gpg.export_keys([test_key_fp, expired_fp])
+
+    # If a key can't be split out of the export, they're exported one at a time
+    _gpg = gpg._gpg
+    def fake_gpg(args, input=None, pass_fds=()):
+        out,err = _gpg(args, input, pass_fds)
+        # Only when exporting both keys at once
+        if len(args) > 2:
+            out += v5_key_packet
+        return out,err
+    gpg._gpg = fake_gpg
+    assert gpg.export_keys([test_key_fp, expired_fp]) == keys
+
+def test_signing_key_store_unsupported_key_version():
+    appdata = tempfile.TemporaryDirectory()
+    open(os.path.join(appdata.name, 'signing_keys.gpg'), 'wb').write(v5_key_packet)
+
+    # Without an index, a keyring that can't be split is started over
+    store = SigningKeyStore(appdata.name, debug=True)
+    assert not store.has(test_key_fp)
+    assert store.put_many({test_key_fp: b'key'}) == [test_key_fp]
+
+    appdata.cleanup()
+
+def test_signing_key_store():
+    appdata = tempfile.TemporaryDirectory()
+    key = open(get_gpg_file('gpgsync_test_pubkey.asc'), 'rb').read()
+    store = SigningKeyStore(appdata.name, debug=True)
+
+    # Writing the same key again changes nothing
+    assert store.put_many({b'A' * 40: b'key a', b'B' * 40: b'key b'}) == [b'A' * 40, b'B' * 40]
+    assert store.put_many({b'A' * 40: b'key a'}) == []
+    assert store.put_many({b'A' * 40: b'new key a'}) == [b'A' * 40]
+
+    store = SigningKeyStore(appdata.name, debug=True)
+    assert store.get_many([b'B' * 40, b'C' * 40, b'A' * 40]) == {b'B' * 40: b'key b', b'A' * 40: b'new key a'}
+
+    store.delete(b'A' * 40)
+    store = SigningKeyStore(appdata.name, debug=True)
+    assert not store.has(b'A' * 40)
+    assert store.has(b'B' * 40)
+
+    appdata.cleanup()
+
+
+def test_gpg_delete_keys():
+    gpg = GnuPG(debug=True)
+    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
+    assert gpg.in_keyring(test_key_fp)
+
+    gpg.delete_keys([test_key_fp])
+    assert not gpg.in_keyring(test_key_fp)
+
 def test_gpg_verify():
     # test a message that works to verify
     gpg = GnuPG(debug=True)
@@ -65,6 +407,14 @@ def test_gpg_verify():
     msg_sig = open(get_gpg_file('signed_message-valid.txt.sig'), 'rb').read()
     gpg.verify(msg_sig, msg, b'3B72C32B49CBB5BBDD57440E1D07D43448FB8382')
 
+@raises(VerificationError)
+def test_gpg_verify_no_pubkey():
+    # test a message signed by a key that isn't in the keyring
+    gpg = GnuPG(debug=True)
+    msg = open(get_gpg_file('signed_message-valid.txt'), 'rb').read()
+    msg_sig = open(get_gpg_file('signed_message-valid.txt.sig'), 'rb').read()
+    gpg.verify(msg_sig, msg, b'3B72C32B49CBB5BBDD57440E1D07D43448FB8382')
+
 @raises(BadSignature)
 def test_gpg_verify_invalid_sig():
     # test a message with an invalid sig
@@ -99,55 +449,26 @@ def test_gpg_verify_wrong_key():
     msg_sig = open(get_gpg_file('signed_message-valid.txt.sig'), 'rb').read()
     gpg.verify(msg_sig, msg, b'D86B4D4BB5DFDD378B58D4D3F121AC6230396C33')
 
-def test_gpg_list_all_keyids():
-    gpg = GnuPG(debug=True)
-
-    import_key('gpgsync_test_pubkey.asc', gpg.homedir)
-    key1_fp = common.clean_fp(b'3B72C32B49CBB5BBDD57440E1D07D43448FB8382')
-
-    import_key('pgpsync_multiple_uids.asc', gpg.homedir)
-    key2_fp = common.clean_fp(b'D86B4D4BB5DFDD378B58D4D3F121AC6230396C33')
-
-    assert gpg.list_all_keyids(key1_fp) == [b'0x1D07D43448FB8382', b'0x1ED9906D2F8FC45D']
-    assert gpg.list_all_keyids(key2_fp) == [b'0xF121AC6230396C33', b'0x06D001C585800EF4']
-
 def test_gpg_export_pubkey_to_disk():
     appdata = tempfile.TemporaryDirectory()
     gpg = GnuPG(appdata_path=appdata.name, debug=True)
 
     fp = b'3B72C32B49CBB5BBDD57440E1D07D43448FB8382'
-    filename = gpg.get_pubkey_filename_on_disk(fp)
 
     # The key should be imported
     import_key('gpgsync_test_pubkey.asc', gpg.homedir)
     assert gpg.get_uid(fp) == 'GPG Sync Unit Test Key (not secure in any way)'
 
-    # The file shouldn't exist yet
-    assert os.path.isfile(filename) == False
+    # It shouldn't be stored yet
+    assert gpg.signing_keys.has(fp) == False
 
-    # Export the key, now it should exist
+    # Export the key, now it should be stored
     gpg.export_pubkey_to_disk(fp)
-    assert os.path.isfile(filename) == True
-
-    appdata.cleanup()
-
-def test_gpg_import_pubkey_from_disk():
-    appdata = tempfile.TemporaryDirectory()
-    gpg = GnuPG(appdata_path=appdata.name, debug=True)
-
-    fp = b'3B72C32B49CBB5BBDD57440E1D07D43448FB8382'
-    filename = gpg.get_pubkey_filename_on_disk(fp)
-
-    # Copy the pubkey into appdata_path
-    pubkey = open(get_gpg_file('gpgsync_test_pubkey.asc'), 'r').read()
-    open(filename, 'w').write(pubkey)
+    assert gpg.signing_keys.has(fp) == True
 
-    # The key shouldn't be imported yet
-    assert gpg.get_uid(fp) == ''
-
-    # Import the key, and now it should be there
-    gpg.import_pubkey_from_disk(fp)
-    assert gpg.get_uid(fp) == 'GPG Sync Unit Test Key (not secure in any way)'
+    # Without its index, the store finds the key in the keyring anyway
+    os.remove(os.path.join(appdata.name, 'signing_keys.json'))
+    assert SigningKeyStore(appdata.name, debug=True).has(fp)
 
     appdata.cleanup()
 
@@ -156,21 +477,17 @@ def test_gpg_delete_pubkey_from_disk():
     gpg = GnuPG(appdata_path=appdata.name, debug=True)
 
     fp = b'3B72C32B49CBB5BBDD57440E1D07D43448FB8382'
-    filename = gpg.get_pubkey_filename_on_disk(fp)
 
     # The key should be imported
     import_key('gpgsync_test_pubkey.asc', gpg.homedir)
     assert gpg.get_uid(fp) == 'GPG Sync Unit Test Key (not secure in any way)'
 
-    # The file shouldn't exist yet
-    assert os.path.isfile(filename) == False
-
-    # Export the key, now it should exist
+    # Export the key, now it should be stored
     gpg.export_pubkey_to_disk(fp)
-    assert os.path.isfile(filename) == True
+    assert gpg.signing_keys.has(fp) == True
 
-    # Delete it, and it shouldn't exist again
+    # Delete it, and it shouldn't be stored again
     gpg.delete_pubkey_from_disk(fp)
-    assert os.path.isfile(filename) == False
+    assert gpg.signing_keys.has(fp) == False
 
     appdata.cleanup()
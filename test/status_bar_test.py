@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from nose import with_setup
-from gpgsync.status_bar import StatusBar, MessageQueue
+from gpgsync.status_bar import StatusBar
 
 def test_status_bar_show_loading_animation():
     status_bar = StatusBar()
@@ -11,25 +11,3 @@ def test_status_bar_hide_loading_animation():
     status_bar = StatusBar()
     status_bar.hide_loading()
     assert status_bar.loading_animation.isHidden()
-
-def test_message_queue_add_message():
-    q = MessageQueue()
-    q.add_message('this is a test')
-    q.add_message('another test', timeout=2000)
-    q.add_message(type="clear")
-
-    assert q.get(False) == {
-        'type': 'update',
-        'msg': 'this is a test',
-        'timeout': 0
-    }
-    assert q.get(False) == {
-        'type': 'update',
-        'msg': 'another test',
-        'timeout': 2000
-    }
-    assert q.get(False) == {
-        'type': 'clear',
-        'msg': None,
-        'timeout': 0
-    }
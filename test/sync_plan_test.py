@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from nose import with_setup
+from gpgsync.sync_plan import SyncPlan
+from gpgsync.sync_state import SyncState
+from gpgsync.gnupg import KeyserverError
+from gpgsync.endpoint import Endpoint
+
+from .test_helpers import *
+
+def make_endpoint(keyserver):
+    e = Endpoint()
+    e.keyserver = keyserver
+    return e
+
+def test_sync_plan_fetches_each_key_once():
+    fp_a = b'ABCD' * 10
+    fp_b = b'1234' * 10
+    e1 = make_endpoint(b'hkps://keys.example.com')
+    e2 = make_endpoint(b'hkps://other.example.com')
+    e3 = make_endpoint(b'hkps://other.example.com')
+
+    plan = SyncPlan(3600)
+    plan.add_endpoint(e1, [fp_a])
+    plan.add_endpoint(e2, [fp_a, fp_b])
+    plan.add_endpoint(e3, [fp_a])
+
+    # Both keys come from the keyserver most of the endpoints listing them use
+    groups = plan.get_fetch_groups()
+    assert len(groups) == 1
+    assert groups[0][0] == plan.get_route(e2)
+    assert groups[0][1] == [fp_a, fp_b]
+
+def test_sync_plan_failed_route():
+    fp_a = b'ABCD' * 10
+    e1 = make_endpoint(b'hkps://keys.example.com')
+    e2 = make_endpoint(b'hkps://other.example.com')
+
+    plan = SyncPlan(3600)
+    plan.add_endpoint(e1, [fp_a])
+    plan.add_endpoint(e2, [fp_a], [b'invalid'])
+
+    # Fall back to the other endpoint's keyserver
+    plan.failed_routes[plan.get_route(e1)] = 'Keyserver error'
+    groups = plan.get_fetch_groups()
+    assert groups == [(plan.get_route(e2), [fp_a])]
+
+    # If it worked, nobody failed
+    plan.results[fp_a] = 'notfound'
+    assert plan.get_result(e1) == ([], [fp_a], [], None)
+    assert plan.get_result(e2) == ([b'invalid'], [fp_a], [], None)
+
+    # If it didn't, both endpoints did
+    del plan.results[fp_a]
+    plan.failed_routes[plan.get_route(e2)] = 'Invalid keyserver'
+    assert plan.get_fetch_groups() == []
+    assert plan.get_result(e1) == ([], [], [], 'Keyserver error')
+    assert plan.get_result(e2) == ([b'invalid'], [], [], 'Invalid keyserver')
+
+def test_sync_plan_priority():
+    fp_a = b'ABCD' * 10
+    fp_b = b'1234' * 10
+    e1 = make_endpoint(b'hkps://keys.example.com')
+    e2 = make_endpoint(b'hkps://keys.example.com')
+
+    plan = SyncPlan(3600)
+    plan.add_endpoint(e1, [fp_a])
+    plan.add_endpoint(e2, [fp_b], priority_fingerprints=[fp_b])
+
+    # Expired keys from any endpoint go first
+    assert plan.get_fetch_groups() == [(plan.get_route(e1), [fp_b, fp_a])]
+
+def test_sync_plan_cached_not_found():
+    fp_a = b'ABCD' * 10
+    fp_b = b'1234' * 10
+    e = make_endpoint(b'hkps://keys.example.com')
+
+    plan = SyncPlan(3600)
+    plan.add_endpoint(e, [fp_a], notfound_fingerprints=[fp_b])
+
+    # Keys that weren't found last time are reported, but not fetched
+    assert plan.get_fetch_groups() == [(plan.get_route(e), [fp_a])]
+    plan.results[fp_a] = 'notfound'
+    assert plan.get_result(e) == ([], [fp_b, fp_a], [], None)
+
+def test_sync_plan_failed_keys():
+    fp_a = b'ABCD' * 10
+    fp_b = b'1234' * 10
+    e1 = make_endpoint(b'hkps://keys.example.com')
+    e2 = make_endpoint(b'hkps://other.example.com')
+
+    plan = SyncPlan(3600)
+    plan.add_endpoint(e1, [fp_a, fp_b])
+    plan.add_endpoint(e2, [fp_b])
+
+    # A key that failed is tried over another route, and the rest of its
+    # group isn't affected
+    plan.results[fp_a] = 'fetched'
+    plan.failed_keys[fp_b] = {plan.get_route(e1): 'Keyserver error'}
+    assert plan.get_fetch_groups() == [(plan.get_route(e2), [fp_b])]
+    assert plan.get_result(e1) == ([], [], [], 'Keyserver error')
+    assert plan.get_result(e2) == ([], [], [], None)
+
+    # Once no route is left, it's given up on
+    plan.failed_keys[fp_b][plan.get_route(e2)] = 'Keyserver error'
+    assert plan.get_fetch_groups() == []
+    assert plan.get_result(e2) == ([], [], [], 'Keyserver error')
+
+class FailingGnuPG(object):
+    def connect_dirmngr(self, keyserver):
+        return None
+
+    def recv_keys(self, keyserver, fps, use_proxy, proxy_host, proxy_port, dirmngr=None):
+        raise KeyserverError(keyserver)
+
+def test_sync_plan_records_failures():
+    fp_a = b'ABCD' * 10
+    e1 = make_endpoint(b'hkps://keys.example.com')
+    e2 = make_endpoint(b'hkps://other.example.com')
+    sync_state = SyncState()
+
+    plan = SyncPlan(3600)
+    plan.add_endpoint(e1, [fp_a])
+    plan.add_endpoint(e2, [fp_a])
+
+    # One failure per sync, however many routes failed
+    plan.execute(FailingGnuPG(), sync_state, lambda msg: None)
+    assert plan.get_result(e1) == ([], [], [], 'Keyserver error')
+    assert sync_state.get_key(fp_a) == {'failures': 1}
+    assert not sync_state.key_is_not_found(fp_a)
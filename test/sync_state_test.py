@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import tempfile, datetime, time, os, sqlite3
+from nose import with_setup
+from gpgsync.sync_state import SyncState, MIGRATIONS
+from gpgsync.endpoint import Endpoint
+
+from .test_helpers import *
+
+def test_sync_state_update_key():
+    state = SyncState()
+    assert state.get_key(test_key_fp) == {}
+
+    state.update_key(test_key_fp, digest='abc')
+    state.update_key(test_key_fp, last_fetched='2017-03-03T00:00:00')
+    assert state.get_key(test_key_fp) == {'digest': 'abc', 'last_fetched': '2017-03-03T00:00:00'}
+
+def test_sync_state_save_and_load():
+    appdata = tempfile.TemporaryDirectory()
+
+    state = SyncState(appdata.name)
+    state.update_key(test_key_fp, digest='abc')
+    state.save()
+
+    state = SyncState(appdata.name)
+    assert state.get_key(test_key_fp) == {'digest': 'abc'}
+
+    appdata.cleanup()
+
+def test_sync_state_load_corrupt():
+    appdata = tempfile.TemporaryDirectory()
+    with open(os.path.join(appdata.name, 'sync_state.db'), 'wb') as f:
+        f.write(b'not a database' * 100)
+
+    # It starts over
+    state = SyncState(appdata.name)
+    assert state.get_key(test_key_fp) == {}
+    state.update_key(test_key_fp, digest='abc')
+    state.save()
+
+    appdata.cleanup()
+
+def test_sync_state_migrate_not_found_count():
+    appdata = tempfile.TemporaryDirectory()
+    db = sqlite3.connect(os.path.join(appdata.name, 'sync_state.db'))
+    db.executescript(MIGRATIONS[0])
+    db.execute('PRAGMA user_version = 1')
+    db.execute("INSERT INTO keys (fingerprint, failures) VALUES (?, 2)", (test_key_fp.decode(),))
+    db.commit()
+    db.close()
+
+    # failures used to count not found keys
+    state = SyncState(appdata.name)
+    assert state.get_key(test_key_fp) == {'not_found_count': 2}
+    assert state.key_is_not_found(test_key_fp)
+
+    appdata.cleanup()
+
+def test_sync_state_update_endpoint():
+    state = SyncState()
+    e = Endpoint()
+    e.fingerprint = test_key_fp
+    e.url = b'https://example.com/fingerprints.txt'
+    state.update_endpoint(e, fingerprints=[test_key_fp.decode()])
+    assert state.get_endpoint(e) == {'fingerprints': [test_key_fp.decode()]}
+    state.update_endpoint(e, url_validators={'etag': '"abc"', 'last_modified': None})
+    assert state.get_endpoint(e) == {'fingerprints': [test_key_fp.decode()], 'url_validators': {'etag': '"abc"', 'last_modified': None}}
+
+    # A different URL is a different endpoint
+    e.url = b'https://example.com/other_fingerprints.txt'
+    assert state.get_endpoint(e) == {}
+
+def test_sync_state_key_is_due():
+    state = SyncState()
+    assert state.key_is_due(test_key_fp, 3600)
+
+    state.update_key(test_key_fp, last_fetched=datetime.datetime.now().isoformat())
+    assert not state.key_is_due(test_key_fp, 3600)
+
+    state.update_key(test_key_fp, last_fetched=(datetime.datetime.now() - datetime.timedelta(hours=2)).isoformat())
+    assert state.key_is_due(test_key_fp, 3600)
+
+    state.forget_key(test_key_fp)
+    assert state.get_key(test_key_fp) == {}
+
+def test_sync_state_schedule_key():
+    state = SyncState()
+    now = datetime.datetime.now()
+
+    # The first time, anywhere in the interval
+    state.schedule_key(test_key_fp, 3600)
+    next_refresh = datetime.datetime.strptime(state.get_key(test_key_fp)['next_refresh'], '%Y-%m-%dT%H:%M:%S.%f')
+    assert now <= next_refresh <= now + datetime.timedelta(seconds=3601)
+
+    # After that, about one interval later
+    state.schedule_key(test_key_fp, 3600)
+    next_refresh = datetime.datetime.strptime(state.get_key(test_key_fp)['next_refresh'], '%Y-%m-%dT%H:%M:%S.%f')
+    assert now + datetime.timedelta(seconds=3239) <= next_refresh <= now + datetime.timedelta(seconds=3961)
+    assert not state.key_is_due(test_key_fp, 3600)
+
+    state.update_key(test_key_fp, next_refresh=(now - datetime.timedelta(seconds=1)).isoformat())
+    assert state.key_is_due(test_key_fp, 3600)
+
+def test_sync_state_get_refresh_interval():
+    state = SyncState()
+    assert state.get_refresh_interval(test_key_fp, 3600) == 3600
+
+    # About to expire
+    state.update_key(test_key_fp, last_fetched=datetime.datetime.now().isoformat(), expires=int(time.time()) + 60)
+    assert state.key_expires_soon(test_key_fp)
+    assert state.get_refresh_interval(test_key_fp, 3600) == 900
+
+    # Never expires, and hasn't changed in a while
+    state.update_key(test_key_fp, expires=None, unchanged_count=1)
+    assert not state.key_expires_soon(test_key_fp)
+    assert state.get_refresh_interval(test_key_fp, 3600) == 5400
+    state.update_key(test_key_fp, unchanged_count=5)
+    assert state.get_refresh_interval(test_key_fp, 3600) == 7200
+
+def test_sync_state_schedule_not_found_key():
+    state = SyncState()
+    for i in range(10):
+        state.schedule_not_found_key(test_key_fp, 3600)
+        delay = datetime.datetime.strptime(state.get_key(test_key_fp)['next_refresh'], '%Y-%m-%dT%H:%M:%S.%f') - datetime.datetime.now()
+        assert abs(delay.total_seconds() - min(3600 * 2**i, 7*24*60*60)) < 60
+
+    assert state.key_is_not_found(test_key_fp)
+    assert not state.key_is_due(test_key_fp, 3600)
+
+def test_sync_state_record_key_failure():
+    state = SyncState()
+    state.record_key_failure(test_key_fp)
+    state.record_key_failure(test_key_fp)
+    assert state.get_key(test_key_fp) == {'failures': 2}
+
+    # Keyserver errors aren't taken for keys that aren't there
+    assert not state.key_is_not_found(test_key_fp)
+    assert state.key_is_due(test_key_fp, 3600)
+
+    # An answer from the keyserver ends the streak
+    state.schedule_not_found_key(test_key_fp, 3600)
+    assert state.get_key(test_key_fp)['failures'] == 0
+
+def test_sync_state_get_due_keys():
+    state = SyncState()
+    fp_a = b'ABCD' * 10
+    fp_b = b'1234' * 10
+    now = datetime.datetime.now()
+
+    state.update_key(test_key_fp, next_refresh=(now - datetime.timedelta(seconds=1)).isoformat())
+    state.update_key(fp_a, next_refresh=(now + datetime.timedelta(hours=1)).isoformat())
+    assert state.get_due_keys([test_key_fp, fp_a, fp_b], 3600) == [test_key_fp, fp_b]
+
+def test_sync_state_get_not_found_keys():
+    state = SyncState()
+    fp_a = b'ABCD' * 10
+    fp_b = b'1234' * 10
+
+    state.schedule_not_found_key(fp_a, 3600)
+    state.update_key(fp_b, not_found_count=0)
+    assert state.get_not_found_keys([test_key_fp, fp_a, fp_b]) == [fp_a]
+
+def test_sync_state_get_changed_keys():
+    state = SyncState()
+    fp_a = b'ABCD' * 10
+    now = datetime.datetime.now()
+
+    state.update_key(test_key_fp, last_changed=(now - datetime.timedelta(days=1)).isoformat())
+    state.update_key(fp_a, last_changed=now.isoformat())
+    assert state.get_changed_keys(now - datetime.timedelta(hours=1)) == [fp_a]
+    assert state.get_changed_keys(now - datetime.timedelta(days=2)) == [test_key_fp, fp_a]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import json, threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from gpgsync.threads import UpdateChecker
+
+from .test_helpers import *
+
+class ReleaseHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            body = json.dumps({'tag_name': 'v1.0.0', 'html_url': 'https://example.com/'}).encode()
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def check_for_updates(url, etag=None, release=None):
+    results = []
+    update_checker = UpdateChecker(True, False, b'127.0.0.1', b'9050', etag, release)
+    update_checker.url = url
+    update_checker.checked.connect(lambda release, etag: results.append((release, etag)))
+    update_checker.run()
+    return results[0]
+
+def test_update_checker_etag():
+    server = HTTPServer(('127.0.0.1', 0), ReleaseHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    # The first check downloads the release
+    release, etag = check_for_updates(url)
+    assert release['tag_name'] == 'v1.0.0'
+    assert etag == '"v1"'
+
+    # The next one gets a 304, and uses the saved release
+    assert check_for_updates(url, etag, release) == (release, etag)
+    assert ReleaseHandler.requests == [None, '"v1"']
+
+    # Failed requests give None
+    server.shutdown()
+    server.server_close()
+    assert check_for_updates(url) == (None, None)